@@ -0,0 +1,522 @@
+"""
+Cross Crowding Index
+-------------
+Computes colocations between groups of users (e.g. residents of each parish and tourists)
+from a flat table of stays, as in pre_lockdown_mobility.ipynb.
+
+Stays are assigned to H3 cells and to every time interval they overlap. The number of
+users of each group in each (day, interval, cell) forms a sparse count tensor X, and the
+colocation matrices are products of X with itself:
+    colocations[i, j] = sum over (interval, cell) of n_i * n_j          for i != j
+    colocations[i, i] = sum over (interval, cell) with n_i > 0 of n_i**2 - 1
+(the diagonal as computed in pre_lockdown_mobility.ipynb).
+
+With cell_radius > 0, users in neighbouring cells (h3.k_ring) are also colocated.
+With cell_weights, colocations within a cell are weighted by its weight, and between
+neighbouring cells by the product of their weights. Indoor colocations are counted, as in
+pre_lockdown_mobility.ipynb, with the indicator weights of the cells entirely built-up
+(get_indoor_weights of the built-up fractions of outputs/h3_res11_builtup.json, the default
+--cell_weighting=indoor). --cell_weighting=fraction weights cells by their built-up fraction
+instead, which also counts the colocations of partly built-up cells, so its CCI is not that
+of the notebook.
+
+The Cross Crowding Index (CCI) of group i with group j is the number of colocations with
+users of group j per user of group i, averaged over days.
+
+Example usage:
+
+    stays_df = read_stays_df('../data/private/', dates)
+    homes_df = pd.read_csv('../data/private/homes/2020_1_homes.csv')
+    user_groups = get_parish_tourist_groups(homes_df, PresenceStore.open(...))
+    colocations, group_sizes = get_colocation_matrices(stays_df, user_groups, GROUPS)
+    cci_df = get_cci_df(colocations, group_sizes, GROUPS)
+
+
+Usage:
+python cross_crowding.py \
+    --start_date=yyyy-mm-dd \
+    --end_date=yyyy-mm-dd \
+    --data_filepath=PATH \
+    --outputs_filepath=PATH \
+    [--homes_month=yyyy-mm] \
+    [--presence_store=PATH] \
+    [--nationality_groups=country|PATH] \
+    [--resolution=INT] \
+    [--interval_length_minutes=INT] \
+    [--cell_radius=INT] \
+    [--cell_weights=PATH] \
+    [--cell_weighting=indoor|fraction] \
+    [--sample_rate=FLOAT] \
+    [--n_buckets=INT]
+
+Example usage:
+python cross_crowding.py \
+    --start_date=2020-01-01 \
+    --end_date=2020-02-29 \
+    --data_filepath=../data/private/ \
+    --outputs_filepath=../outputs/metrics/ \
+    --cell_weights=../outputs/h3_res11_builtup.json
+
+Instrumentation options (see andorra_mobility/instrumentation.py):
+    [--metrics_log=PATH] [--profile_day=yyyy-mm-dd] [--profiler=cprofile|sampling]
+
+
+Residents are grouped by their home parish of homes_month (defaults to the month of start_date)
+and tourists are those of the presence store (defaults to the store of the year of start_date).
+
+With --sample_rate < 1, only a stable sample of users is read (see andorra_mobility/sampling.py).
+Colocations between groups scale as sample_rate**2 and group sizes as sample_rate, so the CCI
+is scaled by 1 / sample_rate. The diagonal (n_i**2 - 1 per cell) is only approximately
+unbiased, for groups of several users per cell. Standard errors are estimated with n_buckets
+delete-a-group jackknife replicates: users are split into buckets by the hash of their imsi,
+and the colocations without each bucket are computed from the same count tensor.
+
+Saves the CCI matrix to
+outputs_filepath/YEAR/cci.csv:
+-------------
+group, CCI with each group
+or, with --sample_rate < 1, to cci_sample_RATE.csv, and their standard errors to cci_sample_RATE_se.csv
+
+"""
+from datetime import datetime
+import json
+from pathlib import Path
+
+import h3
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from andorra_mobility.inputs import read_csv
+from andorra_mobility.instrumentation import Instrumentation, add_instrumentation_args
+from andorra_mobility.nationality import get_mcc_grouping
+from andorra_mobility.paths import (find_input, get_datetimes, get_homes_filepath, get_presence_store_filepath,
+                                    get_sample_suffix, get_stays_filepath, month_fmt)
+from andorra_mobility.presence_store import RESIDENT, PresenceStore
+from andorra_mobility.sampling import add_sampling_args, get_buckets, get_sample_rate, set_sample_rate
+
+IMSI = 'imsi'
+DAY = 'day'
+PARISH = 'parish'
+LAT = 'lat'
+LON = 'lon'
+START = 's'
+END = 'e'
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+PARISHES = ['Andorra la Vella', 'Canillo', 'Encamp', 'Escaldes-Engordany',
+            'La Massana', 'Ordino', 'Sant Julià de Lòria']
+TOURISTS = 'Tourists'
+GROUPS = PARISHES + [TOURISTS]
+
+DEFAULT_RESOLUTION = 11
+DEFAULT_INTERVAL_LENGTH_MINUTES = 10
+# delete-a-group jackknife replicates of sampled runs
+DEFAULT_N_BUCKETS = 20
+
+# how --cell_weights are applied
+INDOOR = 'indoor'
+FRACTION = 'fraction'
+CELL_WEIGHTINGS = [INDOOR, FRACTION]
+# cells with a built-up fraction of at least INDOOR_THRESHOLD are indoor
+INDOOR_THRESHOLD = 1
+
+
+def read_stays_df(data_filepath, dates):
+    """
+    Returns the stays of the given dates as one table, with a 'day' column indexing dates.
+    Missing dates are skipped.
+    """
+    stays_dfs = []
+    sample_rate = get_sample_rate()
+    for day, d in enumerate(dates):
+        fpath = find_input(get_stays_filepath, data_filepath, sample_rate, d.day, d.month, d.year)
+        if not Path(fpath).is_file():
+            print('file not found: %s' % fpath)
+            continue
+        stays_df = read_csv(fpath, usecols=[IMSI, START, END, LAT, LON])
+        stays_df[DAY] = day
+        stays_dfs.append(stays_df)
+    return pd.concat(stays_dfs, ignore_index=True)
+
+
+def get_stays_df_from_persons(persons, day=0):
+    """
+    Flattens persons (as in the stays json files) to a stays table.
+    """
+    records = [(person['imsi'], stay['s'], stay['e'], stay['p'][1], stay['p'][0])
+               for person in persons for stay in person['stay_points']]
+    stays_df = pd.DataFrame.from_records(records, columns=[IMSI, START, END, LAT, LON])
+    stays_df[DAY] = day
+    return stays_df
+
+
+def get_parish_tourist_groups(homes_df, presence_store, mcc_grouping=None):
+    """
+    Returns a series of the group of each user, indexed by imsi:
+    residents are grouped by their home parish (from homes_df, with columns imsi, parish)
+    and tourists are grouped together as TOURISTS, or by the nationality groups of
+    mcc_grouping (see andorra_mobility/nationality.py).
+    Residents without a home parish are not grouped.
+    """
+    imsis = np.asarray(presence_store.imsi)
+    is_resident = presence_store.get_user_mask(RESIDENT)
+    home_parishes = homes_df.set_index(IMSI)[PARISH]
+    home_parishes = home_parishes[~home_parishes.index.duplicated()]
+    groups = pd.Series(home_parishes.reindex(imsis).values, index=imsis, dtype=object)
+    groups[~is_resident] = (TOURISTS if mcc_grouping is None
+                            else mcc_grouping.get_names(np.asarray(presence_store.mcc)[~is_resident]))
+    return groups.dropna()
+
+
+def get_cell_ids(stays_df, resolution):
+    """
+    Returns the H3 cell of each stay. Each distinct location is only converted once.
+    """
+    locations, inverse = np.unique(stays_df[[LAT, LON]].values, axis=0, return_inverse=True)
+    location_cells = np.array([h3.geo_to_h3(lat, lon, resolution) for lat, lon in locations], dtype=object)
+    return location_cells[inverse.ravel()]
+
+
+def get_interval_stays(stays_df, interval_length_minutes):
+    """
+    Expands stays over the intervals they overlap.
+    returns (stay index, interval index) arrays, with intervals numbered across days.
+    """
+    T = interval_length_minutes * 60
+    n_intervals = int(SECONDS_PER_DAY / T)
+    int_start = (stays_df[START].values // T).astype(np.int64)
+    int_end = np.minimum(stays_df[END].values // T, n_intervals - 1).astype(np.int64)
+    n_stay_intervals = np.maximum(int_end - int_start + 1, 0)
+    stay_inds = np.repeat(np.arange(len(stays_df)), n_stay_intervals)
+    # position of each repeated stay within its run of intervals
+    offsets = np.arange(len(stay_inds)) - np.repeat(np.cumsum(n_stay_intervals) - n_stay_intervals, n_stay_intervals)
+    intervals = stays_df[DAY].values[stay_inds] * n_intervals + int_start[stay_inds] + offsets
+    return stay_inds, intervals
+
+
+def get_neighbour_pairs(cell_ids, cell_radius):
+    """
+    Returns (cell code, neighbour cell code) arrays of the pairs of distinct cells within
+    cell_radius of each other, among cell_ids.
+    """
+    cell_codes = {cell_id: code for code, cell_id in enumerate(cell_ids)}
+    pairs = [(code, cell_codes[n]) for code, cell_id in enumerate(cell_ids)
+             for n in h3.k_ring(cell_id, cell_radius) if n != cell_id and n in cell_codes]
+    pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def get_count_tensor(stays_df, user_groups, groups, resolution=DEFAULT_RESOLUTION,
+                     interval_length_minutes=DEFAULT_INTERVAL_LENGTH_MINUTES, n_buckets=1):
+    """
+    returns (X, group_sizes, row_intervals, row_cells, cell_ids)
+        X: sparse (interval, cell) x (bucket, day, group) matrix of the number of users in each
+           (interval, cell), so that X.T @ X holds each day's colocations in a diagonal block
+        group_sizes: array (buckets x days x groups) of the number of users of each group with stays
+        row_intervals, row_cells: the interval and cell code of each row, sorted
+        cell_ids: the H3 cell of each cell code
+    Users are split into n_buckets buckets by the hash of their imsi (see andorra_mobility/sampling.py).
+    """
+    n_groups = len(groups)
+    group_codes = pd.Categorical(user_groups.reindex(stays_df[IMSI].values).values, categories=groups).codes
+    stays_df = stays_df[group_codes >= 0]
+    group_codes = group_codes[group_codes >= 0].astype(np.int64)
+    n_days = int(stays_df[DAY].max()) + 1 if len(stays_df) else 0
+    buckets = (np.zeros(len(stays_df), dtype=np.int64) if n_buckets == 1
+               else get_buckets(stays_df[IMSI].values, n_buckets))
+    # groups of each bucket
+    bucket_groups = buckets * n_groups + group_codes
+    n_bucket_groups = n_buckets * n_groups
+    user_days = pd.DataFrame({IMSI: stays_df[IMSI].values, DAY: stays_df[DAY].values, 'g': bucket_groups})
+    user_days = user_days.drop_duplicates([IMSI, DAY])
+    size_buckets, size_groups = np.divmod(user_days['g'].values, n_groups)
+    group_sizes = np.bincount((size_buckets * n_days + user_days[DAY].values) * n_groups + size_groups,
+                              minlength=n_buckets * n_days * n_groups).reshape(n_buckets, n_days, n_groups)
+
+    cell_codes, cell_ids = pd.factorize(get_cell_ids(stays_df, resolution))
+    stay_inds, intervals = get_interval_stays(stays_df, interval_length_minutes)
+    n_intervals_per_day = int(SECONDS_PER_DAY / (interval_length_minutes * 60))
+    # nonzero entries of the (interval x cell x bucket group) tensor
+    keys = (intervals * len(cell_ids) + cell_codes[stay_inds]) * n_bucket_groups + bucket_groups[stay_inds]
+    keys, counts = np.unique(keys, return_counts=True)
+    interval_cells, tensor_bucket_groups = np.divmod(keys, n_bucket_groups)
+    tensor_buckets, tensor_groups = np.divmod(tensor_bucket_groups, n_groups)
+    rows, row_interval_cells = pd.factorize(interval_cells, sort=True)
+    row_intervals, row_cells = np.divmod(row_interval_cells, len(cell_ids))
+    row_days = row_intervals // n_intervals_per_day
+    X = sparse.csr_matrix(
+        (counts.astype(np.float64), (rows, (tensor_buckets * n_days + row_days[rows]) * n_groups + tensor_groups)),
+        shape=(len(row_interval_cells), n_buckets * n_days * n_groups))
+    return X, group_sizes, row_intervals, row_cells, cell_ids
+
+
+def get_colocation_products(X_left, X_right, row_weights, n_groups, R=None, X_present=None):
+    """
+    Returns the array (days x groups x groups) of the day blocks of X_left.T @ W @ X_right
+    (W: the diagonal row weights) of colocations, plus those between neighbouring rows of R.
+    The rows of a day only have entries in the (day, group) columns of that day, so the product
+    is block diagonal: it is kept sparse, and only its day blocks are made dense.
+    With X_present, n_i**2 - 1 rather than n_i**2 is counted on the diagonal,
+    for each (interval, cell) where column i of X_present is nonzero.
+    """
+    W = sparse.diags(row_weights)
+    products = X_left.T @ W @ X_right
+    if R is not None:
+        products = products + X_left.T @ W @ R @ W @ X_right
+    blocks = get_day_blocks(products, n_groups)
+    if X_present is not None:
+        subtract_self_colocations(blocks, X_present, row_weights)
+    return blocks
+
+
+def get_day_blocks(products, n_groups):
+    """
+    Returns the array (days x groups x groups) of the diagonal day blocks of the sparse matrix products.
+    """
+    n_days = products.shape[0] // n_groups
+    products = products.tocoo()
+    days, rows = np.divmod(products.row, n_groups)
+    column_days, columns = np.divmod(products.col, n_groups)
+    in_block = days == column_days
+    blocks = np.zeros((n_days, n_groups, n_groups))
+    np.add.at(blocks, (days[in_block], rows[in_block], columns[in_block]), products.data[in_block])
+    return blocks
+
+
+def subtract_self_colocations(blocks, X_present, row_weights):
+    """
+    Subtracts, in place, the colocations of each user with themselves from the diagonals of the
+    day blocks: one for each (interval, cell) where column i of X_present is nonzero.
+    """
+    n_days, n_groups = blocks.shape[:2]
+    self_colocations = ((X_present > 0).astype(np.float64).T @ row_weights).reshape(n_days, n_groups)
+    blocks[:, np.arange(n_groups), np.arange(n_groups)] -= self_colocations
+
+
+def get_indoor_weights(cell_weights, threshold=INDOOR_THRESHOLD):
+    """
+    Returns the indicator weights {cell id: 1} of the cells whose weight (e.g. built-up fraction)
+    is at least threshold, as the indoor colocations of pre_lockdown_mobility.ipynb (cover == 1).
+    """
+    return {cell_id: 1.0 for cell_id, weight in cell_weights.items() if weight >= threshold}
+
+
+def get_row_weights(row_cells, cell_ids, cell_weights=None):
+    if cell_weights is None:
+        return np.ones(len(row_cells))
+    return np.array([cell_weights.get(c, 0) for c in cell_ids], dtype=np.float64)[row_cells]
+
+
+def get_colocation_matrices(stays_df, user_groups, groups, resolution=DEFAULT_RESOLUTION,
+                            interval_length_minutes=DEFAULT_INTERVAL_LENGTH_MINUTES, cell_radius=0,
+                            cell_weights=None, instrumentation=None):
+    """
+    returns (colocations, group_sizes)
+        colocations: array (days x groups x groups) of the number of colocations between groups
+        group_sizes: array (days x groups) of the number of users of each group with stays
+    stays_df: stays with columns imsi, s, e, lat, lon and day (see read_stays_df)
+    user_groups: series of the group of each user, indexed by imsi. Users without a group are ignored.
+    groups: the groups, in the order of the matrices
+    cell_radius: colocate users within cell_radius cells (h3.k_ring) of each other
+    cell_weights: optional dict of the weight of each cell id (cells not in it have weight 0)
+    """
+    if instrumentation is None:
+        instrumentation = Instrumentation('cross crowding')
+    with instrumentation.stage('count tensor', rows_in=len(stays_df)) as stage_record:
+        X, group_sizes, row_intervals, row_cells, cell_ids = get_count_tensor(
+            stays_df, user_groups, groups, resolution, interval_length_minutes)
+        stage_record.rows_out = X.nnz
+
+    with instrumentation.stage('colocations', rows_in=X.nnz) as stage_record:
+        row_weights = get_row_weights(row_cells, cell_ids, cell_weights)
+        R = None
+        if cell_radius > 0:
+            cells_a, cells_b = get_neighbour_pairs(cell_ids, cell_radius)
+            R = get_neighbour_rows(row_intervals, row_cells, len(cell_ids), cells_a, cells_b)
+        colocations = get_colocation_products(X, X, row_weights, len(groups), R, X_present=X)
+        stage_record.rows_out = len(colocations)
+    return colocations, group_sizes[0]
+
+
+def get_colocation_replicates(stays_df, user_groups, groups, n_buckets=DEFAULT_N_BUCKETS,
+                              resolution=DEFAULT_RESOLUTION, interval_length_minutes=DEFAULT_INTERVAL_LENGTH_MINUTES,
+                              cell_radius=0, cell_weights=None, instrumentation=None):
+    """
+    returns (colocations, group_sizes, replicate_colocations, replicate_group_sizes)
+    as get_colocation_matrices, and their delete-a-group jackknife replicates
+    (buckets x days x groups x groups and buckets x days x groups): users are split into
+    n_buckets buckets by hash, and replicate b leaves the users of bucket b out.
+    Colocations without bucket b are those of all users, minus those of bucket b with all
+    users counted twice, plus those within bucket b, so the tensor is only built once.
+    """
+    if instrumentation is None:
+        instrumentation = Instrumentation('cross crowding')
+    n_groups = len(groups)
+    with instrumentation.stage('count tensor', rows_in=len(stays_df)) as stage_record:
+        X, bucket_group_sizes, row_intervals, row_cells, cell_ids = get_count_tensor(
+            stays_df, user_groups, groups, resolution, interval_length_minutes, n_buckets)
+        stage_record.rows_out = X.nnz
+
+    with instrumentation.stage('colocation replicates', rows_in=X.nnz) as stage_record:
+        row_weights = get_row_weights(row_cells, cell_ids, cell_weights)
+        R = None
+        if cell_radius > 0:
+            cells_a, cells_b = get_neighbour_pairs(cell_ids, cell_radius)
+            R = get_neighbour_rows(row_intervals, row_cells, len(cell_ids), cells_a, cells_b)
+        n_columns = X.shape[1] // n_buckets
+        X = X.tocsc()
+        bucket_Xs = [X[:, b * n_columns:(b + 1) * n_columns].tocsr() for b in range(n_buckets)]
+        X_all = sum(bucket_Xs[1:], bucket_Xs[0])
+        products = get_colocation_products(X_all, X_all, row_weights, n_groups, R)
+        colocations = products.copy()
+        subtract_self_colocations(colocations, X_all, row_weights)
+        replicate_colocations = []
+        for X_b in bucket_Xs:
+            cross_products = get_colocation_products(X_b, X_all, row_weights, n_groups, R)
+            replicate_products = (products - cross_products - cross_products.transpose(0, 2, 1)
+                                  + get_colocation_products(X_b, X_b, row_weights, n_groups, R))
+            subtract_self_colocations(replicate_products, X_all - X_b, row_weights)
+            replicate_colocations.append(replicate_products)
+        stage_record.rows_out = n_buckets
+    group_sizes = bucket_group_sizes.sum(axis=0)
+    return colocations, group_sizes, np.stack(replicate_colocations), group_sizes[None] - bucket_group_sizes
+
+
+def get_neighbour_rows(row_intervals, row_cells, n_cells, cells_a, cells_b):
+    """
+    Returns a sparse matrix R with R[r1, r2] = 1 if the (interval, cell) rows r1 and r2
+    are in the same interval and in neighbouring cells.
+    """
+    row_keys = row_intervals * n_cells + row_cells
+    # neighbours of each row's cell
+    order = np.argsort(cells_a, kind='stable')
+    cells_a, cells_b = cells_a[order], cells_b[order]
+    first = np.searchsorted(cells_a, np.arange(n_cells))
+    n_neighbours = np.bincount(cells_a, minlength=n_cells)[row_cells]
+    rows_a = np.repeat(np.arange(len(row_keys)), n_neighbours)
+    offsets = np.arange(len(rows_a)) - np.repeat(np.cumsum(n_neighbours) - n_neighbours, n_neighbours)
+    neighbour_keys = row_intervals[rows_a] * n_cells + cells_b[first[row_cells[rows_a]] + offsets]
+    # rows are sorted by key, so neighbouring rows are found by binary search
+    rows_b = np.minimum(np.searchsorted(row_keys, neighbour_keys), len(row_keys) - 1)
+    found = row_keys[rows_b] == neighbour_keys
+    return sparse.csr_matrix((np.ones(found.sum()), (rows_a[found], rows_b[found])),
+                             shape=(len(row_keys), len(row_keys)))
+
+
+def get_cci(colocations, group_sizes):
+    """
+    Returns the Cross Crowding Index matrix (groups x groups): the number of colocations
+    with users of group j per user of group i, averaged over days.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        per_user = colocations / group_sizes[:, :, None]
+        # days without users of group i are left out, and groups without users are nan
+        observed = ~np.isnan(per_user)
+        return np.where(observed, per_user, 0).sum(axis=0) / observed.sum(axis=0)
+
+
+def get_cci_df(colocations, group_sizes, groups, sample_rate=1.0):
+    """
+    Returns the CCI matrix as a table. The CCI of a sample of users (at sample_rate) is scaled
+    up to all users: colocations scale as sample_rate**2 and group sizes as sample_rate.
+    """
+    cci = get_cci(colocations, group_sizes) / sample_rate
+    return pd.DataFrame(cci, index=groups, columns=groups)
+
+
+def get_cci_standard_errors(replicate_colocations, replicate_group_sizes, sample_rate):
+    """
+    Returns the delete-a-group jackknife standard error of the scaled CCI matrix of a sample
+    of users (see get_colocation_replicates), with the finite population correction 1 - sample_rate.
+    Each replicate is a sample at sample_rate * (n - 1) / n, for n replicates.
+    """
+    n_replicates = len(replicate_colocations)
+    replicate_rate = sample_rate * (n_replicates - 1) / n_replicates
+    replicate_cci = np.stack([get_cci(colocations, group_sizes) / replicate_rate
+                              for colocations, group_sizes in zip(replicate_colocations, replicate_group_sizes)])
+    variance = (n_replicates - 1) / n_replicates * ((replicate_cci - replicate_cci.mean(axis=0)) ** 2).sum(axis=0)
+    return np.sqrt((1 - sample_rate) * variance)
+
+
+def add_arguments(parser):
+    parser.add_argument('--start_date', required=True)
+    parser.add_argument('--end_date', required=True)
+    parser.add_argument('--data_filepath', required=True)
+    parser.add_argument('--outputs_filepath', required=True)
+    parser.add_argument('--homes_month', default=None,
+                        help='yyyy-mm of the homes of residents. Defaults to the month of start_date.')
+    parser.add_argument('--presence_store', default=None,
+                        help='/path/to/presence.store. Defaults to data_filepath/presence/YEAR/presence.store/')
+    parser.add_argument('--nationality_groups', default=None,
+                        help='group tourists by "country", or by the groups of a /path/to/groups.json '
+                             '(see andorra_mobility/nationality.py). Defaults to one group of tourists.')
+    parser.add_argument('--resolution', type=int, default=DEFAULT_RESOLUTION)
+    parser.add_argument('--interval_length_minutes', type=int, default=DEFAULT_INTERVAL_LENGTH_MINUTES)
+    parser.add_argument('--cell_radius', type=int, default=0)
+    parser.add_argument('--cell_weights', default=None,
+                        help='/path/to/cell_weights.json of {h3 cell id: weight}, e.g. h3_res11_builtup.json')
+    parser.add_argument('--cell_weighting', choices=CELL_WEIGHTINGS, default=INDOOR,
+                        help='indoor: count the colocations in cells of weight %s (as pre_lockdown_mobility.ipynb), '
+                             'fraction: weight colocations by the cell weights' % INDOOR_THRESHOLD)
+    add_sampling_args(parser)
+    parser.add_argument('--n_buckets', type=int, default=DEFAULT_N_BUCKETS,
+                        help='number of jackknife replicates for the standard errors of sampled runs')
+    return parser
+
+
+def main(args, instrumentation):
+    datetimes = get_datetimes(args.start_date, args.end_date)
+    start_date = datetimes[0]
+    print('--- get cross crowding index ---')
+    print('datetimes: %s - %s' % (datetimes[0], datetimes[-1]))
+    sample_rate = set_sample_rate(args.sample_rate)
+    homes_month = (start_date if args.homes_month is None
+                   else datetime.strptime(args.homes_month, month_fmt))
+    homes_df = read_csv(find_input(get_homes_filepath, args.data_filepath, sample_rate,
+                                   homes_month.year, homes_month.month),
+                        usecols=[IMSI, PARISH])
+    presence_store = PresenceStore.open(args.presence_store or find_input(
+        get_presence_store_filepath, args.data_filepath, sample_rate, start_date.year))
+    mcc_grouping = get_mcc_grouping(args.nationality_groups)
+    groups = PARISHES + ([TOURISTS] if mcc_grouping is None else list(mcc_grouping.names))
+    user_groups = get_parish_tourist_groups(homes_df, presence_store, mcc_grouping)
+    cell_weights = None if args.cell_weights is None else json.load(open(args.cell_weights))
+    if cell_weights is not None and args.cell_weighting == INDOOR:
+        cell_weights = get_indoor_weights(cell_weights)
+    with instrumentation.stage('read stays', rows_in=len(datetimes)) as stage_record:
+        stays_df = read_stays_df(args.data_filepath, datetimes)
+        stage_record.rows_out = len(stays_df)
+    if sample_rate < 1:
+        colocations, group_sizes, replicate_colocations, replicate_group_sizes = get_colocation_replicates(
+            stays_df, user_groups, groups, args.n_buckets, args.resolution, args.interval_length_minutes,
+            args.cell_radius, cell_weights, instrumentation)
+    else:
+        colocations, group_sizes = get_colocation_matrices(
+            stays_df, user_groups, groups, args.resolution, args.interval_length_minutes, args.cell_radius,
+            cell_weights, instrumentation)
+    cci_df = get_cci_df(colocations, group_sizes, groups, sample_rate)
+    cci_filepath = '%s%s/cci%s.csv' % (args.outputs_filepath, start_date.year, get_sample_suffix(sample_rate))
+    print('saving CCI to %s' % cci_filepath)
+    cci_df.to_csv(cci_filepath, index=True, index_label='group')
+    if sample_rate < 1:
+        cci_se_df = pd.DataFrame(get_cci_standard_errors(replicate_colocations, replicate_group_sizes, sample_rate),
+                                 index=groups, columns=groups)
+        cci_se_filepath = '%s%s/cci%s_se.csv' % (args.outputs_filepath, start_date.year, get_sample_suffix(sample_rate))
+        print('saving CCI standard errors to %s' % cci_se_filepath)
+        cci_se_df.to_csv(cci_se_filepath, index=True, index_label='group')
+    print('saved')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Computes the Cross Crowding Index between the residents of each parish and tourists.')
+    add_arguments(parser)
+    add_instrumentation_args(parser)
+    args = parser.parse_args()
+    instrumentation = Instrumentation.from_args('cross crowding', args)
+    main(args, instrumentation)
+    instrumentation.print_summary()
@@ -0,0 +1,261 @@
+"""
+H3 built-up fraction
+-------------
+Computes the fraction of each H3 cell in Andorra which is built-up, from the GHSL
+built-up raster, as building_areas.ipynb does for resolution 11 (outputs/h3_res11_builtup.json),
+for any resolution.
+
+Each cell of the parishes (h3.polyfill) is sampled at the centroids of its children
+(sample_levels=1, as in building_areas.ipynb) or of its descendants sample_levels resolutions
+finer, and its built-up fraction is the fraction of samples on built-up pixels.
+Rather than reading the raster once per child:
+- the children of all cells are computed at once from the bits of the H3 indexes
+- the centroids of all children are mapped to raster rows and columns with one
+  inverse affine transform (as rasterio's dataset.index, with floor)
+- the built-up samples of each cell are counted with one bincount
+Samples outside the raster are not built-up.
+
+Results are cached per resolution as compressed numpy archives, h3_res{R}_builtup.npz
+(h3_res{R}_builtup_{L}_levels.npz for sample_levels L other than 1):
+    cells: uint64 H3 indexes, sorted
+    n_built, n_samples: built-up samples and samples of each cell
+so that analyses sweeping resolutions (e.g. cross_crowding.py with cell_weights, or
+h3_cell_robustness.ipynb) read them without the raster.
+
+Example usage:
+
+    builtup = get_builtup(11, cache_filepath='../outputs/h3_builtup/')   # cell id -> fraction
+    cell_weights = builtup.to_dict()  # as json.load(open('../outputs/h3_res11_builtup.json'))
+
+
+Usage:
+python h3_builtup.py \
+    --resolutions=INT,INT,... \
+    --cache_filepath=PATH \
+    [--raster_filepath=PATH] \
+    [--parishes_filepath=PATH] \
+    [--sample_levels=INT] \
+    [--json_filepath=PATH]
+
+Example usage:
+python h3_builtup.py \
+    --resolutions=9,10,11,12 \
+    --cache_filepath=../outputs/h3_builtup/ \
+    --json_filepath=../outputs/h3_res11_builtup.json
+
+Requires rasterio to read the raster (not to read cached results).
+
+
+Saves to
+cache_filepath/h3_res{R}_builtup.npz for each resolution R
+(h3_res{R}_builtup_{L}_levels.npz with --sample_levels=L other than 1)
+and optionally, for the first resolution, json_filepath:
+-------------
+{h3 cell id: built-up fraction}
+
+"""
+import json
+from pathlib import Path
+
+import h3
+from h3.api import basic_int as h3_int
+import numpy as np
+import pandas as pd
+
+RASTER_FILEPATH = Path(__file__).resolve().parents[1] / 'data/public/GHSL/5136_OTSU_projected_to_wgs84.tif'
+PARISHES_FILEPATH = Path(__file__).resolve().parents[1] / 'data/public/shapefiles/andorra_parish.geojson'
+
+DEFAULT_RESOLUTIONS = [9, 10, 11, 12]
+DEFAULT_SAMPLE_LEVELS = 1
+
+# H3 index layout: 4 resolution bits at 52, then a 3 bit digit per resolution
+RESOLUTION_OFFSET = 52
+MAX_RESOLUTION = 15
+DIGIT_BITS = 3
+N_CHILDREN = 7
+BASE_CELL_OFFSET = 45
+# the children of pentagons do not include the K axis digit
+K_AXES_DIGIT = 1
+PENTAGON_BASE_CELLS = [4, 14, 24, 38, 49, 58, 63, 72, 83, 97, 107, 117]
+
+
+def get_builtup_cache_filepath(cache_filepath, resolution, sample_levels=DEFAULT_SAMPLE_LEVELS):
+    return '%sh3_res%s_builtup%s.npz' % (
+        cache_filepath, resolution, ('_%s_levels' % sample_levels if sample_levels != DEFAULT_SAMPLE_LEVELS else ''))
+
+
+def read_raster(raster_filepath=RASTER_FILEPATH):
+    """
+    Returns (channel, transform): the first band of the raster and its affine transform
+    (a, b, c, d, e, f), mapping (col, row) to (lon, lat).
+    """
+    import rasterio
+
+    with rasterio.open(raster_filepath) as bld_raster:
+        return bld_raster.read(1), tuple(bld_raster.transform)[:6]
+
+
+def get_flipped_geo_for_h3(coords):
+    return {'type': 'Polygon', 'coordinates': [[[coord[1], coord[0]] for coord in coords]]}
+
+
+def get_parish_cells(parishes, resolution):
+    """
+    Returns the sorted uint64 indexes of the cells of the parishes (geojson) at resolution.
+    """
+    cells = set()
+    for p_feat in parishes['features']:
+        for poly in p_feat['geometry']['coordinates']:
+            cells.update(h3_int.polyfill(get_flipped_geo_for_h3(poly), res=resolution))
+    return np.sort(np.array(list(cells), dtype=np.uint64))
+
+
+def get_digit_offset(resolution):
+    return np.uint64((MAX_RESOLUTION - resolution) * DIGIT_BITS)
+
+
+def is_pentagon(cells, resolution):
+    """
+    Returns whether each cell is a pentagon: a pentagon base cell with only 0 digits.
+    """
+    base_cells = (cells >> np.uint64(BASE_CELL_OFFSET)) & np.uint64(0x7F)
+    digits = (cells >> get_digit_offset(resolution)) & ((np.uint64(1) << np.uint64(resolution * DIGIT_BITS)) - np.uint64(1))
+    return np.isin(base_cells, PENTAGON_BASE_CELLS) & (digits == 0)
+
+
+def get_children(cells, resolution):
+    """
+    Returns (children, parents): the uint64 indexes of the children of cells (at resolution)
+    and the position in cells of the parent of each child.
+    """
+    cells = np.asarray(cells, dtype=np.uint64)
+    child_resolution = resolution + 1
+    base = cells & ~(np.uint64(0xF) << np.uint64(RESOLUTION_OFFSET))
+    base |= np.uint64(child_resolution) << np.uint64(RESOLUTION_OFFSET)
+    # unused digits are 7: clear the child's digit and set it to 0-6
+    base &= ~(np.uint64(7) << get_digit_offset(child_resolution))
+    digits = np.arange(N_CHILDREN, dtype=np.uint64) << get_digit_offset(child_resolution)
+    children = (base[:, None] | digits[None, :]).ravel()
+    parents = np.repeat(np.arange(len(cells)), N_CHILDREN)
+    pentagons = is_pentagon(cells, resolution)
+    if pentagons.any():
+        keep = ~(np.repeat(pentagons, N_CHILDREN) & np.tile(np.arange(N_CHILDREN) == K_AXES_DIGIT, len(cells)))
+        children, parents = children[keep], parents[keep]
+    return children, parents
+
+
+def get_descendants(cells, resolution, levels):
+    """
+    Returns (descendants, parents): the uint64 indexes of the descendants of cells
+    levels resolutions finer, and the position in cells of the ancestor of each.
+    """
+    descendants, parents = np.asarray(cells, dtype=np.uint64), np.arange(len(cells))
+    for level in range(levels):
+        descendants, level_parents = get_children(descendants, resolution + level)
+        parents = parents[level_parents]
+    return descendants, parents
+
+
+def get_centroids(cells):
+    """
+    Returns (lats, lons) of the centroids of cells (uint64 indexes)
+    """
+    centroids = np.array([h3_int.h3_to_geo(c) for c in cells.tolist()], dtype=np.float64).reshape(-1, 2)
+    return centroids[:, 0], centroids[:, 1]
+
+
+def get_raster_indices(lons, lats, transform):
+    """
+    Returns (rows, cols) of the pixels containing the points, by inverting the affine transform
+    (a, b, c, d, e, f): lon = a * col + b * row + c, lat = d * col + e * row + f
+    """
+    a, b, c, d, e, f = transform
+    det = a * e - b * d
+    x, y = np.asarray(lons) - c, np.asarray(lats) - f
+    cols = np.floor((e * x - b * y) / det).astype(np.int64)
+    rows = np.floor((a * y - d * x) / det).astype(np.int64)
+    return rows, cols
+
+
+def get_builtup_counts(cells, resolution, channel, transform, sample_levels=DEFAULT_SAMPLE_LEVELS):
+    """
+    Returns (n_built, n_samples) of each cell: the number of its descendants
+    sample_levels resolutions finer whose centroid is on a built-up pixel, and of descendants.
+    """
+    samples, parents = get_descendants(cells, resolution, sample_levels)
+    lats, lons = get_centroids(samples)
+    rows, cols = get_raster_indices(lons, lats, transform)
+    inside = (rows >= 0) & (rows < channel.shape[0]) & (cols >= 0) & (cols < channel.shape[1])
+    built = np.zeros(len(samples), dtype=np.int64)
+    built[inside] = channel[rows[inside], cols[inside]] > 0
+    n_built = np.bincount(parents, weights=built, minlength=len(cells)).astype(np.uint32)
+    n_samples = np.bincount(parents, minlength=len(cells)).astype(np.uint32)
+    return n_built, n_samples
+
+
+def save_builtup(filepath, cells, n_built, n_samples):
+    Path(filepath).parent.mkdir(parents=True, exist_ok=True)
+    np.savez_compressed(filepath, cells=cells, n_built=n_built, n_samples=n_samples)
+
+
+def read_builtup(filepath):
+    """
+    Returns a series of the built-up fraction of each cell, indexed by h3 cell id.
+    """
+    with np.load(filepath) as f:
+        cells, n_built, n_samples = f['cells'], f['n_built'], f['n_samples']
+    return pd.Series(n_built / n_samples, index=[h3.h3_to_string(c) for c in cells.tolist()])
+
+
+def compute_builtup(resolution, channel, transform, parishes, sample_levels=DEFAULT_SAMPLE_LEVELS):
+    """
+    Returns (cells, n_built, n_samples) for the cells of the parishes at resolution.
+    """
+    cells = get_parish_cells(parishes, resolution)
+    n_built, n_samples = get_builtup_counts(cells, resolution, channel, transform, sample_levels)
+    return cells, n_built, n_samples
+
+
+def get_builtup(resolution, cache_filepath, raster_filepath=RASTER_FILEPATH,
+                parishes_filepath=PARISHES_FILEPATH, sample_levels=DEFAULT_SAMPLE_LEVELS):
+    """
+    Returns a series of the built-up fraction of each cell at resolution, indexed by h3 cell id,
+    from the cache if it exists, else computed from the raster and cached.
+    """
+    filepath = get_builtup_cache_filepath(cache_filepath, resolution, sample_levels)
+    if not Path(filepath).is_file():
+        channel, transform = read_raster(raster_filepath)
+        parishes = json.load(open(parishes_filepath))
+        save_builtup(filepath, *compute_builtup(resolution, channel, transform, parishes, sample_levels))
+    return read_builtup(filepath)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Computes the built-up fraction of the H3 cells of Andorra at several resolutions.')
+    parser.add_argument('--resolutions', default=','.join(str(r) for r in DEFAULT_RESOLUTIONS))
+    parser.add_argument('--cache_filepath', required=True, help='/path/to/h3_builtup/')
+    parser.add_argument('--raster_filepath', default=RASTER_FILEPATH)
+    parser.add_argument('--parishes_filepath', default=PARISHES_FILEPATH)
+    parser.add_argument('--sample_levels', type=int, default=DEFAULT_SAMPLE_LEVELS,
+                        help='sample each cell at its descendants this many resolutions finer')
+    parser.add_argument('--json_filepath', default=None,
+                        help='also save the first resolution as {cell id: fraction} json')
+    args = parser.parse_args()
+
+    resolutions = [int(r) for r in args.resolutions.split(',')]
+    channel, transform = read_raster(args.raster_filepath)
+    parishes = json.load(open(args.parishes_filepath))
+    for resolution in resolutions:
+        filepath = get_builtup_cache_filepath(args.cache_filepath, resolution, args.sample_levels)
+        cells, n_built, n_samples = compute_builtup(resolution, channel, transform, parishes, args.sample_levels)
+        print('resolution %s: %s cells, mean built-up fraction %.4f' % (
+            resolution, len(cells), (n_built / n_samples).mean()))
+        save_builtup(filepath, cells, n_built, n_samples)
+        print('saved to %s' % filepath)
+    if args.json_filepath is not None:
+        builtup = read_builtup(get_builtup_cache_filepath(args.cache_filepath, resolutions[0], args.sample_levels))
+        print('saving resolution %s to %s' % (resolutions[0], args.json_filepath))
+        json.dump(builtup.to_dict(), open(args.json_filepath, 'w'))
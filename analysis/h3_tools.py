@@ -1,6 +1,7 @@
 import h3
 from collections import Counter
-import datetime
+
+from andorra_mobility.instrumentation import Instrumentation
 
 def get_h3_cells_by_interval(resolution, intervals, T, persons):
     # iterate through all stays and get the interval and the h3 cell
@@ -32,14 +33,18 @@ def count_interactions_kring_one_interval(cell_ids_this_interval, cell_radius):
         interactions_by_cell_this_interval.append([cell_id,int(n_interactions_this_cell)])
     return n_interactions_this_interval, interactions_by_cell_this_interval
 
-def count_interactions_kring_all_intervals(cell_radius, stay_ind_by_interval, cell_ids_by_stay_ind):
-    then=datetime.datetime.now()
+def count_interactions_kring_all_intervals(cell_radius, stay_ind_by_interval, cell_ids_by_stay_ind,
+                                           instrumentation=None, day=None):
+    if instrumentation is None:
+        instrumentation = Instrumentation('h3_tools')
     n_interactions_all_intervals=[]
     interactions_by_interval_and_cell=[]
-    for s_ind_this_interval in stay_ind_by_interval:
-        cell_ids_this_interval=[cell_ids_by_stay_ind[s_ind] for s_ind in s_ind_this_interval]
-        n_interactions_this_interval, interactions_by_cell_this_interval = count_interactions_kring_one_interval(cell_ids_this_interval, cell_radius)
-        n_interactions_all_intervals.append(n_interactions_this_interval)
-        interactions_by_interval_and_cell.append(interactions_by_cell_this_interval)
-    print(datetime.datetime.now()-then)
+    with instrumentation.stage('count interactions', day=day,
+                               rows_in=sum(len(s) for s in stay_ind_by_interval)) as stage_record:
+        for s_ind_this_interval in stay_ind_by_interval:
+            cell_ids_this_interval=[cell_ids_by_stay_ind[s_ind] for s_ind in s_ind_this_interval]
+            n_interactions_this_interval, interactions_by_cell_this_interval = count_interactions_kring_one_interval(cell_ids_this_interval, cell_radius)
+            n_interactions_all_intervals.append(n_interactions_this_interval)
+            interactions_by_interval_and_cell.append(interactions_by_cell_this_interval)
+        stage_record.rows_out = len(n_interactions_all_intervals)
     return n_interactions_all_intervals, interactions_by_interval_and_cell
@@ -0,0 +1,301 @@
+"""
+Lagged correlations
+-------------
+Correlates every mobility metric of outputs/metrics/YEAR/all_metrics.csv with case
+growth over the susceptible population (LCG in outputs/owid-covid-data-modified-14d-window-presence.csv),
+for every combination of metric, lag and smoothing window, as in
+outputs/mobility_lcg_correlations.csv (one lag and one window at a time).
+
+The metrics are loaded as one (dates x metrics) matrix aligned with the case growth.
+For a smoothing window of w days, each metric is replaced by its trailing w-day mean
+(missing unless all w days are present), computed from cumulative sums.
+For a lag of l days, the metric on day t - l is paired with the case growth on day t,
+so positive lags are mobility preceding case growth.
+All (window, lag, metric) series are stacked into one (dates x combinations) matrix,
+and the Pearson correlations over the dates where both series are present are computed
+from weighted sums of x, y, x^2, y^2 and xy, with a single matrix product for all combinations.
+
+Confidence intervals are computed with a moving block bootstrap over dates (blocks of
+block_length consecutive days, to keep the autocorrelation of the series). A bootstrap
+sample only changes how many times each date is counted, so a batch of samples is a
+(samples x dates) weight matrix, and the correlations of every combination for the whole
+batch are again one matrix product. Batches are computed on a pool of n_workers processes,
+with a random seed per batch so that the results do not depend on n_workers.
+
+Example usage:
+
+    metrics_df = read_metrics_df('../outputs/metrics/2020/all_metrics.csv')
+    case_growth = read_case_growth('../outputs/owid-covid-data-modified-14d-window-presence.csv')
+    sweep_df = get_correlation_sweep(metrics_df, case_growth, lags=range(-30, 31),
+                                     windows=[1, 7, 14], n_bootstrap=1000, n_workers=8)
+    get_lag_table(sweep_df, window=7)  # lag x metric, as outputs/mobility_lcg_correlations.csv
+
+
+Usage:
+python lagged_correlations.py \
+    --metrics_filepath=PATH \
+    --cases_filepath=PATH \
+    --outputs_filepath=PATH \
+    [--target=COLUMN] \
+    [--min_lag=INT] \
+    [--max_lag=INT] \
+    [--windows=INT,INT,...] \
+    [--n_bootstrap=INT] \
+    [--block_length=INT] \
+    [--n_workers=INT]
+
+Example usage:
+python lagged_correlations.py \
+    --metrics_filepath=../outputs/metrics/2020/all_metrics.csv \
+    --cases_filepath=../outputs/owid-covid-data-modified-14d-window-presence.csv \
+    --outputs_filepath=../outputs/lagged_correlations.csv \
+    --windows=1,3,7,14 \
+    --n_bootstrap=1000
+
+
+Saves the sweep to
+outputs_filepath:
+-------------
+metric, window, lag, r, n, ci_low, ci_high
+n is the number of dates where both series are present
+
+"""
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+DATE = 'date'
+METRIC = 'metric'
+WINDOW = 'window'
+LAG = 'lag'
+R = 'r'
+N = 'n'
+CI_LOW = 'ci_low'
+CI_HIGH = 'ci_high'
+
+# case growth over the susceptible population
+LCG = 'LCG'
+
+DEFAULT_LAGS = range(-30, 31)
+DEFAULT_WINDOWS = [1]
+DEFAULT_MIN_PERIODS = 10
+DEFAULT_BLOCK_LENGTH = 7
+DEFAULT_CI = 0.95
+BOOTSTRAP_BATCH_SIZE = 100
+
+# number of weighted sums per combination: n, x, y, x^2, y^2, xy
+N_SUMS = 6
+
+
+def read_metrics_df(metrics_filepath):
+    """
+    Returns the numeric metrics of all_metrics.csv, indexed by date.
+    """
+    metrics_df = pd.read_csv(metrics_filepath, index_col=DATE, parse_dates=True)
+    return metrics_df.select_dtypes('number')
+
+
+def read_case_growth(cases_filepath, column=LCG):
+    """
+    Returns the case growth series, indexed by date. Infinite values (from days
+    without cases) are missing.
+    """
+    cases_df = pd.read_csv(cases_filepath, index_col=DATE, parse_dates=True)
+    return cases_df[column].replace([np.inf, -np.inf], np.nan)
+
+
+def align(metrics_df, target):
+    """
+    Returns (dates, X, y) on the daily dates spanning both metrics_df and target:
+    X (dates x metrics), y (dates), with NaN for missing values.
+    """
+    dates = pd.date_range(min(metrics_df.index.min(), target.index.min()),
+                          max(metrics_df.index.max(), target.index.max()), freq='D')
+    X = metrics_df.reindex(dates).values.astype(np.float64)
+    y = target.reindex(dates).values.astype(np.float64)
+    return dates, X, y
+
+
+def standardize(X):
+    """
+    Centers and scales each column, ignoring missing values, so that the sums of squares
+    are computed without loss of precision. Correlations are unchanged.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.nanstd(X, axis=0)
+        return (X - np.nanmean(X, axis=0)) / np.where(std > 0, std, 1)
+
+
+def get_smoothed(X, windows):
+    """
+    Returns the trailing means of the columns of X (dates x metrics) over each window,
+    (windows x dates x metrics), missing unless all the days of the window are present.
+    """
+    valid = ~np.isnan(X)
+    values = np.vstack([np.zeros((1, X.shape[1])), np.cumsum(np.where(valid, X, 0), axis=0)])
+    counts = np.vstack([np.zeros((1, X.shape[1]), dtype=np.int64), np.cumsum(valid, axis=0)])
+    smoothed = np.full((len(windows),) + X.shape, np.nan)
+    for k, w in enumerate(windows):
+        if w > X.shape[0]:
+            continue
+        window_sums = values[w:] - values[:-w]
+        window_counts = counts[w:] - counts[:-w]
+        smoothed[k, w - 1:] = np.where(window_counts == w, window_sums / w, np.nan)
+    return smoothed
+
+
+def get_lagged(X_smoothed, lags):
+    """
+    Returns X_smoothed (windows x dates x metrics) lagged by each lag,
+    (windows x lags x dates x metrics), with the value of date t - lag at date t.
+    """
+    n_windows, n_dates, n_metrics = X_smoothed.shape
+    max_shift = max(abs(lag) for lag in lags)
+    padded = np.full((n_windows, n_dates + 2 * max_shift, n_metrics), np.nan)
+    padded[:, max_shift:max_shift + n_dates] = X_smoothed
+    starts = max_shift - np.asarray(lags)
+    # for each lag, a view of the dates shifted by lag
+    windows = np.lib.stride_tricks.sliding_window_view(padded, n_dates, axis=1)
+    return windows[:, starts].transpose(0, 1, 3, 2)
+
+
+def get_design(X_lagged, y):
+    """
+    Returns the (dates x N_SUMS * combinations) matrix whose weighted column sums are
+    the sums n, x, y, x^2, y^2, xy of each combination over the dates where both are present.
+    """
+    n_dates = X_lagged.shape[2]
+    x = X_lagged.transpose(2, 0, 1, 3).reshape(n_dates, -1)
+    both = ~np.isnan(x) & ~np.isnan(y)[:, None]
+    x = np.where(both, x, 0)
+    y = np.where(both, np.nan_to_num(y)[:, None], 0)
+    return np.hstack([both.astype(np.float64), x, y, x * x, y * y, x * y])
+
+
+def get_correlations(weights, design, min_periods=DEFAULT_MIN_PERIODS):
+    """
+    Returns (r, n) for each row of weights (samples x dates): the weighted Pearson
+    correlation and the weighted number of dates of each combination (samples x combinations).
+    """
+    sums = (weights @ design).reshape(len(weights), N_SUMS, -1)
+    n, sx, sy, sxx, syy, sxy = [sums[:, i] for i in range(N_SUMS)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = (n * sxy - sx * sy) / np.sqrt((n * sxx - sx * sx) * (n * syy - sy * sy))
+    r[n < min_periods] = np.nan
+    return np.clip(r, -1, 1), n
+
+
+def get_block_bootstrap_weights(n_dates, n_samples, block_length, rng):
+    """
+    Returns (samples x dates) weights: the number of times each date is drawn in
+    each moving block bootstrap sample.
+    """
+    block_length = min(block_length, n_dates)
+    n_blocks = int(np.ceil(n_dates / block_length))
+    starts = rng.integers(0, n_dates - block_length + 1, size=(n_samples, n_blocks))
+    indices = (starts[:, :, None] + np.arange(block_length)).reshape(n_samples, -1)[:, :n_dates]
+    offsets = np.arange(n_samples)[:, None] * n_dates
+    return np.bincount((indices + offsets).ravel(), minlength=n_samples * n_dates).reshape(
+        n_samples, n_dates).astype(np.float64)
+
+
+# the design matrix of the sweep, set in each worker process
+_design = None
+
+def _init_worker(design):
+    global _design
+    _design = design
+
+
+def _bootstrap_batch(args):
+    seed, n_samples, block_length, min_periods = args
+    rng = np.random.default_rng(seed)
+    weights = get_block_bootstrap_weights(_design.shape[0], n_samples, block_length, rng)
+    return get_correlations(weights, _design, min_periods)[0]
+
+
+def bootstrap_correlations(design, n_bootstrap, block_length=DEFAULT_BLOCK_LENGTH,
+                           min_periods=DEFAULT_MIN_PERIODS, n_workers=1, seed=0):
+    """
+    Returns the (n_bootstrap x combinations) bootstrap correlations, computed in batches
+    of BOOTSTRAP_BATCH_SIZE samples on n_workers processes.
+    """
+    batch_sizes = [BOOTSTRAP_BATCH_SIZE] * (n_bootstrap // BOOTSTRAP_BATCH_SIZE)
+    if n_bootstrap % BOOTSTRAP_BATCH_SIZE:
+        batch_sizes.append(n_bootstrap % BOOTSTRAP_BATCH_SIZE)
+    seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+    batches = [(s, size, block_length, min_periods) for s, size in zip(seeds, batch_sizes)]
+    if n_workers > 1:
+        with multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(design,)) as pool:
+            results = pool.map(_bootstrap_batch, batches)
+    else:
+        _init_worker(design)
+        results = [_bootstrap_batch(batch) for batch in batches]
+    return np.vstack(results)
+
+
+def get_correlation_sweep(metrics_df, target, lags=DEFAULT_LAGS, windows=DEFAULT_WINDOWS,
+                          n_bootstrap=0, block_length=DEFAULT_BLOCK_LENGTH, ci=DEFAULT_CI,
+                          min_periods=DEFAULT_MIN_PERIODS, n_workers=1, seed=0):
+    """
+    Returns a dataframe of the correlation of each metric (column of metrics_df) with target
+    for every window and lag: metric, window, lag, r, n, and ci_low, ci_high if n_bootstrap > 0.
+    """
+    lags, windows = list(lags), list(windows)
+    dates, X, y = align(metrics_df, target)
+    X_lagged = get_lagged(get_smoothed(standardize(X), windows), lags)
+    design = get_design(X_lagged, standardize(y[:, None])[:, 0])
+    r, n = get_correlations(np.ones((1, len(dates))), design, min_periods)
+    index = pd.MultiIndex.from_product([windows, lags, metrics_df.columns], names=[WINDOW, LAG, METRIC])
+    sweep_df = pd.DataFrame({R: r[0], N: n[0].astype(np.int64)}, index=index)
+    if n_bootstrap > 0:
+        r_bootstrap = bootstrap_correlations(design, n_bootstrap, block_length, min_periods, n_workers, seed)
+        with np.errstate(invalid='ignore'):
+            sweep_df[CI_LOW] = np.nanquantile(r_bootstrap, (1 - ci) / 2, axis=0)
+            sweep_df[CI_HIGH] = np.nanquantile(r_bootstrap, 1 - (1 - ci) / 2, axis=0)
+    return sweep_df.reorder_levels([METRIC, WINDOW, LAG]).sort_index().reset_index()
+
+
+def get_lag_table(sweep_df, window=1, value=R):
+    """
+    Returns a (lag x metric) table of one window's correlations (or confidence bounds),
+    as outputs/mobility_lcg_correlations.csv
+    """
+    window_df = sweep_df[sweep_df[WINDOW] == window]
+    return window_df.pivot(index=LAG, columns=METRIC, values=value)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Correlates mobility metrics with case growth for every lag and smoothing window.')
+    parser.add_argument('--metrics_filepath', required=True, help='/path/to/all_metrics.csv')
+    parser.add_argument('--cases_filepath', required=True,
+                        help='/path/to/owid-covid-data-modified-14d-window-presence.csv')
+    parser.add_argument('--outputs_filepath', required=True, help='/path/to/lagged_correlations.csv')
+    parser.add_argument('--target', default=LCG, help='case growth column of the cases file')
+    parser.add_argument('--min_lag', type=int, default=min(DEFAULT_LAGS))
+    parser.add_argument('--max_lag', type=int, default=max(DEFAULT_LAGS))
+    parser.add_argument('--windows', default=','.join(str(w) for w in DEFAULT_WINDOWS),
+                        help='comma separated smoothing windows, in days')
+    parser.add_argument('--n_bootstrap', type=int, default=0)
+    parser.add_argument('--block_length', type=int, default=DEFAULT_BLOCK_LENGTH)
+    parser.add_argument('--ci', type=float, default=DEFAULT_CI)
+    parser.add_argument('--min_periods', type=int, default=DEFAULT_MIN_PERIODS)
+    parser.add_argument('--n_workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    metrics_df = read_metrics_df(args.metrics_filepath)
+    case_growth = read_case_growth(args.cases_filepath, args.target)
+    windows = [int(w) for w in args.windows.split(',')]
+    lags = range(args.min_lag, args.max_lag + 1)
+    print('--- correlations of %s metrics with %s: %s lags, windows %s, %s bootstrap samples ---' % (
+        len(metrics_df.columns), args.target, len(lags), windows, args.n_bootstrap))
+    sweep_df = get_correlation_sweep(metrics_df, case_growth, lags, windows, args.n_bootstrap,
+                                     args.block_length, args.ci, args.min_periods, args.n_workers, args.seed)
+    print('saving correlations to %s' % args.outputs_filepath)
+    sweep_df.to_csv(args.outputs_filepath, index=False)
+    print('saved')
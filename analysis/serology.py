@@ -0,0 +1,356 @@
+"""
+Serology
+-------------
+Estimates the probability that each participant of the mass serology screening was
+infected before the first testing phase, and the infection rates by parish and by
+residency status (temporer), as serology_infer_cases_bayes.ipynb, with confidence intervals.
+
+The prior probability of infection is estimated from the proportion of positive tests
+(any antibody, IgM or IgG, in test 1) by maximum likelihood:
+    P(D) = (n^T / N - (1 - sp)) / (se + sp - 1)
+and the posterior probability of each participant by Bayes:
+    P(D|T) = se P(D) / P(T)          P(D|T') = (1 - se) P(D) / (1 - P(T))
+The posterior only depends on the test result, so it is computed with boolean masks,
+and the infection rate of a group only depends on its numbers of positive and negative tests.
+
+Confidence intervals come from replicates that resample:
+- the sensitivity and specificity, from Beta distributions of the validation of the test
+  (n_se infected and n_sp non-infected samples), if given
+- the participants (bootstrap), i.e. the numbers of participants of each
+  (parish, status, test result) cell, drawn from a multinomial
+Each replicate re-estimates the prior, the posteriors and the tables. Replicates are
+computed in batches of arrays (replicates x cells), on a pool of n_workers processes,
+with a random seed per batch so that the results do not depend on n_workers.
+The chi-square tests of independence of infection and status or parish (as in the notebook)
+are computed for every replicate as well.
+
+Example usage:
+
+    serology = read_serology('../data/private/serology_clean.csv')
+    se, sp = read_serology_accuracy('../data/private/serology_accuracy.json')
+    serology['P_D1_test_1_only'] = get_posteriors(get_any_antibody(serology), se, sp)
+    tables = get_serology_tables(serology, se, sp, n_replicates=1000, n_se=100, n_sp=100, n_workers=8)
+    tables['by_parish']  # mean, ci_low, ci_high, size of the infection rate of each parish
+
+
+Usage:
+python serology.py \
+    --serology_filepath=PATH \
+    --accuracy_filepath=PATH \
+    --outputs_filepath=PATH \
+    [--n_replicates=INT] \
+    [--n_se=INT] \
+    [--n_sp=INT] \
+    [--n_workers=INT]
+
+Example usage:
+python serology.py \
+    --serology_filepath=../data/private/serology_clean.csv \
+    --accuracy_filepath=../data/private/serology_accuracy.json \
+    --outputs_filepath=../outputs/serology/ \
+    --n_replicates=1000
+
+
+Saves to outputs_filepath:
+-------------
+test1_by_parish.csv, test1_by_status.csv, test1_by_parish_status.csv:
+    group(s), mean, ci_low, ci_high, size  (infection rate of each group)
+chi2.csv:
+    test, stat, p, dof, stat_ci_low, stat_ci_high, p_ci_low, p_ci_high
+
+"""
+import json
+import multiprocessing
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2
+
+PARISH = 'parish'
+NEW_PARISH = 'new_parish'
+STATUS = 'temporer'
+DATA_TEST_1 = 'data_test_1'
+IGM_1 = 'igm_1'
+IGG_1 = 'igg_1'
+POSITIVE = 'positiu'
+
+MEAN = 'mean'
+SIZE = 'size'
+CI_LOW = 'ci_low'
+CI_HIGH = 'ci_high'
+
+ALV_ESCALDES = 'Andorra la Vella & Escaldes-Engordany'
+SANT_JULIA = 'Sant Juliá de Lòria'
+
+# groupings of the tables: name -> grouping columns
+GROUPINGS = {
+    'by_parish': [NEW_PARISH],
+    'by_status': [STATUS],
+    'by_parish_status': [NEW_PARISH, STATUS],
+}
+# chi-square tests of independence of infection and a column, as in the notebook
+CHI2_TESTS = {
+    'status': STATUS,
+    'parish': PARISH,
+}
+
+DEFAULT_CI = 0.95
+REPLICATES_BATCH_SIZE = 100
+
+
+def read_serology(serology_filepath):
+    """
+    Returns the participants with a first test, with their new_parish.
+    """
+    serology = pd.read_csv(serology_filepath)
+    serology = serology.loc[~serology[DATA_TEST_1].isnull()].copy()
+    serology[NEW_PARISH] = get_new_parish_names(serology[PARISH])
+    return serology
+
+
+def read_serology_accuracy(accuracy_filepath):
+    """
+    returns se, sp
+    """
+    serology_accuracy = json.load(open(accuracy_filepath))
+    return serology_accuracy['se'], serology_accuracy['sp']
+
+
+def get_new_parish_names(parishes):
+    """
+    Combines Andorra la Vella and Escaldes, and fixes the parish names. Missing parishes are NaN.
+    """
+    parishes = pd.Series(parishes)
+    names = parishes.str.replace('_', ' ').str.title()
+    names[parishes.isin(['andorra_la_vella', 'escaldes_engordany'])] = ALV_ESCALDES
+    names[parishes == 'sant_julia'] = SANT_JULIA
+    return names
+
+
+def get_any_antibody(serology):
+    """
+    Returns whether each participant tested positive for any antibody in test 1
+    """
+    return ((serology[IGM_1] == POSITIVE) | (serology[IGG_1] == POSITIVE)).values
+
+
+def get_prior(prop_positive, se, sp):
+    """
+    The maximum likelihood estimate of the probability of infection, clipped to [0, 1]
+    (it is outside when the proportion of positives is not between 1 - sp and se).
+    """
+    return np.clip((prop_positive - (1 - sp)) / (se + sp - 1), 0, 1)
+
+
+def get_posterior_values(prop_positive, se, sp):
+    """
+    returns (P(D|T), P(D|T')): the posterior probability of infection of participants
+    with a positive and a negative test
+    """
+    prior = get_prior(prop_positive, se, sp)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return prior * se / prop_positive, prior * (1 - se) / (1 - prop_positive)
+
+
+def get_posteriors(positive, se, sp):
+    """
+    Returns the posterior probability of infection of each participant, given their test 1 result.
+    """
+    positive = np.asarray(positive, dtype=bool)
+    posterior_positive, posterior_negative = get_posterior_values(positive.mean(), se, sp)
+    return np.where(positive, posterior_positive, posterior_negative)
+
+
+def get_chi2(observed):
+    """
+    Returns (stat, p, dof) of the chi-square test of independence of the
+    contingency tables observed (... x rows x columns), as scipy's chi2_contingency
+    (with Yates' correction for 1 degree of freedom).
+    """
+    observed = np.asarray(observed, dtype=np.float64)
+    total = observed.sum(axis=(-2, -1), keepdims=True)
+    expected = observed.sum(axis=-1, keepdims=True) * observed.sum(axis=-2, keepdims=True) / total
+    dof = (observed.shape[-2] - 1) * (observed.shape[-1] - 1)
+    if dof == 1:
+        diff = expected - observed
+        observed = observed + np.sign(diff) * np.minimum(0.5, np.abs(diff))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stat = ((observed - expected) ** 2 / expected).sum(axis=(-2, -1))
+    return stat, chi2.sf(stat, dof), dof
+
+
+class SerologyCells:
+    """
+    The participants counted by cell: a combination of the values of the grouping
+    and chi-square columns, and of the test result. All the tables are sums over cells.
+    """
+
+    def __init__(self, serology, positive):
+        columns = sorted(set(c for cs in GROUPINGS.values() for c in cs) | set(CHI2_TESTS.values()))
+        keys = serology[columns].copy()
+        keys['positive'] = np.asarray(positive, dtype=bool)
+        # missing values are a value of their own, so that all participants are counted
+        codes = keys.groupby(list(keys.columns), dropna=False, sort=False).ngroup().values
+        self.cells = keys.assign(cell=codes).drop_duplicates('cell').sort_values('cell').reset_index(drop=True)
+        self.counts = np.bincount(codes).astype(np.float64)
+        self.positive = self.cells['positive'].values
+        # one (cells x groups) indicator matrix per grouping and chi-square test
+        self.group_matrices, self.group_names = {}, {}
+        for name, group_columns in list(GROUPINGS.items()) + [(t, [c]) for t, c in CHI2_TESTS.items()]:
+            group_keys = self.cells[group_columns]
+            valid = group_keys.notna().all(axis=1).values
+            grouped = group_keys[valid].groupby(group_columns)
+            matrix = np.zeros((len(self.cells), grouped.ngroups))
+            matrix[np.flatnonzero(valid), grouped.ngroup().values] = 1
+            self.group_matrices[name] = matrix
+            self.group_names[name] = pd.MultiIndex.from_frame(
+                group_keys[valid].drop_duplicates().sort_values(group_columns))
+
+    def get_tables(self, counts, se, sp):
+        """
+        counts (replicates x cells), se and sp (replicates)
+        returns {grouping: (infection rates, sizes)} (replicates x groups)
+        and {chi-square test: (stat, p)} (replicates)
+        """
+        n_positive = counts[:, self.positive].sum(axis=1)
+        posterior_positive, posterior_negative = get_posterior_values(n_positive / counts.sum(axis=1), se, sp)
+        infected = counts * np.where(self.positive, posterior_positive[:, None], posterior_negative[:, None])
+        tables, chi2_tests = {}, {}
+        for name in GROUPINGS:
+            sizes = counts @ self.group_matrices[name]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                tables[name] = (infected @ self.group_matrices[name] / sizes, sizes)
+        for name in CHI2_TESTS:
+            group_infected = infected @ self.group_matrices[name]
+            group_not_infected = counts @ self.group_matrices[name] - group_infected
+            stat, p, _ = get_chi2(np.stack([group_infected, group_not_infected], axis=-1))
+            chi2_tests[name] = (stat, p)
+        return tables, chi2_tests
+
+
+def draw_accuracy(value, n, size, rng):
+    """
+    Returns size draws of a sensitivity or specificity estimated as value from n
+    validation samples (Beta posterior with a uniform prior), or value if n is None.
+    """
+    if n is None:
+        return np.full(size, value)
+    return rng.beta(value * n + 1, (1 - value) * n + 1, size=size)
+
+
+# the cells of the participants, set in each worker process
+_cells = None
+
+def _init_worker(cells):
+    global _cells
+    _cells = cells
+
+
+def _replicates_batch(args):
+    seed, n_replicates, se, sp, n_se, n_sp, bootstrap_participants = args
+    rng = np.random.default_rng(seed)
+    se_replicates = draw_accuracy(se, n_se, n_replicates, rng)
+    sp_replicates = draw_accuracy(sp, n_sp, n_replicates, rng)
+    n_participants = int(_cells.counts.sum())
+    if bootstrap_participants:
+        counts = rng.multinomial(n_participants, _cells.counts / n_participants, size=n_replicates).astype(np.float64)
+    else:
+        counts = np.tile(_cells.counts, (n_replicates, 1))
+    return _cells.get_tables(counts, se_replicates, sp_replicates)
+
+
+def get_replicates(cells, se, sp, n_replicates, n_se=None, n_sp=None, bootstrap_participants=True,
+                   n_workers=1, seed=0):
+    """
+    Returns the tables of n_replicates replicates, concatenated over batches of
+    REPLICATES_BATCH_SIZE replicates computed on n_workers processes.
+    """
+    batch_sizes = [REPLICATES_BATCH_SIZE] * (n_replicates // REPLICATES_BATCH_SIZE)
+    if n_replicates % REPLICATES_BATCH_SIZE:
+        batch_sizes.append(n_replicates % REPLICATES_BATCH_SIZE)
+    seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+    batches = [(s, size, se, sp, n_se, n_sp, bootstrap_participants) for s, size in zip(seeds, batch_sizes)]
+    if n_workers > 1:
+        with multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(cells,)) as pool:
+            results = pool.map(_replicates_batch, batches)
+    else:
+        _init_worker(cells)
+        results = [_replicates_batch(batch) for batch in batches]
+    tables = {name: tuple(np.vstack([r[0][name][i] for r in results]) for i in range(2)) for name in GROUPINGS}
+    chi2_tests = {name: tuple(np.concatenate([r[1][name][i] for r in results]) for i in range(2))
+                  for name in CHI2_TESTS}
+    return tables, chi2_tests
+
+
+def get_serology_tables(serology, se, sp, n_replicates=0, n_se=None, n_sp=None, bootstrap_participants=True,
+                        ci=DEFAULT_CI, n_workers=1, seed=0):
+    """
+    Returns a dict of dataframes:
+        by_parish, by_status, by_parish_status: mean infection rate and size of each group,
+            with ci_low, ci_high if n_replicates > 0
+        chi2: stat, p, dof of the chi-square tests of infection by status and by parish,
+            with the confidence intervals of stat and p if n_replicates > 0
+    """
+    cells = SerologyCells(serology, get_any_antibody(serology))
+    tables, chi2_tests = cells.get_tables(cells.counts[None, :], np.array([se]), np.array([sp]))
+    if n_replicates > 0:
+        replicate_tables, replicate_chi2_tests = get_replicates(
+            cells, se, sp, n_replicates, n_se, n_sp, bootstrap_participants, n_workers, seed)
+    quantiles = [(1 - ci) / 2, 1 - (1 - ci) / 2]
+    dfs = {}
+    for name, group_columns in GROUPINGS.items():
+        rates, sizes = tables[name]
+        df = pd.DataFrame({MEAN: rates[0], SIZE: sizes[0].astype(np.int64)},
+                          index=cells.group_names[name])
+        if n_replicates > 0:
+            df[CI_LOW], df[CI_HIGH] = np.nanquantile(replicate_tables[name][0], quantiles, axis=0)
+        dfs[name] = df[[MEAN] + ([CI_LOW, CI_HIGH] if n_replicates > 0 else []) + [SIZE]].reset_index()
+    chi2_rows = []
+    for name in CHI2_TESTS:
+        stat, p = chi2_tests[name]
+        row = {'test': name, 'stat': stat[0], 'p': p[0],
+               'dof': len(cells.group_names[name]) - 1}
+        if n_replicates > 0:
+            row['stat_ci_low'], row['stat_ci_high'] = np.nanquantile(replicate_chi2_tests[name][0], quantiles)
+            row['p_ci_low'], row['p_ci_high'] = np.nanquantile(replicate_chi2_tests[name][1], quantiles)
+        chi2_rows.append(row)
+    dfs['chi2'] = pd.DataFrame(chi2_rows)
+    return dfs
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Estimates infection rates by parish and status from the serology tests, '
+                    'with confidence intervals.')
+    parser.add_argument('--serology_filepath', required=True, help='/path/to/serology_clean.csv')
+    parser.add_argument('--accuracy_filepath', required=True, help='/path/to/serology_accuracy.json')
+    parser.add_argument('--outputs_filepath', required=True)
+    parser.add_argument('--n_replicates', type=int, default=1000)
+    parser.add_argument('--n_se', type=int, default=None,
+                        help='number of infected validation samples of the sensitivity. '
+                             'Defaults to a fixed sensitivity.')
+    parser.add_argument('--n_sp', type=int, default=None,
+                        help='number of non-infected validation samples of the specificity. '
+                             'Defaults to a fixed specificity.')
+    parser.add_argument('--no_bootstrap', action='store_true',
+                        help='only resample the sensitivity and specificity, not the participants')
+    parser.add_argument('--ci', type=float, default=DEFAULT_CI)
+    parser.add_argument('--n_workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    serology = read_serology(args.serology_filepath)
+    se, sp = read_serology_accuracy(args.accuracy_filepath)
+    print('--- serology infection rates: %s participants, se=%s, sp=%s, %s replicates ---' % (
+        len(serology), se, sp, args.n_replicates))
+    dfs = get_serology_tables(serology, se, sp, args.n_replicates, args.n_se, args.n_sp,
+                              not args.no_bootstrap, args.ci, args.n_workers, args.seed)
+    Path(args.outputs_filepath).mkdir(parents=True, exist_ok=True)
+    for name, df in dfs.items():
+        fpath = '%s%s.csv' % (args.outputs_filepath, name if name == 'chi2' else 'test1_%s' % name)
+        print('saving %s to %s' % (name, fpath))
+        df.to_csv(fpath, index=False)
+    print('saved')
@@ -0,0 +1,5 @@
+import sys
+
+from andorra_mobility.cli import main
+
+sys.exit(main())
@@ -0,0 +1,173 @@
+"""
+Command line interface
+-------------
+Runs the preprocessing stages and analyses as subcommands of one command,
+installed with the package (pip install -e .) as andorra-mobility:
+
+    andorra-mobility [GLOBAL OPTIONS] COMMAND [OPTIONS] [+ COMMAND [OPTIONS] ...]
+
+Commands (each takes the options of its script, see andorra-mobility COMMAND --help):
+    parish      stays with parishes from the JSON stays   preprocessing/stays/preprocessing_stays_by_parish.py
+    trips       daily trips                                preprocessing/trips/trips.py
+    presence    presence, entrances and departures         preprocessing/presence/presence_entrances_departures.py
+    homes       inferred home parishes                     preprocessing/homes/infer_homes.py
+    stay_home   daily users staying home                   preprocessing/stay_home/stay_home.py
+    occupancy   occupancy by parish and time of day        preprocessing/occupancy/occupancy.py
+    crowding    Cross Crowding Index                       analysis/cross_crowding.py
+
+This module only imports the standard library. The module of a command, with its
+dependencies (e.g. geopandas for parish, h3 and scipy for crowding), is only imported
+when the command is run.
+
+Commands separated by + are run in order in one process:
+- the global options --start_date, --end_date, --data_filepath, --outputs_filepath and
+  --sample_rate are the defaults of the commands' options of the same name
+- all commands are parsed before the first one runs, so that a typo in the last
+  command does not fail a long run
+- the daily stays and homes read by a command are kept for the next ones
+  (see andorra_mobility/inputs.py), up to --cache_mb megabytes
+- instrumentation options are global, and the stages of each command are summarized
+
+Example usage:
+andorra-mobility trips \
+    --start_date=2020-03-01 \
+    --end_date=2020-03-31 \
+    --data_filepath=/home/data_commons/andorra_data_2020/ \
+    --outputs_filepath=./outputs/metrics/
+
+andorra-mobility \
+    --start_date=2020-03-01 \
+    --end_date=2020-03-31 \
+    --data_filepath=/home/data_commons/andorra_data_2020/ \
+    --outputs_filepath=./outputs/metrics/ \
+    trips + presence --n_shards=8 + homes --month=2020-03 + stay_home
+
+A quick approximate run of the same chain, on a stable 5% sample of users whose
+counts are scaled up, with standard errors (see andorra_mobility/sampling.py):
+andorra-mobility \
+    --start_date=2020-03-01 \
+    --end_date=2020-03-31 \
+    --data_filepath=/home/data_commons/andorra_data_2020/ \
+    --outputs_filepath=./outputs/metrics/ \
+    --sample_rate=0.05 \
+    trips + presence + homes --month=2020-03 + stay_home
+
+Instrumentation options (see andorra_mobility/instrumentation.py):
+    [--metrics_log=PATH] [--profile_day=yyyy-mm-dd] [--profiler=cprofile|sampling]
+
+"""
+import argparse
+from collections import OrderedDict
+import importlib
+import sys
+
+from andorra_mobility.instrumentation import Instrumentation, add_instrumentation_args
+
+# command -> (module, instrumentation run name, description)
+COMMANDS = OrderedDict([
+    ('parish', ('preprocessing.stays.preprocessing_stays_by_parish', 'stays by parish',
+                'Preprocess JSON stays files to produce CSV tables of stays with parishes.')),
+    ('trips', ('preprocessing.trips.trips', 'trips',
+               'Computes the daily number of trips made by mobile subscribers, based on precomputed stays.')),
+    ('presence', ('preprocessing.presence.presence_entrances_departures', 'presence',
+                  'Computes likely dates of presence, entrances, departures for each user in the data, '
+                  'based on the dates they are observed in the data.')),
+    ('homes', ('preprocessing.homes.infer_homes', 'homes',
+               'Infers a home parish for each user in the stays data and saves a table.')),
+    ('stay_home', ('preprocessing.stay_home.stay_home', 'stay home',
+                   'Computes the daily number of users staying home, by home parish.')),
+    ('occupancy', ('preprocessing.occupancy.occupancy', 'occupancy',
+                   'Computes the number of devices in each parish during each time slot of the day.')),
+    ('crowding', ('analysis.cross_crowding', 'cross crowding',
+                  'Computes the Cross Crowding Index between the residents of each parish and tourists.')),
+])
+
+CHAIN_SEPARATOR = '+'
+# global options that are the defaults of the commands' options of the same name
+SHARED_OPTIONS = ['start_date', 'end_date', 'data_filepath', 'outputs_filepath', 'sample_rate']
+SHARED_OPTION_TYPES = {'sample_rate': float}
+DEFAULT_CACHE_MB = 2048
+
+
+def split_chain(argv):
+    """
+    Splits the command line at each CHAIN_SEPARATOR
+    """
+    chain = [[]]
+    for arg in argv:
+        if arg == CHAIN_SEPARATOR:
+            chain.append([])
+        else:
+            chain[-1].append(arg)
+    return chain
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        prog='andorra-mobility',
+        description='Runs the preprocessing stages and analyses. Commands separated by %s are run '
+                    'in order in one process.' % CHAIN_SEPARATOR,
+        epilog='commands:\n' + '\n'.join('  %-10s %s' % (c, COMMANDS[c][2]) for c in COMMANDS),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    for option in SHARED_OPTIONS:
+        parser.add_argument('--%s' % option, default=None, type=SHARED_OPTION_TYPES.get(option, str),
+                            help='default --%s of the commands' % option)
+    parser.add_argument('--cache_mb', type=int, default=DEFAULT_CACHE_MB,
+                        help='megabytes of inputs kept for the next commands of a chain')
+    add_instrumentation_args(parser)
+    parser.add_argument('command', choices=list(COMMANDS))
+    parser.add_argument('command_args', nargs=argparse.REMAINDER)
+    return parser
+
+
+def get_command_parser(command, shared_defaults):
+    """
+    Imports the module of command and returns (module, parser of its options),
+    with the shared options as defaults.
+    """
+    module_name, _, description = COMMANDS[command]
+    module = importlib.import_module(module_name)
+    parser = argparse.ArgumentParser(prog='andorra-mobility %s' % command, description=description)
+    module.add_arguments(parser)
+    for action in parser._actions:
+        if shared_defaults.get(action.dest) is not None:
+            action.default = shared_defaults[action.dest]
+            action.required = False
+    return module, parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = get_parser()
+    if not argv:
+        parser.print_help()
+        return 1
+    chain = split_chain(argv)
+    args = parser.parse_args(chain[0])
+    shared_defaults = {option: getattr(args, option) for option in SHARED_OPTIONS}
+    steps = [(args.command, args.command_args)]
+    for command_argv in chain[1:]:
+        if not command_argv or command_argv[0] not in COMMANDS:
+            parser.error('expected one of %s after %s' % (list(COMMANDS), CHAIN_SEPARATOR))
+        steps.append((command_argv[0], command_argv[1:]))
+
+    commands = []
+    for command, command_argv in steps:
+        module, command_parser = get_command_parser(command, shared_defaults)
+        commands.append((command, module, command_parser.parse_args(command_argv)))
+
+    from andorra_mobility.inputs import set_cache_size
+    cache = set_cache_size(args.cache_mb if len(commands) > 1 else 0)
+    for i, (command, module, command_args) in enumerate(commands):
+        if len(commands) > 1:
+            print('=== %s/%s: %s ===' % (i + 1, len(commands), command))
+        instrumentation = Instrumentation.from_args(COMMANDS[command][1], args)
+        module.main(command_args, instrumentation)
+        instrumentation.print_summary()
+    if len(commands) > 1:
+        print('inputs cache: %s reads, %s from cache' % (cache.hits + cache.misses, cache.hits))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
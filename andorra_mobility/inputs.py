@@ -0,0 +1,105 @@
+"""
+Inputs
+-------------
+Reads the csv inputs of the stages (daily stays, homes) through an optional
+in-process cache, so that stages chained in one process (see cli.py) read each
+file once: e.g. trips, presence and homes all read the same daily stays.
+
+The cache is disabled by default, and read_csv is then pd.read_csv.
+When enabled (set_cache_size), whole files are read and kept, least recently used
+first out, up to max_mb megabytes of tables. Callers get a copy of the requested
+columns (in file order, as pd.read_csv with usecols), so they may modify it.
+
+At a sample rate below 1 (see sampling.py), only the rows of the sampled users are
+returned, by their imsi column, and only they are kept in the cache.
+
+Example usage:
+
+    set_cache_size(4096)
+    stays_df = read_csv(get_stays_filepath(data_filepath, 1, 3, 2020), usecols=['imsi', 'parish'])
+
+"""
+from collections import OrderedDict
+
+import pandas as pd
+
+from andorra_mobility.sampling import IMSI, get_sample_rate, sample_users
+
+
+class InputCache:
+    """
+    Least recently used cache of whole csv tables, bounded by their memory usage.
+    """
+
+    def __init__(self, max_mb=0):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.tables = OrderedDict()  # filepath -> (table, bytes)
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def read_csv(self, filepath, usecols=None, sample_rate=1.0):
+        filepath = str(filepath)
+        if self.max_bytes <= 0:
+            return read_sampled_csv(filepath, usecols, sample_rate)
+        key = (filepath, sample_rate)
+        if key in self.tables:
+            self.tables.move_to_end(key)
+            self.hits += 1
+            table = self.tables[key][0]
+        else:
+            self.misses += 1
+            table = read_sampled_csv(filepath, None, sample_rate)
+            self.add(key, table)
+        if usecols is None:
+            return table.copy()
+        return table[[c for c in table.columns if c in set(usecols)]].copy()
+
+    def add(self, key, table):
+        n_bytes = int(table.memory_usage(index=True, deep=True).sum())
+        if n_bytes > self.max_bytes:
+            return
+        self.tables[key] = (table, n_bytes)
+        self.n_bytes += n_bytes
+        while self.n_bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self.tables.popitem(last=False)
+            self.n_bytes -= evicted_bytes
+
+    def clear(self):
+        self.tables.clear()
+        self.n_bytes = 0
+
+
+def read_sampled_csv(filepath, usecols=None, sample_rate=1.0):
+    """
+    pd.read_csv, keeping the rows of the users sampled at sample_rate
+    """
+    if sample_rate >= 1:
+        return pd.read_csv(filepath, usecols=usecols)
+    table = sample_users(pd.read_csv(filepath, usecols=None if usecols is None else set(usecols) | {IMSI}),
+                         sample_rate)
+    return table if usecols is None else table[[c for c in table.columns if c in set(usecols)]]
+
+
+# the cache shared by the stages run in this process
+_cache = InputCache()
+
+
+def set_cache_size(max_mb):
+    """
+    Sets the size of the shared cache in megabytes. 0 disables it.
+    """
+    global _cache
+    _cache = InputCache(max_mb)
+    return _cache
+
+
+def get_cache():
+    return _cache
+
+
+def read_csv(filepath, usecols=None):
+    """
+    Reads a csv input through the shared cache, keeping the users of the run's sample rate.
+    """
+    return _cache.read_csv(filepath, usecols, get_sample_rate())
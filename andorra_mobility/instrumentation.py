@@ -0,0 +1,325 @@
+"""
+Instrumentation
+-------------
+Records per-stage (and per-day) measurements for the preprocessing scripts and
+analysis helpers, replacing ad-hoc progress prints:
+
+    stage, day, seconds, rows_in, rows_out, rows_per_second,
+    rss_mb, peak_rss_mb, read_bytes, write_bytes
+
+Each record is printed as a progress line, and optionally appended as a JSON line
+to a metrics log. A summary table aggregated by stage is printed at the end of a run.
+Stages can be nested (e.g. a day within a stage); records are written when a stage exits.
+
+Peak RSS is measured per stage on Linux by resetting the process high water mark
+(/proc/self/clear_refs) when a stage starts. Elsewhere it is the process-wide peak.
+I/O bytes are read from /proc/self/io when available.
+
+A profiler can be attached to the stages of one chosen day:
+    cprofile  deterministic profile, saved as pstats (view with snakeviz, pstats, ...)
+    sampling  low overhead stack sampling, saved as collapsed stacks
+              (one 'frame;frame;frame count' line per stack, as read by flamegraph.pl/speedscope)
+
+Example usage:
+
+    instrumentation = Instrumentation('trips', metrics_log_filepath='trips_metrics.jsonl')
+    for d in dates:
+        with instrumentation.stage('day', day=d) as record:
+            df = pd.read_csv(...)
+            record.rows_in = len(df)
+            ...
+            record.rows_out = 1
+    instrumentation.print_summary()
+
+Scripts add the command line options with add_instrumentation_args(parser)
+and create the instrumentation with Instrumentation.from_args(name, args).
+"""
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import cProfile
+from datetime import date, datetime
+import json
+from pathlib import Path
+import resource
+import signal
+import sys
+import time
+
+
+CPROFILE = 'cprofile'
+SAMPLING = 'sampling'
+PROFILERS = [CPROFILE, SAMPLING]
+
+SAMPLING_INTERVAL_S = 0.005
+
+date_fmt = '%Y-%m-%d'
+
+PROC_STATUS = Path('/proc/self/status')
+PROC_CLEAR_REFS = Path('/proc/self/clear_refs')
+PROC_IO = Path('/proc/self/io')
+
+
+def get_rss_mb():
+    """
+    Returns (current RSS, peak RSS since the last reset) in MB.
+    """
+    if PROC_STATUS.is_file():
+        status = {}
+        for line in PROC_STATUS.read_text().splitlines():
+            key, _, value = line.partition(':')
+            if key in ('VmRSS', 'VmHWM'):
+                status[key] = int(value.split()[0]) / 1024
+        if len(status) == 2:
+            return status['VmRSS'], status['VmHWM']
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+    return None, peak
+
+
+def reset_peak_rss():
+    """
+    Resets the peak RSS high water mark (Linux >= 4.0). Returns whether it was reset.
+    """
+    try:
+        PROC_CLEAR_REFS.write_text('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_io_bytes():
+    """
+    Returns (bytes read, bytes written) by the process, including page cache hits, or (None, None).
+    """
+    try:
+        io = dict(line.split(': ') for line in PROC_IO.read_text().splitlines())
+        return int(io['rchar']), int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def format_day(day):
+    if day is None:
+        return None
+    if isinstance(day, (date, datetime)):
+        return day.strftime(date_fmt)
+    return str(day)
+
+
+class StageRecord:
+    """
+    Measurements for one run of a stage.
+    rows_in and rows_out are set by the instrumented code.
+    """
+
+    def __init__(self, run, stage, day=None, rows_in=None, rows_out=None):
+        self.run = run
+        self.stage = stage
+        self.day = format_day(day)
+        self.rows_in = rows_in
+        self.rows_out = rows_out
+        self.seconds = None
+        self.rss_mb = None
+        self.peak_rss_mb = None
+        self.read_bytes = None
+        self.write_bytes = None
+
+    @property
+    def rows_per_second(self):
+        if self.rows_in is None or not self.seconds:
+            return None
+        return self.rows_in / self.seconds
+
+    def to_dict(self):
+        return OrderedDict([
+            ('run', self.run),
+            ('stage', self.stage),
+            ('day', self.day),
+            ('seconds', self.seconds),
+            ('rows_in', self.rows_in),
+            ('rows_out', self.rows_out),
+            ('rows_per_second', self.rows_per_second),
+            ('rss_mb', self.rss_mb),
+            ('peak_rss_mb', self.peak_rss_mb),
+            ('read_bytes', self.read_bytes),
+            ('write_bytes', self.write_bytes),
+            ('time', datetime.now().isoformat()),
+        ])
+
+    def __str__(self):
+        s = '[%s] %s%s: %.2fs' % (self.run, self.stage, ' %s' % self.day if self.day else '', self.seconds)
+        if self.rows_in is not None:
+            s += ', %s rows in' % self.rows_in
+        if self.rows_out is not None:
+            s += ', %s rows out' % self.rows_out
+        if self.rows_per_second is not None:
+            s += ', %.0f rows/s' % self.rows_per_second
+        s += ', peak RSS %.0f MB' % self.peak_rss_mb
+        if self.read_bytes is not None:
+            s += ', read %.1f MB, wrote %.1f MB' % (self.read_bytes / 1e6, self.write_bytes / 1e6)
+        return s
+
+
+class SamplingProfiler:
+    """
+    Samples the main thread's stack on a CPU time timer and counts collapsed stacks.
+    """
+
+    def __init__(self, interval=SAMPLING_INTERVAL_S):
+        self.interval = interval
+        self.stacks = Counter()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%s)' % (code.co_name, Path(code.co_filename).name, code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def enable(self):
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler)
+
+    def dump_stats(self, filepath):
+        with open(filepath, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('%s %s\n' % (stack, count))
+
+
+class Instrumentation:
+    """
+    Records stage measurements for one run of a script.
+
+    run: name of the run, e.g. the script name
+    metrics_log_filepath: if given, each record is appended to this file as a JSON line
+    verbose: print each record as a progress line
+    profile_day: day (yyyy-mm-dd, or a date) whose stages are profiled
+    profiler: one of PROFILERS
+    profile_filepath: where the profile is saved. Defaults to {run}_{day}.prof / .stacks
+    """
+
+    def __init__(self, run, metrics_log_filepath=None, verbose=True,
+                 profile_day=None, profiler=CPROFILE, profile_filepath=None):
+        assert profiler in PROFILERS, 'profiler must be one of %s' % PROFILERS
+        self.run = run
+        self.metrics_log_filepath = metrics_log_filepath
+        self.verbose = verbose
+        self.profile_day = format_day(profile_day)
+        self.profiler = profiler
+        self.profile_filepath = profile_filepath
+        self.records = []
+        self._stack = []
+        self._active_profiler = None
+
+    @classmethod
+    def from_args(cls, run, args):
+        return cls(run, metrics_log_filepath=args.metrics_log,
+                   profile_day=args.profile_day, profiler=args.profiler,
+                   profile_filepath=args.profile_filepath)
+
+    @contextmanager
+    def stage(self, stage, day=None, rows_in=None):
+        """
+        Context manager that measures the enclosed code and yields its StageRecord.
+        Nested stages inherit the day of the enclosing stage.
+        """
+        if day is None and self._stack:
+            day = self._stack[-1][0].day
+        record = StageRecord(self.run, stage, day=day, rows_in=rows_in)
+        profiling = (self.profile_day is not None and record.day == self.profile_day
+                     and self._active_profiler is None)
+        if profiling:
+            self._start_profiler()
+        if self._stack:
+            # the enclosing stage's peak so far, before the high water mark is reset
+            self._stack[-1][3] = max(self._stack[-1][3], get_rss_mb()[1])
+        reset_peak_rss()
+        read_bytes, write_bytes = get_io_bytes()
+        self._stack.append([record, read_bytes, write_bytes, 0.0])
+        then = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds = time.perf_counter() - then
+            _, _, _, nested_peak_rss_mb = self._stack.pop()
+            record.rss_mb, record.peak_rss_mb = get_rss_mb()
+            record.peak_rss_mb = max(record.peak_rss_mb, nested_peak_rss_mb)
+            if self._stack:
+                self._stack[-1][3] = max(self._stack[-1][3], record.peak_rss_mb)
+            end_read_bytes, end_write_bytes = get_io_bytes()
+            if read_bytes is not None:
+                record.read_bytes = end_read_bytes - read_bytes
+                record.write_bytes = end_write_bytes - write_bytes
+            if profiling:
+                self._stop_profiler(record.day)
+            self._add_record(record)
+
+    def _add_record(self, record):
+        self.records.append(record)
+        if self.verbose:
+            print(record, flush=True)
+        if self.metrics_log_filepath is not None:
+            with open(self.metrics_log_filepath, 'a') as f:
+                f.write(json.dumps(record.to_dict()) + '\n')
+
+    def _start_profiler(self):
+        self._active_profiler = cProfile.Profile() if self.profiler == CPROFILE else SamplingProfiler()
+        self._active_profiler.enable()
+
+    def _stop_profiler(self, day):
+        self._active_profiler.disable()
+        ext = 'prof' if self.profiler == CPROFILE else 'stacks'
+        filepath = self.profile_filepath or '%s_%s.%s' % (self.run, day, ext)
+        self._active_profiler.dump_stats(filepath)
+        print('[%s] saved %s profile for %s to %s' % (self.run, self.profiler, day, filepath))
+        self._active_profiler = None
+
+    def summary(self):
+        """
+        Returns a list of dicts with the records aggregated by stage:
+        stage, count, seconds, rows_in, rows_out, rows_per_second, peak_rss_mb, read_bytes, write_bytes
+        """
+        summary = OrderedDict()
+        for r in self.records:
+            s = summary.setdefault(r.stage, OrderedDict([
+                ('stage', r.stage), ('count', 0), ('seconds', 0.0), ('rows_in', 0), ('rows_out', 0),
+                ('rows_per_second', None), ('peak_rss_mb', 0.0), ('read_bytes', 0), ('write_bytes', 0)]))
+            s['count'] += 1
+            s['seconds'] += r.seconds
+            s['rows_in'] += r.rows_in or 0
+            s['rows_out'] += r.rows_out or 0
+            s['peak_rss_mb'] = max(s['peak_rss_mb'], r.peak_rss_mb)
+            s['read_bytes'] += r.read_bytes or 0
+            s['write_bytes'] += r.write_bytes or 0
+        for s in summary.values():
+            if s['seconds'] > 0 and s['rows_in']:
+                s['rows_per_second'] = s['rows_in'] / s['seconds']
+        return list(summary.values())
+
+    def print_summary(self):
+        columns = ['stage', 'count', 'seconds', 'rows_in', 'rows_out', 'rows_per_second',
+                   'peak_rss_mb', 'read_bytes', 'write_bytes']
+        print('--- [%s] summary ---' % self.run)
+        print(' '.join('%16s' % c for c in columns))
+        for s in self.summary():
+            print(' '.join('%16s' % (('%.2f' % s[c]) if isinstance(s[c], float) else s[c]) for c in columns))
+
+
+def add_instrumentation_args(parser):
+    """
+    Adds the instrumentation command line options to an argparse parser.
+    """
+    parser.add_argument('--metrics_log', default=None,
+                        help='/path/to/metrics.jsonl to append per-stage measurements to')
+    parser.add_argument('--profile_day', default=None,
+                        help='yyyy-mm-dd day whose stages are profiled')
+    parser.add_argument('--profiler', default=CPROFILE, choices=PROFILERS)
+    parser.add_argument('--profile_filepath', default=None,
+                        help='/path/to/save/profile')
+    return parser
@@ -0,0 +1,133 @@
+"""
+Nationality
+-------------
+Groups users into nationalities, or any other grouping of countries, by the MCC
+(mobile country code) of their SIM card, using the list of MCCs in
+data/public/mcc-mnc-list.csv.
+
+A grouping is a lookup table from MCC (0-999) to a group code, so that the groups of
+an array of MCCs are found with a single indexing operation, and per-group counts
+with a single bincount. MCCs not in any group are assigned to the 'Other' group.
+
+Example usage:
+
+    # the nationalities of pre_lockdown_mobility.ipynb
+    grouping = MccGrouping({'Andorran': [213], 'Spanish': [214], 'French': [208],
+                            'British': [234], 'Dutch': [204]})
+    # groups of countries, by name or ISO code
+    grouping = MccGrouping.from_countries({'Iberia': ['Spain', 'pt'], 'France': ['fr']})
+    # one group per country
+    grouping = MccGrouping.by_country()
+
+    codes = grouping.get_codes(mccs)
+    counts = np.bincount(codes, minlength=len(grouping))
+    grouping.names  # group name of each code
+
+"""
+from collections import OrderedDict
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+MCC_MNC_LIST_FILEPATH = Path(__file__).resolve().parents[1] / 'data/public/mcc-mnc-list.csv'
+
+N_MCCS = 1000
+OTHER = 'Other'
+
+# grouping names accepted by get_mcc_grouping, besides a path to a JSON file
+COUNTRY = 'country'
+
+
+def read_mcc_countries(filepath=MCC_MNC_LIST_FILEPATH):
+    """
+    Returns a dataframe indexed by MCC (int) with the columns Country and ISO.
+    MCCs shared by several countries or territories (e.g. 234 for the United Kingdom
+    and the Channel Islands) are assigned the country of most of their networks.
+    """
+    mcc_mnc_df = pd.read_csv(filepath, dtype={'MCC': str})
+    mcc_mnc_df['MCC'] = pd.to_numeric(mcc_mnc_df['MCC'], errors='coerce')
+    mcc_mnc_df = mcc_mnc_df.dropna(subset=['MCC', 'Country'])
+    mcc_mnc_df['MCC'] = mcc_mnc_df['MCC'].astype(int)
+    counts = mcc_mnc_df.groupby(['MCC', 'Country', 'ISO']).size().rename('n').reset_index()
+    counts = counts.sort_values(['MCC', 'n'], ascending=[True, False])
+    return counts.drop_duplicates('MCC').set_index('MCC')[['Country', 'ISO']]
+
+
+def get_int_mccs(mccs):
+    """
+    Returns mccs as ints, with -1 for missing or invalid values.
+    """
+    mccs = pd.to_numeric(pd.Series(np.asarray(mccs)), errors='coerce').fillna(-1).astype(np.int64).values
+    mccs[(mccs < 0) | (mccs >= N_MCCS)] = -1
+    return mccs
+
+
+class MccGrouping:
+    """
+    A lookup table from MCC to group.
+
+    groups: ordered dict of group name -> list of MCCs
+    other: name of the group of all other MCCs
+    """
+
+    def __init__(self, groups, other=OTHER):
+        groups = OrderedDict(groups)
+        self.names = list(groups) + [other]
+        self.other_code = len(groups)
+        # the last entry is the code for missing MCCs (-1)
+        self.lookup = np.full(N_MCCS + 1, self.other_code, dtype=np.int64)
+        for code, mccs in enumerate(groups.values()):
+            self.lookup[get_int_mccs(mccs)] = code
+        self.lookup[-1] = self.other_code
+
+    @classmethod
+    def from_countries(cls, groups, other=OTHER, filepath=MCC_MNC_LIST_FILEPATH):
+        """
+        groups: ordered dict of group name -> list of country names, ISO codes or MCCs
+        """
+        mcc_countries = read_mcc_countries(filepath)
+        mcc_groups = OrderedDict()
+        for name, countries in OrderedDict(groups).items():
+            mccs = [int(c) for c in countries if str(c).isdigit()]
+            countries = set(str(c).lower() for c in countries if not str(c).isdigit())
+            mask = (mcc_countries['Country'].str.lower().isin(countries)
+                    | mcc_countries['ISO'].str.lower().isin(countries))
+            mcc_groups[name] = mccs + list(mcc_countries.index[mask])
+        return cls(mcc_groups, other)
+
+    @classmethod
+    def by_country(cls, other=OTHER, filepath=MCC_MNC_LIST_FILEPATH):
+        """
+        One group per country.
+        """
+        mcc_countries = read_mcc_countries(filepath)
+        return cls(mcc_countries.groupby('Country').apply(lambda df: list(df.index)), other)
+
+    def get_codes(self, mccs):
+        """
+        Returns the group code of each mcc.
+        """
+        return self.lookup[get_int_mccs(mccs)]
+
+    def get_names(self, mccs):
+        return np.array(self.names, dtype=object)[self.get_codes(mccs)]
+
+    def __len__(self):
+        return len(self.names)
+
+
+def get_mcc_grouping(grouping, default=None):
+    """
+    Returns an MccGrouping from a command line value:
+        None: default
+        'country': one group per country
+        PATH: a JSON file of {group name: [MCCs, country names or ISO codes]}
+    """
+    if grouping is None:
+        return default
+    if grouping == COUNTRY:
+        return MccGrouping.by_country()
+    return MccGrouping.from_countries(json.load(open(grouping), object_pairs_hook=OrderedDict))
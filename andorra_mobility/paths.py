@@ -0,0 +1,105 @@
+"""
+Paths
+-------------
+The paths of the data files shared by the preprocessing stages, and date helpers.
+
+data_filepath/
+    stays/YYYY_M/stays_YYYY_M_D.json    stays by person (parquet_to_json.py)
+    stays/YYYY_M/stays_YYYY_M_D.csv     stays with parishes (preprocessing_stays_by_parish.py)
+    homes/YYYY_M_homes.csv              inferred homes (infer_homes.py)
+    presence/YYYY/                      presence tables, store and sketches (presence_entrances_departures.py)
+
+Stages that take the stays or homes directory rather than data_filepath
+(e.g. infer_homes.py --stays_path) use the *_path helpers.
+
+Runs on a sample of users (--sample_rate, see sampling.py) write their per-user data
+(stays, homes, presence) under data_filepath/sample_RATE/, with the same layout, so that
+they never replace the data of all users, and their aggregate outputs with a _sample_RATE
+suffix. They read the data written by a run at the same sample rate if it exists, and the
+data of all users otherwise (find_input).
+
+Only the standard library is imported, so that the command line interface (cli.py)
+can use these helpers without loading numpy or pandas.
+
+"""
+from datetime import datetime, timedelta
+from pathlib import Path
+
+date_fmt = '%Y-%m-%d'
+month_fmt = '%Y-%m'
+
+CSV = 'csv'
+JSON = 'json'
+
+
+def daterange(start_datetime, end_datetime):
+    for n in range(int((end_datetime - start_datetime).days) + 1):
+        yield start_datetime + timedelta(n)
+
+def parse_date(date_str):
+    return datetime.strptime(date_str, date_fmt)
+
+def get_datetimes(start_date, end_date):
+    """
+    returns the datetimes from start_date to end_date (yyyy-mm-dd), inclusive
+    """
+    return [d for d in daterange(parse_date(start_date), parse_date(end_date))]
+
+
+def get_stays_path(data_filepath):
+    return '{}stays/'.format(data_filepath)
+
+def get_homes_path(data_filepath):
+    return '{}homes/'.format(data_filepath)
+
+def get_presence_path(data_filepath, year):
+    return '{}presence/{}/'.format(data_filepath, year)
+
+
+def get_stays_day_filepath(stays_path, day, month, year, ext=CSV):
+    return '{}{}_{}/stays_{}_{}_{}.{}'.format(stays_path, year, month, year, month, day, ext)
+
+def get_stays_filepath(data_filepath, day, month, year, ext=CSV):
+    return get_stays_day_filepath(get_stays_path(data_filepath), day, month, year, ext)
+
+def get_stays_filepath_date(stays_filepath):
+    return datetime.strptime(Path(stays_filepath).stem, 'stays_%Y_%m_%d').date()
+
+
+def get_month_homes_filepath(homes_path, year, month):
+    return '{}{}_{}_homes.csv'.format(homes_path, year, month)
+
+def get_homes_filepath(data_filepath, year, month):
+    return get_month_homes_filepath(get_homes_path(data_filepath), year, month)
+
+
+def get_presence_store_filepath(data_filepath, year):
+    """
+    The presence store of the default window
+    """
+    return '{}presence.store/'.format(get_presence_path(data_filepath, year))
+
+
+def get_sample_suffix(sample_rate):
+    """
+    The suffix of the outputs of a run at sample_rate, empty for all users
+    """
+    return '' if sample_rate >= 1 else '_sample_{:g}'.format(sample_rate)
+
+def get_sample_path(data_filepath, sample_rate):
+    """
+    Where a run at sample_rate writes its per-user data
+    """
+    return data_filepath if sample_rate >= 1 else '{}sample_{:g}/'.format(data_filepath, sample_rate)
+
+def find_input(get_filepath, data_filepath, sample_rate, *args):
+    """
+    Returns get_filepath(data_filepath, *args), or the same file under the sample path of
+    sample_rate if a run at sample_rate wrote it, e.g.
+    find_input(get_stays_filepath, data_filepath, 0.05, day, month, year)
+    """
+    if sample_rate < 1:
+        sample_filepath = get_filepath(get_sample_path(data_filepath, sample_rate), *args)
+        if Path(sample_filepath).exists():
+            return sample_filepath
+    return get_filepath(data_filepath, *args)
@@ -0,0 +1,366 @@
+"""
+Presence store
+-------------
+A compact binary store of per-user presence, replacing the wide
+presence_tourists.csv / presence_others.csv tables (one text column per day).
+
+For each user and day two flags are stored, bit-packed along days:
+    present: the user is inferred to be present (presence value > 0)
+    observed: the user has at least one stay (presence value == 2)
+together with user metadata:
+    imsi, mcc (0 if unknown), status (tourist or resident)
+
+A store is a directory:
+    meta.json        dates, number of users, dtypes
+    imsi.bin         imsi per user (int64, or fixed width bytes for string IMSIs)
+    mcc.bin          uint16 per user
+    status.bin       uint8 per user (0: tourist, 1: resident)
+    present.bin      uint8 (users x ceil(days/8)), bits packed along days
+    observed.bin     uint8 (users x ceil(days/8)), bits packed along days
+
+The files are memory-mapped when opened, so queries only read the files of the flags and
+metadata they use, without parsing tables. Rows are users and bits are packed along days,
+so a query of one day or a range of days still reads a byte of every user's row per 8 days.
+meta.json is written last, when the writer is closed without error: a store without it is incomplete.
+Stores with the same dates can be concatenated by concatenating their files (see merge_stores),
+which is how the sharded presence computation combines its shards.
+
+Example usage:
+
+    store = PresenceStore.open('/home/data_commons/andorra_data_2020/presence/2020/presence.store')
+    store.users_present('2020-04-01', status=RESIDENT)   # imsis
+    store.count_present('2020-03-01', '2020-03-31', by='status')  # dataframe of daily counts
+    store.residents()  # imsis
+    store.is_resident(imsis)  # boolean array
+
+
+Usage to convert presence csv tables to a store:
+python presence_store.py \
+    --presence_tourists_filepath=PATH \
+    --presence_others_filepath=PATH \
+    --store_filepath=PATH
+
+"""
+from datetime import date, datetime
+import json
+from pathlib import Path
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+TOURIST = 'tourist'
+RESIDENT = 'resident'
+STATUSES = [TOURIST, RESIDENT]
+
+IMSI = 'imsi'
+MCC = 'mcc'
+STATUS = 'status'
+PRESENT = 'present'
+OBSERVED = 'observed'
+DATE = 'date'
+
+META = 'meta.json'
+IMSI_STR_LEN = 64
+UNKNOWN_MCC = 0
+
+date_fmt = '%Y-%m-%d'
+
+CSV_CHUNKSIZE = 100000
+
+
+def get_mcc_codes(mccs):
+    """
+    Returns mccs as uint16, with UNKNOWN_MCC for missing values.
+    """
+    return pd.to_numeric(pd.Series(mccs), errors='coerce').fillna(UNKNOWN_MCC).astype(np.uint16).values
+
+
+class PresenceStoreWriter:
+    """
+    Writes a presence store in chunks of users.
+
+    dates: the dates of the presence columns
+    imsi_dtype: 'int64' for numeric IMSIs, otherwise IMSIs are stored as fixed width bytes
+    """
+
+    def __init__(self, filepath, dates, imsi_dtype='int64'):
+        self.filepath = Path(filepath)
+        self.filepath.mkdir(parents=True, exist_ok=True)
+        # the meta of a previous store would make this one look complete until it is closed
+        remove_meta(self.filepath)
+        self.dates = [format_date(d) for d in dates]
+        self.imsi_dtype = np.dtype(imsi_dtype) if imsi_dtype == 'int64' else np.dtype('S%s' % IMSI_STR_LEN)
+        self.n_users = 0
+        self._files = {name: open(self.filepath / ('%s.bin' % name), 'wb')
+                       for name in [IMSI, MCC, STATUS, PRESENT, OBSERVED]}
+
+    def write(self, imsis, mccs, statuses, presence_values):
+        """
+        Writes a chunk of users.
+        presence_values: (users x days) array with 0: absent, 1: present, 2: present and observed,
+        as in the presence tables.
+        statuses: TOURIST or RESIDENT per user, or a single status for all users.
+        """
+        presence_values = np.asarray(presence_values)
+        assert presence_values.shape == (len(imsis), len(self.dates))
+        if isinstance(statuses, str):
+            statuses = [statuses] * len(imsis)
+        self._files[IMSI].write(np.asarray(imsis).astype(self.imsi_dtype).tobytes())
+        self._files[MCC].write(get_mcc_codes(mccs).tobytes())
+        self._files[STATUS].write(np.array([STATUSES.index(s) for s in statuses], dtype=np.uint8).tobytes())
+        self._files[PRESENT].write(np.packbits(presence_values > 0, axis=1).tobytes())
+        self._files[OBSERVED].write(np.packbits(presence_values == 2, axis=1).tobytes())
+        self.n_users += len(imsis)
+
+    def close(self, complete=True):
+        """
+        Closes the files, and writes meta.json if the store is complete.
+        """
+        for f in self._files.values():
+            f.close()
+        if complete:
+            write_meta(self.filepath, self.dates, self.n_users, self.imsi_dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close(complete=exc[0] is None)
+
+
+def format_date(d):
+    if isinstance(d, (date, datetime, pd.Timestamp)):
+        return d.strftime(date_fmt)
+    return pd.to_datetime(d).strftime(date_fmt)
+
+
+def remove_meta(filepath):
+    try:
+        (Path(filepath) / META).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def write_meta(filepath, dates, n_users, imsi_dtype):
+    json.dump({
+        'dates': dates,
+        'n_users': n_users,
+        'imsi_dtype': imsi_dtype.str,
+    }, open(Path(filepath) / META, 'w'))
+
+
+class PresenceStore:
+    """
+    Read access to a presence store. Use PresenceStore.open(filepath).
+    """
+
+    def __init__(self, filepath):
+        self.filepath = Path(filepath)
+        meta = json.load(open(self.filepath / META))
+        self.dates = pd.to_datetime(meta['dates'])
+        self.n_users = meta['n_users']
+        self.n_days = len(self.dates)
+        n_bytes = (self.n_days + 7) // 8
+        self.imsi = self._memmap(IMSI, np.dtype(meta['imsi_dtype']), (self.n_users,))
+        self.mcc = self._memmap(MCC, np.uint16, (self.n_users,))
+        self.status = self._memmap(STATUS, np.uint8, (self.n_users,))
+        self.present = self._memmap(PRESENT, np.uint8, (self.n_users, n_bytes))
+        self.observed = self._memmap(OBSERVED, np.uint8, (self.n_users, n_bytes))
+        self._imsi_index = None
+        self._ind_date_by_date = {d: i for i, d in enumerate(self.dates.strftime(date_fmt))}
+
+    @classmethod
+    def open(cls, filepath):
+        return cls(filepath)
+
+    def _memmap(self, name, dtype, shape):
+        if self.n_users == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self.filepath / ('%s.bin' % name), dtype=dtype, mode='r', shape=shape)
+
+    def __len__(self):
+        return self.n_users
+
+    def get_ind_date(self, d):
+        if isinstance(d, (int, np.integer)):
+            return d
+        return self._ind_date_by_date[format_date(d)]
+
+    def _day_flags(self, flags, ind_date):
+        return ((flags[:, ind_date >> 3] >> (7 - (ind_date & 7))) & 1).astype(bool)
+
+    def get_user_mask(self, status=None, mccs=None):
+        """
+        Returns a boolean mask over users with the given status and/or in the given mccs.
+        """
+        mask = np.ones(self.n_users, dtype=bool)
+        if status is not None:
+            mask &= self.status == STATUSES.index(status)
+        if mccs is not None:
+            mask &= np.isin(self.mcc, get_mcc_codes(mccs))
+        return mask
+
+    def present_on(self, d):
+        """
+        Returns a boolean mask over users present on day d.
+        """
+        return self._day_flags(self.present, self.get_ind_date(d))
+
+    def observed_on(self, d):
+        """
+        Returns a boolean mask over users observed on day d.
+        """
+        return self._day_flags(self.observed, self.get_ind_date(d))
+
+    def users_present(self, d, status=None, mccs=None):
+        """
+        Returns the imsis of users present on day d, optionally restricted to a status and mccs.
+        """
+        return np.asarray(self.imsi[self.present_on(d) & self.get_user_mask(status, mccs)])
+
+    def users_observed(self, d, status=None, mccs=None):
+        """
+        Returns the imsis of users observed on day d, optionally restricted to a status and mccs.
+        """
+        return np.asarray(self.imsi[self.observed_on(d) & self.get_user_mask(status, mccs)])
+
+    def count_by_group(self, start, end, group_codes, n_groups, observed=False):
+        """
+        Returns an array (days x groups) of the number of users present (or observed)
+        on each day from start to end (inclusive), by group.
+        group_codes: group of each user in [0, n_groups), or -1 to ignore the user.
+        """
+        ind_start, ind_end = self.get_ind_date(start), self.get_ind_date(end)
+        flags = self.observed if observed else self.present
+        group_codes = np.asarray(group_codes)
+        keep = group_codes >= 0
+        counts = np.zeros((ind_end - ind_start + 1, n_groups), dtype=np.int64)
+        for i, ind_date in enumerate(range(ind_start, ind_end + 1)):
+            day_mask = self._day_flags(flags, ind_date) & keep
+            counts[i] = np.bincount(group_codes[day_mask], minlength=n_groups)
+        return counts
+
+    def count_present(self, start=None, end=None, by=None, observed=False):
+        """
+        Returns a dataframe of the number of users present (or observed) on each day
+        from start to end (inclusive), with a column per group.
+        by: None (one 'all' column), 'status' or 'mcc'
+        """
+        start = 0 if start is None else start
+        end = self.n_days - 1 if end is None else end
+        if by is None:
+            group_codes, groups = np.zeros(self.n_users, dtype=np.int64), ['all']
+        elif by == STATUS:
+            group_codes, groups = self.status.astype(np.int64), STATUSES
+        elif by == MCC:
+            groups, group_codes = np.unique(np.asarray(self.mcc), return_inverse=True)
+        else:
+            raise ValueError('by must be None, %s or %s' % (STATUS, MCC))
+        counts = self.count_by_group(start, end, group_codes, len(groups), observed=observed)
+        index = self.dates[self.get_ind_date(start):self.get_ind_date(end) + 1].rename(DATE)
+        return pd.DataFrame(counts, index=index, columns=list(groups))
+
+    def get_user_codes(self, imsis):
+        """
+        Returns the position of each imsi in the store, or -1 for imsis not in the store.
+        """
+        if self._imsi_index is None:
+            self._imsi_index = pd.Index(np.asarray(self.imsi))
+        return self._imsi_index.get_indexer(np.asarray(imsis).astype(self.imsi.dtype))
+
+    def residents(self):
+        return np.asarray(self.imsi[self.status == STATUSES.index(RESIDENT)])
+
+    def tourists(self):
+        return np.asarray(self.imsi[self.status == STATUSES.index(TOURIST)])
+
+    def is_resident(self, imsis):
+        """
+        Returns a boolean array: whether each imsi is a resident (False if not in the store).
+        """
+        codes = self.get_user_codes(imsis)
+        return (codes >= 0) & (self.status[codes] == STATUSES.index(RESIDENT))
+
+    def is_tourist(self, imsis):
+        codes = self.get_user_codes(imsis)
+        return (codes >= 0) & (self.status[codes] == STATUSES.index(TOURIST))
+
+    def get_presence_df(self, status=None):
+        """
+        Returns the presence table in the format of the presence csv tables:
+        1 row per imsi, 1 column per date, 0: absent, 1: present, 2: present and observed.
+        """
+        mask = self.get_user_mask(status)
+        present = np.unpackbits(self.present[mask], axis=1, count=self.n_days)
+        observed = np.unpackbits(self.observed[mask], axis=1, count=self.n_days)
+        return pd.DataFrame(present + observed, index=np.asarray(self.imsi[mask]), columns=self.dates)
+
+
+def merge_stores(store_filepaths, filepath):
+    """
+    Concatenates stores with the same dates into one store.
+    """
+    metas = [json.load(open(Path(fpath) / META)) for fpath in store_filepaths]
+    # empty stores carry no imsis, so their imsi dtype is not meaningful
+    non_empty = [(fpath, m) for fpath, m in zip(store_filepaths, metas) if m['n_users'] > 0]
+    if non_empty:
+        store_filepaths, metas = [fpath for fpath, _ in non_empty], [m for _, m in non_empty]
+    assert all(m['dates'] == metas[0]['dates'] for m in metas), 'stores must have the same dates'
+    assert all(m['imsi_dtype'] == metas[0]['imsi_dtype'] for m in metas), 'stores must have the same imsi dtype'
+    Path(filepath).mkdir(parents=True, exist_ok=True)
+    # meta.json is written last, so that an interrupted merge does not look complete
+    remove_meta(filepath)
+    for name in [IMSI, MCC, STATUS, PRESENT, OBSERVED]:
+        with open(Path(filepath) / ('%s.bin' % name), 'wb') as output_f:
+            for fpath in store_filepaths:
+                with open(Path(fpath) / ('%s.bin' % name), 'rb') as f:
+                    shutil.copyfileobj(f, output_f)
+    write_meta(filepath, metas[0]['dates'], sum(m['n_users'] for m in metas),
+               np.dtype(metas[0]['imsi_dtype']))
+
+
+def write_store_from_presence_csvs(presence_filepaths_by_status, filepath, mcc_by_imsi=None):
+    """
+    Converts presence csv tables to a store, reading them in chunks.
+    presence_filepaths_by_status: {TOURIST: path, RESIDENT: path}
+    mcc_by_imsi: optional series mapping imsi to mcc. MCCs are stored as unknown otherwise.
+    """
+    writer = None
+    for status, fpath in presence_filepaths_by_status.items():
+        n_users = 0
+        for chunk in pd.read_csv(fpath, index_col=0, chunksize=CSV_CHUNKSIZE):
+            if writer is None:
+                imsi_dtype = 'int64' if pd.api.types.is_integer_dtype(chunk.index) else 'S'
+                writer = PresenceStoreWriter(filepath, pd.to_datetime(chunk.columns), imsi_dtype)
+            mccs = (chunk.index.map(mcc_by_imsi).values if mcc_by_imsi is not None
+                    else np.full(len(chunk), UNKNOWN_MCC))
+            writer.write(chunk.index.values, mccs, status, chunk.values)
+            n_users += len(chunk)
+            print('%s: wrote %s %s users' % (filepath, n_users, status))
+    if writer is None:
+        if not presence_filepaths_by_status:
+            raise ValueError('no presence tables to convert to %s' % filepath)
+        # tables without users: an empty store with the dates of their header
+        dates = pd.read_csv(next(iter(presence_filepaths_by_status.values())), index_col=0, nrows=0).columns
+        writer = PresenceStoreWriter(filepath, pd.to_datetime(dates))
+    writer.close()
+    return PresenceStore.open(filepath)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Converts presence csv tables to a bit-packed presence store.')
+    parser.add_argument('--presence_tourists_filepath', required=True)
+    parser.add_argument('--presence_others_filepath', required=True)
+    parser.add_argument('--store_filepath', required=True,
+                        help='/path/to/presence.store')
+    args = parser.parse_args()
+    write_store_from_presence_csvs({
+        TOURIST: args.presence_tourists_filepath,
+        RESIDENT: args.presence_others_filepath,
+    }, args.store_filepath)
+    print('saved presence store to %s' % args.store_filepath)
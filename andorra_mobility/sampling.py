@@ -0,0 +1,189 @@
+"""
+Sampling
+-------------
+Deterministic sampling of users for fast approximate runs of the stages.
+
+A user is kept at sample rate p if a stable 64-bit hash of their IMSI, as a fraction
+of 2**64, is below p. The hash only depends on the IMSI, so the same users are kept
+on every day, in every stage and in every process, and the user-level logic
+(presence gaps, home inference, tourist status) is unchanged for the users kept.
+Samples are nested: the users of a 1% sample are in the 5% sample.
+
+The hash is the 64-bit finalizer of MurmurHash3 applied to the IMSI (as an integer)
+XOR SALT. It is independent of the pandas hash of the presence shards and of the
+distinct user sketches (see sketches.py), so a sample is spread evenly over shards
+and sketch registers. IMSIs that are not integers are hashed with blake2b.
+get_stays.py keeps a copy of imsi_hash for the Spark executors: change both.
+
+The sample rate is set once per run (set_sample_rate, from --sample_rate, see
+add_sampling_args), and applied when the inputs are read (see inputs.py).
+
+Estimates: each user is kept independently with probability p (Bernoulli sampling),
+so for n users of the sample with a property, and values y of the users of the sample,
+    count:  n / p                  standard error  sqrt((1 - p) * n) / p
+    total:  sum(y) / p             standard error  sqrt((1 - p) * sum(y**2)) / p
+    mean:   mean(y), unscaled      standard error  sqrt((1 - p) * sum((y - mean(y))**2)) / n
+About 95% of estimates are within 2 standard errors. Standard error columns are named
+'{column} se'. At sample rate 1 the outputs are unchanged, without standard errors.
+
+Example usage:
+
+    set_sample_rate(0.05)
+    stays_df = read_csv(stays_filepath)                     # the stays of 5% of users
+    users, users_se = scale_count(stays_df['imsi'].nunique(), get_sample_rate())
+
+"""
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+IMSI = 'imsi'
+
+DEFAULT_SAMPLE_RATE = 1.0
+SE_SUFFIX = ' se'
+
+SALT = 0x5BD1E9955BD1E995
+FMIX_1 = 0xFF51AFD7ED558CCD
+FMIX_2 = 0xC4CEB9FE1A85EC53
+MASK_64 = (1 << 64) - 1
+# hashes are compared to the sample rate on their 53 high bits, exactly in float64
+FRACTION_BITS = 53
+
+_sample_rate = DEFAULT_SAMPLE_RATE
+
+
+def set_sample_rate(sample_rate):
+    """
+    Sets the sample rate of the users read in this process, in (0, 1].
+    """
+    global _sample_rate
+    sample_rate = float(sample_rate)
+    if not 0 < sample_rate <= 1:
+        raise ValueError('sample_rate must be in (0, 1], got %s' % sample_rate)
+    _sample_rate = sample_rate
+    return _sample_rate
+
+
+def get_sample_rate():
+    return _sample_rate
+
+
+def imsi_hash(imsi):
+    """
+    Returns the 64-bit sampling hash of an imsi (an integer or a string).
+    """
+    try:
+        x = int(imsi)
+    except ValueError:
+        return int.from_bytes(hashlib.blake2b(str(imsi).encode(), digest_size=8,
+                                              key=SALT.to_bytes(8, 'little')).digest(), 'little')
+    x = (x ^ SALT) & MASK_64
+    x = ((x ^ (x >> 33)) * FMIX_1) & MASK_64
+    x = ((x ^ (x >> 33)) * FMIX_2) & MASK_64
+    return x ^ (x >> 33)
+
+
+def is_sampled(imsi, sample_rate):
+    """
+    Returns whether an imsi is kept at sample_rate.
+    """
+    return sample_rate >= 1 or (imsi_hash(imsi) >> (64 - FRACTION_BITS)) / 2.0 ** FRACTION_BITS < sample_rate
+
+
+def get_imsi_hashes(imsis):
+    """
+    Returns the sampling hash (uint64) of each imsi, as imsi_hash.
+    """
+    codes, uniques = pd.factorize(np.asarray(imsis))
+    uniques = np.asarray(uniques)
+    if uniques.dtype.kind in 'iu':
+        x = uniques.astype(np.int64).view(np.uint64) ^ np.uint64(SALT)
+        with np.errstate(over='ignore'):
+            x = (x ^ (x >> np.uint64(33))) * np.uint64(FMIX_1)
+            x = (x ^ (x >> np.uint64(33))) * np.uint64(FMIX_2)
+        unique_hashes = x ^ (x >> np.uint64(33))
+    else:
+        unique_hashes = np.array([imsi_hash(imsi) for imsi in uniques.tolist()], dtype=np.uint64)
+    return unique_hashes[codes]
+
+
+def get_sample_mask(imsis, sample_rate):
+    """
+    Returns a boolean array of whether each imsi is kept at sample_rate.
+    """
+    if sample_rate >= 1:
+        return np.ones(len(imsis), dtype=bool)
+    fractions = (get_imsi_hashes(imsis) >> np.uint64(64 - FRACTION_BITS)).astype(np.float64) / 2.0 ** FRACTION_BITS
+    return fractions < sample_rate
+
+
+def sample_users(df, sample_rate=None, column=IMSI):
+    """
+    Returns the rows of df of the users kept at sample_rate (the run's sample rate by default).
+    """
+    sample_rate = get_sample_rate() if sample_rate is None else sample_rate
+    if sample_rate >= 1:
+        return df
+    return df[get_sample_mask(df[column].values, sample_rate)].reset_index(drop=True)
+
+
+def get_buckets(imsis, n_buckets):
+    """
+    Returns a bucket in [0, n_buckets) for each imsi, from the low bits of its sampling hash,
+    which are independent of whether it is sampled, e.g. for delete-a-group jackknife replicates.
+    """
+    return (get_imsi_hashes(imsis) % np.uint64(n_buckets)).astype(np.int64)
+
+
+def scale_count(n, sample_rate):
+    """
+    Returns (estimate, standard error) of a number of users from the n users of the sample.
+    """
+    n = np.asarray(n, dtype=np.float64)
+    return n / sample_rate, np.sqrt((1 - sample_rate) * n) / sample_rate
+
+
+def scale_total(values, sample_rate):
+    """
+    Returns (estimate, standard error) of the total of values over all users
+    from the values of the users of the sample.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return values.sum() / sample_rate, np.sqrt((1 - sample_rate) * (values ** 2).sum()) / sample_rate
+
+
+def get_mean_standard_error(values, sample_rate):
+    """
+    Returns the standard error of the mean of values per user, from the values of the users of the sample.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return np.nan
+    return np.sqrt((1 - sample_rate) * ((values - values.mean()) ** 2).sum()) / len(values)
+
+
+def get_se_column(column):
+    return '%s%s' % (column, SE_SUFFIX)
+
+
+def scale_counts(df, columns, sample_rate):
+    """
+    Scales the numbers of users in columns of df up to all users, in place,
+    and adds a standard error column after the columns of df for each. No-op at sample rate 1.
+    """
+    if sample_rate >= 1:
+        return df
+    for column in columns:
+        df[column], df[get_se_column(column)] = scale_count(df[column].values, sample_rate)
+    return df
+
+
+def add_sampling_args(parser):
+    """
+    Adds the --sample_rate command line option to an argparse parser.
+    """
+    parser.add_argument('--sample_rate', type=float, default=DEFAULT_SAMPLE_RATE,
+                        help='fraction of users to keep, by a stable hash of their IMSI. Counts are '
+                             'scaled up to all users, with standard errors. Defaults to all users.')
+    return parser
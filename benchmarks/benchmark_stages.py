@@ -0,0 +1,287 @@
+"""
+Benchmark stages
+-------------
+Times and memory-profiles each pipeline stage on synthetic data
+(see synthetic_data.py) at several population sizes, so that throughput can be
+tracked and performance regressions caught before deploying to the server.
+
+Stages:
+    stay_points       get_stays.get_stay_points over one day of raw observations
+    stays_by_parish   preprocessing_stays_by_parish.get_stays_by_parish_df over one day of JSON stays
+    trips             trips.get_trips_df over all days
+    presence          presence_entrances_departures.get_days_observed and
+                      get_presence_entrances_departures_dfs (infer_days_present) over all days
+    homes             infer_homes.process_stays_data over all days
+    h3_interactions   h3_tools.get_h3_cells_by_interval and
+                      count_interactions_kring_all_intervals over one day of JSON stays
+
+Each stage runs in a fresh process so that its peak RSS can be measured in isolation.
+Inputs are loaded before the stage is timed; input_rss_mb is the peak RSS after loading
+inputs and peak_rss_mb is the peak RSS after running the stage.
+
+Some stages scale poorly (e.g. stays_by_parish appends one dataframe per person), so
+the largest scales may take hours for them: use --stages to select stages.
+
+The stages are imported from the installed package (pip install -e . from the repository root).
+
+Usage:
+python benchmark_stages.py \
+    [--scales=10000,100000,1000000] \
+    [--n_days=INT] \
+    [--stages=STAGE,...] \
+    [--data_filepath=PATH] \
+    [--outputs_filepath=PATH] \
+    [--baseline=PATH] \
+    [--tolerance=FLOAT]
+
+Example usage:
+python benchmark_stages.py --scales=10000,100000 --n_days=14 \
+    --outputs_filepath=./benchmark_results.json
+
+Compare against a previous run and exit with an error if any stage slowed down
+by more than 20%:
+python benchmark_stages.py --scales=10000 \
+    --baseline=./benchmark_results.json --tolerance=0.2
+
+Saves results as JSON to outputs_filepath:
+-------------
+[{stage, n_users, n_days, seconds, rows_in, rows_out, rows_per_second, input_rss_mb, peak_rss_mb}, ...]
+
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import json
+import multiprocessing
+from pathlib import Path
+import resource
+import sys
+import tempfile
+import time
+
+from synthetic_data import (SyntheticPopulation, get_raw_lines, write_synthetic_data,
+                            DEFAULT_START_DATE, DEFAULT_TOURIST_FRACTION, DEFAULT_OBSERVATIONS_PER_HOUR,
+                            JSON, CSV)
+
+
+REPO_PATH = Path(__file__).resolve().parent.parent
+# the stages are imported from the installed package (pip install -e .), except the Spark job,
+# which is submitted as a script rather than installed
+sys.path.append(str(REPO_PATH / 'preprocessing/stays/hadoop'))
+
+SHAPEFILEPATH = str(REPO_PATH / 'data/public/shapefiles/andorra_parish.shp')
+
+DEFAULT_SCALES = [10000, 100000, 1000000]
+DEFAULT_N_DAYS = 7
+DEFAULT_TOLERANCE = 0.2
+
+H3_RESOLUTION = 11
+H3_CELL_RADIUS = 1
+
+STAGE = 'stage'
+N_USERS = 'n_users'
+N_DAYS = 'n_days'
+SECONDS = 'seconds'
+ROWS_IN = 'rows_in'
+ROWS_OUT = 'rows_out'
+ROWS_PER_SECOND = 'rows_per_second'
+INPUT_RSS_MB = 'input_rss_mb'
+PEAK_RSS_MB = 'peak_rss_mb'
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_stays_csv_filepaths(population, data_filepath):
+    from andorra_mobility.paths import get_stays_filepath
+    return [get_stays_filepath(data_filepath, d.day, d.month, d.year) for d in population.dates]
+
+
+def count_csv_rows(fpaths):
+    return sum(sum(1 for _ in open(fpath)) - 1 for fpath in fpaths)
+
+
+# Each setup function loads a stage's inputs and returns (run, rows_in),
+# where run() executes the stage and returns the number of output rows.
+
+def setup_stay_points(population, data_filepath):
+    import get_stays
+    lines = get_raw_lines(population.get_day_raw(0))
+    rows_in = sum(len(line[1][0]) for line in lines)
+    def run():
+        persons = [get_stays.get_stay_points(line) for line in lines]
+        return sum(len(p['stay_points']) for p in persons)
+    return run, rows_in
+
+
+def setup_stays_by_parish(population, data_filepath):
+    import geopandas as gpd
+    from preprocessing.stays import preprocessing_stays_by_parish as sbp
+    persons = population.get_day_persons(0)
+    parish_shps = gpd.read_file(SHAPEFILEPATH).to_crs({'init': sbp.CRS})
+    parish_shps = parish_shps.rename(columns={'NAME_1': sbp.PARISH_NAME})[[sbp.PARISH_NAME, sbp.GEOMETRY]]
+    def run():
+        return len(sbp.get_stays_by_parish_df(persons, parish_shps))
+    return run, len(persons)
+
+
+def setup_trips(population, data_filepath):
+    from preprocessing.trips import trips
+    def run():
+        trips_df, _ = trips.get_trips_df(data_filepath, population.dates)
+        return len(trips_df)
+    return run, count_csv_rows(get_stays_csv_filepaths(population, data_filepath))
+
+
+def setup_presence(population, data_filepath):
+    from preprocessing.presence import presence_entrances_departures as ped
+    def run():
+        all_persons_summary, ind_missing_dates = ped.get_days_observed(data_filepath, population.dates)
+        presence_df, _ = ped.get_presence_entrances_departures_dfs(
+            population.dates, all_persons_summary, ind_missing_dates, ped.DEFAULT_WINDOW)
+        return len(presence_df)
+    return run, count_csv_rows(get_stays_csv_filepaths(population, data_filepath))
+
+
+def setup_homes(population, data_filepath):
+    from preprocessing.homes import infer_homes
+    fpaths = get_stays_csv_filepaths(population, data_filepath)
+    def run():
+        return len(infer_homes.process_stays_data(fpaths))
+    return run, count_csv_rows(fpaths)
+
+
+def setup_h3_interactions(population, data_filepath):
+    from analysis import h3_tools, toolbox
+    persons = population.get_day_persons(0)
+    intervals, T = toolbox.create_intervals()
+    def run():
+        stay_ind_by_interval, cell_ids_by_stay_ind = h3_tools.get_h3_cells_by_interval(
+            H3_RESOLUTION, intervals, T, persons)
+        h3_tools.count_interactions_kring_all_intervals(
+            H3_CELL_RADIUS, stay_ind_by_interval, cell_ids_by_stay_ind)
+        return len(cell_ids_by_stay_ind)
+    return run, len(persons)
+
+
+STAGES = {
+    'stay_points': setup_stay_points,
+    'stays_by_parish': setup_stays_by_parish,
+    'trips': setup_trips,
+    'presence': setup_presence,
+    'homes': setup_homes,
+    'h3_interactions': setup_h3_interactions,
+}
+
+
+def benchmark_stage(stage, population_kwargs, data_filepath):
+    """
+    Runs one stage and returns its measurements.
+    Meant to be run in a fresh process, so that peak RSS is for this stage only.
+    """
+    population = SyntheticPopulation(**population_kwargs)
+    run, rows_in = STAGES[stage](population, data_filepath)
+    input_rss_mb = get_peak_rss_mb()
+    then = time.perf_counter()
+    rows_out = run()
+    seconds = time.perf_counter() - then
+    return {
+        STAGE: stage,
+        N_USERS: population.n_users,
+        N_DAYS: population.n_days,
+        SECONDS: seconds,
+        ROWS_IN: rows_in,
+        ROWS_OUT: rows_out,
+        ROWS_PER_SECOND: rows_in / seconds if seconds > 0 else float('nan'),
+        INPUT_RSS_MB: input_rss_mb,
+        PEAK_RSS_MB: get_peak_rss_mb(),
+    }
+
+
+def run_benchmarks(scales, n_days, stages, data_filepath, seed=0):
+    results = []
+    mp_context = multiprocessing.get_context('fork')
+    for n_users in scales:
+        population_kwargs = {
+            'n_users': n_users, 'n_days': n_days, 'start_date': DEFAULT_START_DATE,
+            'tourist_fraction': DEFAULT_TOURIST_FRACTION,
+            'observations_per_hour': DEFAULT_OBSERVATIONS_PER_HOUR, 'seed': seed,
+        }
+        scale_filepath = '%s%s_users/' % (data_filepath, n_users)
+        if not Path(scale_filepath).is_dir():
+            print('generating synthetic data for %s users : %s' % (n_users, datetime.now()))
+            write_synthetic_data(SyntheticPopulation(**population_kwargs), scale_filepath, (JSON, CSV))
+        for stage in stages:
+            print('benchmarking %s for %s users : %s' % (stage, n_users, datetime.now()))
+            with ProcessPoolExecutor(max_workers=1, mp_context=mp_context) as executor:
+                result = executor.submit(benchmark_stage, stage, population_kwargs, scale_filepath).result()
+            print('%s for %s users: %.2fs, %.0f rows/s, peak RSS %.0f MB' % (
+                stage, n_users, result[SECONDS], result[ROWS_PER_SECOND], result[PEAK_RSS_MB]))
+            results.append(result)
+    return results
+
+
+def find_regressions(results, baseline_results, tolerance=DEFAULT_TOLERANCE):
+    """
+    Returns the results whose time exceeds the matching baseline result's time by more than tolerance.
+    """
+    baseline = {(r[STAGE], r[N_USERS], r[N_DAYS]): r for r in baseline_results}
+    regressions = []
+    for r in results:
+        b = baseline.get((r[STAGE], r[N_USERS], r[N_DAYS]))
+        if b is not None and r[SECONDS] > b[SECONDS] * (1 + tolerance):
+            regressions.append((r, b))
+    return regressions
+
+
+def print_results_table(results):
+    columns = [STAGE, N_USERS, N_DAYS, SECONDS, ROWS_PER_SECOND, INPUT_RSS_MB, PEAK_RSS_MB]
+    print(' '.join('%16s' % c for c in columns))
+    for r in results:
+        print(' '.join('%16s' % (('%.2f' % r[c]) if isinstance(r[c], float) else r[c]) for c in columns))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Times and memory-profiles each pipeline stage on synthetic data.')
+    parser.add_argument('--scales', default=','.join(str(s) for s in DEFAULT_SCALES),
+                        help='comma separated numbers of users')
+    parser.add_argument('--n_days', type=int, default=DEFAULT_N_DAYS)
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='comma separated subset of %s' % ','.join(STAGES))
+    parser.add_argument('--data_filepath', default=None,
+                        help='/path/to/synthetic/data/ (reused across runs). Defaults to a temporary directory.')
+    parser.add_argument('--outputs_filepath', default=None,
+                        help='/path/to/results.json')
+    parser.add_argument('--baseline', default=None,
+                        help='/path/to/baseline/results.json to compare against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed fractional slowdown relative to the baseline')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    scales = [int(s) for s in args.scales.split(',')]
+    stages = args.stages.split(',')
+    assert all(s in STAGES for s in stages), 'unknown stage in %s' % args.stages
+    if args.data_filepath is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        data_filepath = tmp_dir.name + '/'
+    else:
+        data_filepath = args.data_filepath
+    print('--- benchmarking %s for %s users over %s days ---' % (stages, scales, args.n_days))
+    results = run_benchmarks(scales, args.n_days, stages, data_filepath, seed=args.seed)
+    print_results_table(results)
+    if args.outputs_filepath is not None:
+        print('saving results to %s' % args.outputs_filepath)
+        json.dump(results, open(args.outputs_filepath, 'w'), indent=1)
+    if args.baseline is not None:
+        regressions = find_regressions(results, json.load(open(args.baseline)), args.tolerance)
+        for r, b in regressions:
+            print('REGRESSION %s for %s users: %.2fs (baseline %.2fs)' % (
+                r[STAGE], r[N_USERS], r[SECONDS], b[SECONDS]))
+        if regressions:
+            sys.exit(1)
+        print('no regressions')
@@ -0,0 +1,428 @@
+"""
+Synthetic data
+-------------
+Generates synthetic mobile phone data that mimics the private data used by the
+preprocessing stages, so that the pipeline can be benchmarked and regression
+tested outside of the secure server.
+
+Users are placed within the Andorra parish boundaries
+(data/public/shapefiles/andorra_parish.geojson). Each user is either a
+resident, observed on most days with occasional absences, or a tourist,
+present for a short visit (fewer than 50 days).
+Each day, every present user has a sequence of stays (home, other places, home)
+and raw observations are generated within each stay.
+
+Four kinds of outputs can be produced for each day:
+
+- raw: raw RNC observations, as read by get_stays.py, with columns
+    imsi, timestamp, lat, lon, mcc, 4G, cellid
+- json: stays in the format produced by get_stays.py / parquet_to_json.py
+    [{imsi, mcc, stay_points: [{p, s, l, e, n, n_4G}, ...]}, ...]
+- csv: stays by parish, as produced by preprocessing_stays_by_parish.py, with columns
+    imsi, s, l, e, n, n_4G, lon, lat, mcc, parish
+- hdfs: stays as saved on HDFS by get_stays.py (saveAsTextFile), one person per line in
+    part files, to test parquet_to_json.py with local_hdfs.py
+
+
+Usage:
+python synthetic_data.py \
+    --outputs_filepath=PATH \
+    [--n_users=INT] \
+    [--start_date=yyyy-mm-dd] \
+    [--n_days=INT] \
+    [--tourist_fraction=FLOAT] \
+    [--observations_per_hour=FLOAT] \
+    [--formats=raw,json,csv,hdfs] \
+    [--seed=INT]
+
+Example usage:
+python synthetic_data.py \
+    --outputs_filepath=/tmp/synthetic/ \
+    --n_users=10000 \
+    --start_date=2020-03-01 \
+    --n_days=30
+
+
+The output files are saved in the same layout as the private data:
+    outputs_filepath/stays/YYYY_M/stays_YYYY_M_D.json
+    outputs_filepath/stays/YYYY_M/stays_YYYY_M_D.csv
+    outputs_filepath/raw/YYYY_M/raw_YYYY_M_D.csv
+    outputs_filepath/hdfs/stays_YYYY_M_D/part-NNNNN
+
+"""
+from datetime import datetime, timedelta
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+IMSI = 'imsi'
+MCC = 'mcc'
+START = 's'
+LAST = 'l'
+END = 'e'
+N = 'n'
+N4G = 'n_4G'
+LAT = 'lat'
+LON = 'lon'
+PARISH = 'parish'
+TIMESTAMP = 'timestamp'
+IS_4G = '4G'
+CELLID = 'cellid'
+
+date_fmt = '%Y-%m-%d'
+
+RAW = 'raw'
+JSON = 'json'
+CSV = 'csv'
+HDFS = 'hdfs'
+FORMATS = [RAW, JSON, CSV, HDFS]
+DEFAULT_FORMATS = [RAW, JSON, CSV]
+
+N_HDFS_PARTS = 4
+
+default_shapefilepath = str(
+    Path(__file__).resolve().parent.parent / 'data/public/shapefiles/andorra_parish.geojson')
+
+DEFAULT_N_USERS = 10000
+DEFAULT_N_DAYS = 7
+DEFAULT_START_DATE = '2020-03-01'
+DEFAULT_TOURIST_FRACTION = 0.4
+DEFAULT_OBSERVATIONS_PER_HOUR = 2.0
+
+# residents are not observed on some days, and some leave the country for a while
+RESIDENT_DAILY_OBSERVED_PROB = 0.85
+RESIDENT_ABSENCE_PROB = 0.1
+RESIDENT_MAX_ABSENCE_DAYS = 30
+# tourists stay for fewer than 50 days
+TOURIST_MAX_STAY_DAYS = 49
+TOURIST_DAILY_OBSERVED_PROB = 0.95
+# mean number of stays away from home per day
+MEAN_TRIPS = 1.5
+MAX_STAYS = 8
+# stays are jittered around places by up to this many meters (less than MAX_ROAM in get_stays.py)
+MAX_JITTER_M = 50
+METERS_PER_DEGREE = 111320
+FRACTION_4G = 0.6
+# tower 14 is filtered out by get_stays.py
+FILTERED_CELLID = '14'
+FILTERED_CELLID_PROB = 0.01
+N_CELLIDS = 500
+N_PLACES = 20000
+# 's','e' are seconds since 12am
+S_END_OF_DAY = 24*60*60 - 1
+
+RESIDENT_MCC = 213
+# MCC weights for tourists: Spanish, French, British, Dutch, other
+TOURIST_MCCS = [214, 208, 234, 204, 222, 262, 310]
+TOURIST_MCC_WEIGHTS = [0.55, 0.3, 0.05, 0.03, 0.03, 0.02, 0.02]
+RESIDENT_FOREIGN_MCC_PROB = 0.1
+
+
+def get_stays_filepath(data_filepath, day, month, year, ext):
+    return '{}stays/{}_{}/stays_{}_{}_{}.{}'.format(data_filepath, year, month, year, month, day, ext)
+
+def get_raw_filepath(data_filepath, day, month, year):
+    return '{}raw/{}_{}/raw_{}_{}_{}.csv'.format(data_filepath, year, month, year, month, day)
+
+def get_hdfs_stays_filepath(data_filepath, day, month, year):
+    return '{}hdfs/stays_{}_{}_{}/'.format(data_filepath, year, month, day)
+
+def daterange(start_datetime, end_datetime):
+    for n in range(int((end_datetime - start_datetime).days) + 1):
+        yield start_datetime + timedelta(n)
+
+
+def load_parish_polygons(shapefilepath=default_shapefilepath):
+    """
+    Returns {parish name: [exterior ring as (N, 2) array of lon, lat]}
+    """
+    geojson = json.load(open(shapefilepath))
+    parish_polygons = {}
+    for feature in geojson['features']:
+        name = feature['properties']['NAME_1']
+        geometry = feature['geometry']
+        polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+        parish_polygons[name] = [np.array(polygon[0], dtype=float) for polygon in polygons]
+    return parish_polygons
+
+
+def points_in_ring(lon, lat, ring):
+    """
+    Vectorized ray casting test for points inside a polygon ring.
+    """
+    inside = np.zeros(len(lon), dtype=bool)
+    x0, y0 = ring[:-1, 0], ring[:-1, 1]
+    x1, y1 = ring[1:, 0], ring[1:, 1]
+    for i in range(len(x0)):
+        crosses = (y0[i] > lat) != (y1[i] > lat)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x0[i] + (lat - y0[i]) * (x1[i] - x0[i]) / (y1[i] - y0[i])
+        inside ^= crosses & (lon < x_cross)
+    return inside
+
+
+def sample_places(parish_polygons, n_places, rng):
+    """
+    Samples places uniformly within the parish boundaries.
+    Returns lon, lat, parish_ind arrays, where parish_ind indexes sorted(parish_polygons).
+    """
+    parishes = sorted(parish_polygons)
+    rings = [(p_ind, ring) for p_ind, p in enumerate(parishes) for ring in parish_polygons[p]]
+    all_coords = np.concatenate([ring for _, ring in rings])
+    (min_lon, min_lat), (max_lon, max_lat) = all_coords.min(axis=0), all_coords.max(axis=0)
+    lons, lats, parish_inds = [], [], []
+    n_sampled = 0
+    while n_sampled < n_places:
+        lon = rng.uniform(min_lon, max_lon, n_places)
+        lat = rng.uniform(min_lat, max_lat, n_places)
+        parish_ind = np.full(n_places, -1)
+        for p_ind, ring in rings:
+            parish_ind[points_in_ring(lon, lat, ring)] = p_ind
+        keep = parish_ind >= 0
+        lons.append(lon[keep])
+        lats.append(lat[keep])
+        parish_inds.append(parish_ind[keep])
+        n_sampled += keep.sum()
+    return (np.concatenate(lons)[:n_places], np.concatenate(lats)[:n_places],
+            np.concatenate(parish_inds)[:n_places])
+
+
+class SyntheticPopulation:
+    """
+    A synthetic population of users with homes, usual places and presence periods.
+
+    Generates each day's data deterministically from the seed, so that
+    repeated runs produce identical files.
+    """
+
+    def __init__(self, n_users=DEFAULT_N_USERS, n_days=DEFAULT_N_DAYS,
+                 start_date=DEFAULT_START_DATE,
+                 tourist_fraction=DEFAULT_TOURIST_FRACTION,
+                 observations_per_hour=DEFAULT_OBSERVATIONS_PER_HOUR,
+                 shapefilepath=default_shapefilepath, seed=0):
+        self.n_users = n_users
+        self.n_days = n_days
+        self.start_date = datetime.strptime(start_date, date_fmt) if isinstance(start_date, str) else start_date
+        self.dates = [d for d in daterange(self.start_date, self.start_date + timedelta(n_days - 1))]
+        self.tourist_fraction = tourist_fraction
+        self.observations_per_hour = observations_per_hour
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+
+        parish_polygons = load_parish_polygons(shapefilepath)
+        self.parishes = np.array(sorted(parish_polygons))
+        self.place_lon, self.place_lat, self.place_parish = sample_places(
+            parish_polygons, min(N_PLACES, max(100, n_users)), rng)
+        n_places = len(self.place_lon)
+
+        # users
+        self.imsi = rng.choice(10**12, size=n_users, replace=False).astype(np.int64) + 2 * 10**14
+        self.is_tourist = rng.random(n_users) < tourist_fraction
+        mcc = np.full(n_users, RESIDENT_MCC)
+        foreign_mccs = rng.choice(TOURIST_MCCS, size=n_users, p=TOURIST_MCC_WEIGHTS)
+        use_foreign = self.is_tourist | (rng.random(n_users) < RESIDENT_FOREIGN_MCC_PROB)
+        mcc[use_foreign] = foreign_mccs[use_foreign]
+        self.mcc = mcc
+        self.home = rng.integers(0, n_places, n_users)
+        self.work = rng.integers(0, n_places, n_users)
+
+        # presence: day indices [first, last) for tourists, with an optional absence for residents
+        present = np.ones((n_users, n_days), dtype=bool)
+        day_ind = np.arange(n_days)
+        tourist_first = rng.integers(-TOURIST_MAX_STAY_DAYS, n_days, n_users)
+        tourist_length = rng.integers(1, TOURIST_MAX_STAY_DAYS + 1, n_users)
+        tourist_present = ((day_ind[None, :] >= tourist_first[:, None]) &
+                           (day_ind[None, :] < (tourist_first + tourist_length)[:, None]))
+        present[self.is_tourist] = tourist_present[self.is_tourist]
+        absent = (~self.is_tourist) & (rng.random(n_users) < RESIDENT_ABSENCE_PROB)
+        absence_first = rng.integers(0, n_days, n_users)
+        absence_length = rng.integers(1, RESIDENT_MAX_ABSENCE_DAYS + 1, n_users)
+        absence = ((day_ind[None, :] >= absence_first[:, None]) &
+                   (day_ind[None, :] < (absence_first + absence_length)[:, None]))
+        present[absent] &= ~absence[absent]
+        observed_prob = np.where(self.is_tourist, TOURIST_DAILY_OBSERVED_PROB, RESIDENT_DAILY_OBSERVED_PROB)
+        self.observed = present & (rng.random((n_users, n_days)) < observed_prob[:, None])
+
+    def day_rng(self, ind_day, stream=0):
+        return np.random.default_rng([self.seed, stream, ind_day])
+
+    def get_day_stays(self, ind_day):
+        """
+        Returns a dataframe with one row per stay for the users observed on the day.
+        Columns: imsi, s, l, e, n, n_4G, lon, lat, mcc, parish
+        Rows are ordered by user and stay start time.
+        """
+        rng = self.day_rng(ind_day)
+        users = np.flatnonzero(self.observed[:, ind_day])
+        n_stays = np.minimum(2 + rng.poisson(MEAN_TRIPS, len(users)), MAX_STAYS)
+        # with probability 0.2 a user stays at one place all day
+        n_stays[rng.random(len(users)) < 0.2] = 1
+        stay_user = np.repeat(users, n_stays)
+        first_stay = np.repeat(np.cumsum(n_stays) - n_stays, n_stays)
+        ind_stay = np.arange(len(stay_user)) - first_stay
+        is_last = ind_stay == np.repeat(n_stays - 1, n_stays)
+        # places: first and last stays at home, otherwise work or anywhere
+        place = rng.integers(0, len(self.place_lon), len(stay_user))
+        goes_to_work = (~self.is_tourist[stay_user]) & (rng.random(len(stay_user)) < 0.5)
+        place = np.where(goes_to_work, self.work[stay_user], place)
+        place = np.where((ind_stay == 0) | is_last, self.home[stay_user], place)
+        # times: sorted break points in the day for each user
+        break_points = rng.uniform(0, S_END_OF_DAY, len(stay_user))
+        break_points[ind_stay == 0] = rng.uniform(0, 2 * 60 * 60, (ind_stay == 0).sum())
+        order = np.lexsort((break_points, stay_user))
+        start = break_points[order]
+        end = np.where(is_last, S_END_OF_DAY, np.roll(start, -1))
+        duration = end - start
+        n_obs = 1 + rng.poisson(self.observations_per_hour * duration / (60 * 60))
+        last = end - rng.uniform(0, np.minimum(duration, 15 * 60))
+        n_4G = rng.binomial(n_obs, FRACTION_4G)
+        jitter = MAX_JITTER_M / METERS_PER_DEGREE
+        stays_df = pd.DataFrame({
+            IMSI: self.imsi[stay_user],
+            START: start.astype(int),
+            LAST: last.astype(int),
+            END: end.astype(int),
+            N: n_obs,
+            N4G: n_4G,
+            LON: self.place_lon[place] + rng.uniform(-jitter, jitter, len(place)),
+            LAT: self.place_lat[place] + rng.uniform(-jitter, jitter, len(place)),
+            MCC: self.mcc[stay_user],
+            PARISH: self.parishes[self.place_parish[place]],
+        })
+        return stays_df
+
+    def get_day_persons(self, ind_day, stays_df=None):
+        """
+        Returns the day's stays in the JSON persons format produced by get_stays.py
+        """
+        if stays_df is None:
+            stays_df = self.get_day_stays(ind_day)
+        persons = []
+        records = zip(*[stays_df[col].tolist() for col in [IMSI, MCC, START, LAST, END, N, N4G, LON, LAT]])
+        person = None
+        for imsi, mcc, s, l, e, n, n_4G, lon, lat in records:
+            if person is None or person[IMSI] != imsi:
+                person = {IMSI: imsi, MCC: mcc, 'stay_points': []}
+                persons.append(person)
+            person['stay_points'].append({'p': [lon, lat], START: s, LAST: l, END: e, N: n, N4G: n_4G})
+        return persons
+
+    def get_day_raw(self, ind_day, stays_df=None):
+        """
+        Returns a dataframe of raw RNC observations for the day.
+        Columns: imsi, timestamp, lat, lon, mcc, 4G, cellid
+        Observations are spread over each stay's [s, l] period, within MAX_JITTER_M of the stay.
+        """
+        if stays_df is None:
+            stays_df = self.get_day_stays(ind_day)
+        rng = self.day_rng(ind_day, stream=1)
+        n_obs = stays_df[N].values
+        obs_stay = np.repeat(np.arange(len(stays_df)), n_obs)
+        start, last = stays_df[START].values[obs_stay], stays_df[LAST].values[obs_stay]
+        seconds = start + rng.random(len(obs_stay)) * (last - start)
+        jitter = MAX_JITTER_M / METERS_PER_DEGREE / 2
+        cellid = rng.integers(0, N_CELLIDS, len(obs_stay)).astype(str)
+        cellid[rng.random(len(obs_stay)) < FILTERED_CELLID_PROB] = FILTERED_CELLID
+        is_4G = np.zeros(len(obs_stay), dtype=int)
+        is_4G[rng.random(len(obs_stay)) < FRACTION_4G] = 1
+        raw_df = pd.DataFrame({
+            IMSI: stays_df[IMSI].values[obs_stay],
+            TIMESTAMP: pd.Timestamp(self.dates[ind_day]) + pd.to_timedelta(seconds, unit='s'),
+            LAT: stays_df[LAT].values[obs_stay] + rng.uniform(-jitter, jitter, len(obs_stay)),
+            LON: stays_df[LON].values[obs_stay] + rng.uniform(-jitter, jitter, len(obs_stay)),
+            MCC: stays_df[MCC].values[obs_stay],
+            IS_4G: is_4G,
+            CELLID: cellid,
+        })
+        return raw_df
+
+
+def get_raw_lines(raw_df):
+    """
+    Groups raw observations by imsi into the lines that get_stay_points takes,
+    as produced by the reduceByKey step in get_stays.py:
+    (imsi, [timestamps, lats, lons, mcc, 4G flags, cellids])
+    """
+    lines = []
+    for imsi, imsi_df in raw_df.groupby(IMSI, sort=False):
+        lines.append((imsi, [
+            list(imsi_df[TIMESTAMP].dt.to_pydatetime()),
+            imsi_df[LAT].tolist(),
+            imsi_df[LON].tolist(),
+            imsi_df[MCC].iat[0],
+            imsi_df[IS_4G].tolist(),
+            imsi_df[CELLID].tolist(),
+        ]))
+    return lines
+
+
+def write_synthetic_data(population, outputs_filepath, formats=(JSON, CSV)):
+    """
+    Writes the population's daily files in the private data layout.
+    Returns the list of file paths written.
+    """
+    filepaths = []
+    for ind_day, d in enumerate(population.dates):
+        if ind_day % 10 == 0:
+            print('%s/%s %s : %s' % (ind_day, len(population.dates), d.strftime(date_fmt), datetime.now()))
+        stays_df = population.get_day_stays(ind_day)
+        if JSON in formats:
+            fpath = get_stays_filepath(outputs_filepath, d.day, d.month, d.year, JSON)
+            Path(fpath).parent.mkdir(parents=True, exist_ok=True)
+            json.dump(population.get_day_persons(ind_day, stays_df), open(fpath, 'w'))
+            filepaths.append(fpath)
+        if CSV in formats:
+            fpath = get_stays_filepath(outputs_filepath, d.day, d.month, d.year, CSV)
+            Path(fpath).parent.mkdir(parents=True, exist_ok=True)
+            stays_df.set_index(IMSI).to_csv(fpath)
+            filepaths.append(fpath)
+        if RAW in formats:
+            fpath = get_raw_filepath(outputs_filepath, d.day, d.month, d.year)
+            Path(fpath).parent.mkdir(parents=True, exist_ok=True)
+            population.get_day_raw(ind_day, stays_df).to_csv(fpath, index=False)
+            filepaths.append(fpath)
+        if HDFS in formats:
+            fpath = get_hdfs_stays_filepath(outputs_filepath, d.day, d.month, d.year)
+            Path(fpath).mkdir(parents=True, exist_ok=True)
+            persons = population.get_day_persons(ind_day, stays_df)
+            for part in range(N_HDFS_PARTS):
+                with open('%spart-%05d' % (fpath, part), 'w') as f:
+                    for person in persons[part::N_HDFS_PARTS]:
+                        f.write('%s\n' % person)
+            filepaths.append(fpath)
+    return filepaths
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Generates synthetic raw observations and stays data within the parish boundaries.')
+    parser.add_argument('--outputs_filepath', required=True,
+                        help='/path/to/save/synthetic/data/')
+    parser.add_argument('--n_users', type=int, default=DEFAULT_N_USERS)
+    parser.add_argument('--start_date', default=DEFAULT_START_DATE,
+                        help='yyyy-mm-dd first date of data')
+    parser.add_argument('--n_days', type=int, default=DEFAULT_N_DAYS)
+    parser.add_argument('--tourist_fraction', type=float, default=DEFAULT_TOURIST_FRACTION)
+    parser.add_argument('--observations_per_hour', type=float, default=DEFAULT_OBSERVATIONS_PER_HOUR,
+                        help='mean number of raw observations per hour of stay')
+    parser.add_argument('--formats', default=','.join(DEFAULT_FORMATS),
+                        help='comma separated subset of %s' % ','.join(FORMATS))
+    parser.add_argument('--shapefilepath', default=default_shapefilepath)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    formats = args.formats.split(',')
+    assert all(f in FORMATS for f in formats), 'unknown format in %s' % args.formats
+    print('--- generating %s synthetic users for %s days ---' % (args.n_users, args.n_days))
+    population = SyntheticPopulation(
+        n_users=args.n_users, n_days=args.n_days, start_date=args.start_date,
+        tourist_fraction=args.tourist_fraction,
+        observations_per_hour=args.observations_per_hour,
+        shapefilepath=args.shapefilepath, seed=args.seed)
+    filepaths = write_synthetic_data(population, args.outputs_filepath, formats)
+    print('saved %s files to %s' % (len(filepaths), args.outputs_filepath))
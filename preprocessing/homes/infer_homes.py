@@ -10,12 +10,20 @@ The criteria for inferring home parish is described below.
 Usage:
 python infer_homes.py --month=yyyy-mm \
     --month MONTH is the Year-Month for which to infer homes.
+    [--data_filepath DATA_FILEPATH] \
     [--stays_path STAYS_PATH] \
-    [--homes_path HOMES_PATH]
+    [--homes_path HOMES_PATH] \
+    [--sample_rate FLOAT]
     
 optional arguments
+    --data_filepath=STRING is a path to the data with stays/ and homes/, used for
+        stays_path and homes_path when they are not given.
     --stays_path=STRING is a path  to the stays data used for home inference.
     --homes_path=STRING is a path to where output inferred homes data is saved.
+    --sample_rate=FLOAT infers the homes of a stable sample of users only
+        (see andorra_mobility/sampling.py). With --data_filepath, their homes are saved
+        under data_filepath/sample_RATE/homes/, and the stays saved there by a run at the
+        same sample rate are read instead of those of all users, if any.
     
 Example usage:
 python infer_homes.py \
@@ -24,6 +32,9 @@ python infer_homes.py \
     --homes_path=/home/data_commons/andorra_data_2020/homes/ \
     > infer_homes_2020_03.out
 
+Instrumentation options (see andorra_mobility/instrumentation.py):
+    [--metrics_log=PATH] [--profile_day=yyyy-mm-dd] [--profiler=cprofile|sampling]
+
 
 Data is  saved  to homes_path/yyyy_m_homes.csv
 
@@ -51,8 +62,11 @@ from pathlib import Path
 import numpy as np
 import pandas as pd
 
-
-date_fmt = '%Y-%m'
+from andorra_mobility.inputs import read_csv
+from andorra_mobility.instrumentation import Instrumentation, add_instrumentation_args
+from andorra_mobility.paths import (get_homes_path, get_month_homes_filepath, get_sample_path,
+                                    get_stays_day_filepath, get_stays_filepath_date, get_stays_path, month_fmt)
+from andorra_mobility.sampling import add_sampling_args, set_sample_rate
 
 
 IMSI = 'imsi'
@@ -78,25 +92,25 @@ default_homes_path = '/home/data_commons/andorra_data_2020/homes/'
 default_stays_path = '/home/data_commons/andorra_data_2020/stays/'
 
 
-def get_homes_filepath(datapath, year, month):
-    return '{}{}_{}_homes.csv'.format(datapath, year, month)
-
-def get_stays_filepath(datapath, year, month, day):
-    return '{}{}_{}/stays_{}_{}_{}.csv'.format(datapath, year, month, year, month, day)
-
-
-def get_stays_filepaths(year, month, stays_path):
+def get_stays_filepaths(year, month, stays_path, sample_stays_path=None):
+    """
+    returns the stays filepaths of the days of the month, in sample_stays_path
+    (the stays of a sample of users) when they exist there, else in stays_path
+    """
     stays_fpaths = []
     d = date(year, month, 1)
     while d.month == month:
-        stays_fpaths += [get_stays_filepath(stays_path, d.year, d.month, d.day)]
+        fpath = None if sample_stays_path is None else get_stays_day_filepath(sample_stays_path, d.day, d.month, d.year)
+        if fpath is None or not Path(fpath).is_file():
+            fpath = get_stays_day_filepath(stays_path, d.day, d.month, d.year)
+        stays_fpaths += [fpath]
         d += timedelta(days=1)
     return stays_fpaths
 
 
-def infer_homes(year, month, homes_path, stays_path):
+def infer_homes(year, month, homes_path, stays_path, instrumentation=None, sample_stays_path=None):
     print('getting stays filepaths for %s/%s' % (year, month))
-    stays_fpaths = get_stays_filepaths(year, month, stays_path)
+    stays_fpaths = get_stays_filepaths(year, month, stays_path, sample_stays_path)
     missing_stays_fpaths = [fp for fp in stays_fpaths if not Path(fp).is_file()]
     filtered_stays_fpaths = [fp for fp in stays_fpaths if Path(fp).is_file()]
     print('missing %s/%s stays files: %s' % (len(missing_stays_fpaths),
@@ -105,53 +119,56 @@ def infer_homes(year, month, homes_path, stays_path):
         print('no stay files to  process')
         return None
     print('handling %s stays files' % len(filtered_stays_fpaths))
-    inferred_homes_df = process_stays_data(filtered_stays_fpaths)
+    inferred_homes_df = process_stays_data(filtered_stays_fpaths, instrumentation)
     # save homes data
-    homes_fpath = get_homes_filepath(homes_path, year, month)
+    homes_fpath = get_month_homes_filepath(homes_path, year, month)
     print('saving inferred homes data to %s' % homes_fpath)
     inferred_homes_df.reset_index().to_csv(homes_fpath, index=False)
     print('saved %s' % homes_fpath)
     return inferred_homes_df
 
 
-def process_stays_data(stays_fpaths):
+def process_stays_data(stays_fpaths, instrumentation=None):
     # for each imsi, accumulate record of mcc, and of tally days, nights, 
     # and cumulative stay duration in each pairsh
+    if instrumentation is None:
+        instrumentation = Instrumentation('homes')
     imsi_mcc = None
     imsi_days = None
     imsi_nights = None
     imsi_nights_parish_cum_duration = None # indexed by imsi, parish
 
     for i, fpath in enumerate(stays_fpaths):
-        print('(%s/%s) %s handling %s' % (i+1, len(stays_fpaths), datetime.now(), fpath))
-        stays_df = pd.read_csv(fpath)
-        print('%s stays'  % len(stays_df))
-        # compute duration of each nighttime stay
-        stays_df[S_NIGHT_STAY_DURATION] = stays_df.apply(night_stay_duration, axis=1)
-        # assert data integrity
-        assert stays_df[S_NIGHT_STAY_DURATION].apply(lambda nsd: nsd <= S_6AM).all()
-        nights_stays_df = stays_df[stays_df[S_NIGHT_STAY_DURATION] > 0]
-        # make a series of imsis from each day  --> will later count days with value counts
-        # make a series of imsis from each night  --> will later count days with value counts
-        # either make new or combine with previous
-        if imsi_mcc is None:
-            imsi_mcc = stays_df[[IMSI,MCC]].drop_duplicates(subset=IMSI, keep='first')
-            imsi_days = pd.Series(stays_df[IMSI].unique())
-            imsi_nights = pd.Series(nights_stays_df[IMSI].unique())
-        else:
-            imsi_days = imsi_days.append(pd.Series(stays_df[IMSI].unique()))
-            imsi_nights = imsi_nights.append(pd.Series(nights_stays_df[IMSI].unique()))
-            imsi_mcc = imsi_mcc.append(stays_df[[IMSI,MCC]]).drop_duplicates(
-                subset=IMSI, keep='first')
-
-        #  accumulate the aggregate night stay time for  each imsi and parish
-        imsi_nsp_cum_duration = nights_stays_df.groupby(
-            [IMSI, PARISH])[S_NIGHT_STAY_DURATION].sum()
-        if imsi_nights_parish_cum_duration is None:
-            imsi_nights_parish_cum_duration = imsi_nsp_cum_duration
-        else:
-            imsi_nights_parish_cum_duration = imsi_nights_parish_cum_duration.add(
-                imsi_nsp_cum_duration, fill_value=0)
+        with instrumentation.stage('homes day', day=get_stays_filepath_date(fpath)) as stage_record:
+            stays_df = read_csv(fpath)
+            stage_record.rows_in = len(stays_df)
+            # compute duration of each nighttime stay
+            stays_df[S_NIGHT_STAY_DURATION] = stays_df.apply(night_stay_duration, axis=1)
+            # assert data integrity
+            assert stays_df[S_NIGHT_STAY_DURATION].apply(lambda nsd: nsd <= S_6AM).all()
+            nights_stays_df = stays_df[stays_df[S_NIGHT_STAY_DURATION] > 0]
+            # make a series of imsis from each day  --> will later count days with value counts
+            # make a series of imsis from each night  --> will later count days with value counts
+            # either make new or combine with previous
+            if imsi_mcc is None:
+                imsi_mcc = stays_df[[IMSI,MCC]].drop_duplicates(subset=IMSI, keep='first')
+                imsi_days = pd.Series(stays_df[IMSI].unique())
+                imsi_nights = pd.Series(nights_stays_df[IMSI].unique())
+            else:
+                imsi_days = imsi_days.append(pd.Series(stays_df[IMSI].unique()))
+                imsi_nights = imsi_nights.append(pd.Series(nights_stays_df[IMSI].unique()))
+                imsi_mcc = imsi_mcc.append(stays_df[[IMSI,MCC]]).drop_duplicates(
+                    subset=IMSI, keep='first')
+
+            #  accumulate the aggregate night stay time for  each imsi and parish
+            imsi_nsp_cum_duration = nights_stays_df.groupby(
+                [IMSI, PARISH])[S_NIGHT_STAY_DURATION].sum()
+            if imsi_nights_parish_cum_duration is None:
+                imsi_nights_parish_cum_duration = imsi_nsp_cum_duration
+            else:
+                imsi_nights_parish_cum_duration = imsi_nights_parish_cum_duration.add(
+                    imsi_nsp_cum_duration, fill_value=0)
+            stage_record.rows_out = len(imsi_nights_parish_cum_duration)
 
     # map imsi to parish with  the greatest cumulative night stay duration
     # get the index for the total max stay by parish for each imsi
@@ -176,19 +193,46 @@ def night_stay_duration(row, night_start=S_12AM, night_end=S_6AM):
 
 
 
+def add_arguments(parser):
+    parser.add_argument('--month', required=True,
+                        help='yyyy-mm the Year/Month for which to infer homes.')
+    parser.add_argument('--data_filepath', default=None,
+                        help='/path/to/data/ with stays/ and homes/. Sets the defaults of '
+                             '--stays_path and --homes_path.')
+    parser.add_argument('--stays_path', default=None,
+                        help='/path/to/stays/data/')
+    parser.add_argument('--homes_path', default=None,
+                        help='/path/to/save/homes/data/')
+    add_sampling_args(parser)
+    return parser
+
+
+def main(args, instrumentation):
+    sample_rate = set_sample_rate(args.sample_rate)
+    stays_path, homes_path, sample_stays_path = args.stays_path, args.homes_path, None
+    if args.data_filepath is not None:
+        # the homes of a sample are kept apart from those of all users
+        sample_data_filepath = get_sample_path(args.data_filepath, sample_rate)
+        if stays_path is None and sample_rate < 1:
+            sample_stays_path = get_stays_path(sample_data_filepath)
+        stays_path = stays_path or get_stays_path(args.data_filepath)
+        homes_path = homes_path or get_homes_path(sample_data_filepath)
+        if sample_rate < 1:
+            Path(homes_path).mkdir(parents=True, exist_ok=True)
+    month_datetime = datetime.strptime(args.month, month_fmt)
+    infer_homes(month_datetime.year, month_datetime.month,
+                homes_path or default_homes_path, stays_path or default_stays_path, instrumentation,
+                sample_stays_path)
+
+
 if __name__ == '__main__':
     import argparse
 
     parser = argparse.ArgumentParser(
         description='Infers a home parish for each user in the stays data and saves a table.')
-    parser.add_argument('--month', required=True,
-                        help='yyyy-mm the Year/Month for which to infer homes.')
-    parser.add_argument('--stays_path', default=default_stays_path,
-                        help='/path/to/stays/data/')
-    parser.add_argument('--homes_path', default=default_homes_path,
-                        help='/path/to/save/homes/data/')
+    add_arguments(parser)
+    add_instrumentation_args(parser)
     args = parser.parse_args()
-    
-    month_datetime = datetime.strptime(args.month, date_fmt)
-    infer_homes(month_datetime.year, month_datetime.month, args.homes_path, args.stays_path)
-
+    instrumentation = Instrumentation.from_args('homes', args)
+    main(args, instrumentation)
+    instrumentation.print_summary()
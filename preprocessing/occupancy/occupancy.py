@@ -0,0 +1,260 @@
+"""
+Occupancy
+-------------
+Computes the number of devices in each parish during each time slot of the day
+(30 minutes by default, as in toolbox.create_intervals), for residents and tourists.
+
+A device is in a parish during a slot if one of its stays in the parish overlaps the slot,
+as in get_h3_cells_by_interval (analysis/h3_tools.py): a stay from s to e covers the
+slots int(s/T) to int(e/T).
+Rather than enumerating every slot of every stay, each day's stays are reduced to +1 at
+their first slot and -1 after their last slot (a difference array), and the occupancy is
+the cumulative sum over slots. Overlapping stays of a device in the same parish are merged
+first, so that each device is counted once per parish and slot.
+
+Residents and tourists are taken from the presence store (see andorra_mobility/presence_store.py).
+Devices not in the presence store are counted as tourists.
+
+Days are processed one at a time into an occupancy cube (date x parish x slot x status),
+saved as a compressed numpy archive that can be sliced without the stays data:
+
+    cube = read_occupancy_cube('outputs/metrics/2020/occupancy.npz')
+    cube['occupancy'][:, cube['parishes'].index('Canillo'), :, cube['statuses'].index('tourist')]
+
+With --sample_rate < 1, only the stays of a stable sample of devices are read
+(see andorra_mobility/sampling.py), with the presence store of the same sample by default.
+The occupancy is scaled up to all devices, with its standard error.
+
+
+Usage:
+python occupancy.py \
+    --start_date=yyyy-mm-dd \
+    --end_date=yyyy-mm-dd \
+    --data_filepath=PATH \
+    --outputs_filepath=PATH \
+    [--presence_store=PATH] \
+    [--interval_length_minutes=INT] \
+    [--sample_rate=FLOAT]
+
+Example usage:
+nohup python occupancy.py \
+  --start_date=2020-03-01 \
+  --end_date=2020-10-31 \
+  --data_filepath=/home/data_commons/andorra_data_2020/  \
+  --outputs_filepath=./outputs/metrics/ \
+  > nohup_occupancy_2020.out &
+
+Instrumentation options (see andorra_mobility/instrumentation.py):
+    [--metrics_log=PATH] [--profile_day=yyyy-mm-dd] [--profiler=cprofile|sampling]
+
+
+Reads stays from data_filepath/stays/YYYY_M/stays_YYYY_M_D.csv
+and the presence store from data_filepath/presence/YEAR/presence.store/ by default
+
+Saves the occupancy cube to
+outputs_filepath/YEAR/occupancy.npz:
+-------------
+occupancy: int32 array (dates x parishes x slots x statuses), -1 for missing dates
+dates: yyyy-mm-dd strings
+parishes
+slot_starts: start of each slot, in seconds from midnight
+statuses: tourist, resident
+and, with --sample_rate < 1, to occupancy_sample_RATE.npz, with float occupancy scaled up to all devices and
+occupancy_se: the standard error of each occupancy, -1 for missing dates
+sample_rate
+
+"""
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+from andorra_mobility.inputs import read_csv
+from andorra_mobility.instrumentation import Instrumentation, add_instrumentation_args
+from andorra_mobility.paths import (date_fmt, find_input, get_datetimes, get_presence_store_filepath,
+                                    get_sample_suffix, get_stays_filepath)
+from andorra_mobility.presence_store import PresenceStore, STATUSES
+from andorra_mobility.sampling import add_sampling_args, get_sample_rate, scale_count, set_sample_rate
+
+IMSI = 'imsi'
+PARISH = 'parish'
+START = 's'
+END = 'e'
+
+PARISHES = ['Andorra la Vella', 'Canillo', 'Encamp', 'Escaldes-Engordany',
+            'La Massana', 'Ordino', 'Sant Julià de Lòria']
+
+SECONDS_PER_DAY = 24 * 60 * 60
+DEFAULT_INTERVAL_LENGTH_MINUTES = 30
+
+MISSING = -1
+
+
+def get_parish_codes(parishes):
+    """
+    Returns the index of each parish in PARISHES, or -1 for missing or unknown parishes.
+    """
+    return pd.Categorical(parishes, categories=PARISHES).codes.astype(np.int64)
+
+
+def get_status_codes(imsis, presence_store):
+    """
+    Returns the index in STATUSES of each imsi's status. Imsis not in the store are tourists.
+    """
+    codes = presence_store.get_user_codes(imsis)
+    status_codes = np.zeros(len(codes), dtype=np.int64)
+    status_codes[codes >= 0] = np.asarray(presence_store.status)[codes[codes >= 0]]
+    return status_codes
+
+
+def merge_device_slots(user_codes, parish_codes, first_slots, last_slots):
+    """
+    Merges the overlapping slot ranges of each device in each parish.
+    returns (parish_codes, first_slots, last_slots) of the merged ranges.
+    """
+    if len(user_codes) == 0:
+        return parish_codes, first_slots, last_slots
+    order = np.lexsort((first_slots, parish_codes, user_codes))
+    user_codes, parish_codes = user_codes[order], parish_codes[order]
+    first_slots, last_slots = first_slots[order], last_slots[order]
+    group_starts = np.r_[True, (user_codes[1:] != user_codes[:-1]) | (parish_codes[1:] != parish_codes[:-1])]
+    # running max of the last slots within each (device, parish): a range starts past it
+    groups = np.cumsum(group_starts) - 1
+    covered_until = pd.Series(last_slots).groupby(groups).cummax().values
+    new_range = group_starts.copy()
+    new_range[1:] |= first_slots[1:] > covered_until[:-1]
+    range_ids = np.cumsum(new_range) - 1
+    merged_last = pd.Series(last_slots).groupby(range_ids).max().values
+    return parish_codes[new_range], first_slots[new_range], merged_last
+
+
+def get_day_occupancy(stays_df, status_codes, n_slots):
+    """
+    Returns the occupancy (parishes x slots x statuses) of a day's stays.
+    status_codes: the index in STATUSES of the status of each stay's device
+    """
+    T = SECONDS_PER_DAY / n_slots
+    parish_codes = get_parish_codes(stays_df[PARISH].values)
+    keep = parish_codes >= 0
+    user_codes = pd.factorize(stays_df[IMSI].values[keep])[0]
+    first_slots = (stays_df[START].values[keep] // T).astype(np.int64)
+    last_slots = np.minimum(stays_df[END].values[keep] // T, n_slots - 1).astype(np.int64)
+    # parish and status are combined so that ranges are merged per device and parish
+    parish_status_codes = parish_codes[keep] * len(STATUSES) + status_codes[keep]
+    parish_status_codes, first_slots, last_slots = merge_device_slots(
+        user_codes, parish_status_codes, first_slots, last_slots)
+    n_rows = len(PARISHES) * len(STATUSES)
+    diffs = (np.bincount(parish_status_codes * (n_slots + 1) + first_slots, minlength=n_rows * (n_slots + 1))
+             - np.bincount(parish_status_codes * (n_slots + 1) + last_slots + 1, minlength=n_rows * (n_slots + 1)))
+    occupancy = np.cumsum(diffs.reshape(n_rows, n_slots + 1), axis=1)[:, :n_slots]
+    return occupancy.reshape(len(PARISHES), len(STATUSES), n_slots).transpose(0, 2, 1)
+
+
+def get_occupancy_cube(data_filepath, datetimes, presence_store,
+                       interval_length_minutes=DEFAULT_INTERVAL_LENGTH_MINUTES, instrumentation=None):
+    """
+    Returns (occupancy, missing_dates).
+    occupancy: int32 array (dates x parishes x slots x statuses), MISSING for missing dates
+    """
+    if instrumentation is None:
+        instrumentation = Instrumentation('occupancy')
+    n_slots = int(24 * 60 / interval_length_minutes)
+    occupancy = np.full((len(datetimes), len(PARISHES), n_slots, len(STATUSES)), MISSING, dtype=np.int32)
+    missing_dates = []
+    sample_rate = get_sample_rate()
+    for i, d in enumerate(datetimes):
+        stays_filepath = find_input(get_stays_filepath, data_filepath, sample_rate, d.day, d.month, d.year)
+        if not pathlib.Path(stays_filepath).is_file():
+            print('%s\nfile not found: %s' % (d.strftime(date_fmt), stays_filepath))
+            missing_dates += [d]
+            continue
+        with instrumentation.stage('occupancy day', day=d) as stage_record:
+            stays_df = read_csv(stays_filepath, usecols=[IMSI, START, END, PARISH])
+            stage_record.rows_in = len(stays_df)
+            occupancy[i] = get_day_occupancy(
+                stays_df, get_status_codes(stays_df[IMSI].values, presence_store), n_slots)
+            stage_record.rows_out = len(PARISHES) * n_slots
+    return occupancy, missing_dates
+
+
+def scale_occupancy(occupancy, sample_rate):
+    """
+    Returns (occupancy, occupancy_se): the occupancy of a sample of devices scaled up to all
+    devices, and its standard error, MISSING for missing dates.
+    """
+    missing = occupancy == MISSING
+    occupancy, occupancy_se = scale_count(np.where(missing, 0, occupancy), sample_rate)
+    occupancy[missing] = MISSING
+    occupancy_se[missing] = MISSING
+    return occupancy, occupancy_se
+
+
+def save_occupancy_cube(filepath, occupancy, datetimes, interval_length_minutes, occupancy_se=None, sample_rate=1.0):
+    n_slots = occupancy.shape[2]
+    sampling = {} if occupancy_se is None else {'occupancy_se': occupancy_se, 'sample_rate': np.array(sample_rate)}
+    np.savez_compressed(
+        filepath,
+        occupancy=occupancy,
+        dates=np.array([d.strftime(date_fmt) for d in datetimes]),
+        parishes=np.array(PARISHES),
+        slot_starts=np.arange(n_slots) * interval_length_minutes * 60,
+        statuses=np.array(STATUSES),
+        **sampling)
+
+
+def read_occupancy_cube(filepath):
+    """
+    Returns a dict of the occupancy cube and its labels (dates, parishes, slot_starts, statuses as lists).
+    """
+    with np.load(filepath) as f:
+        cube = {key: f[key] for key in f.files}
+    for key in ['dates', 'parishes', 'slot_starts', 'statuses']:
+        cube[key] = cube[key].tolist()
+    return cube
+
+
+def add_arguments(parser):
+    parser.add_argument('--start_date', required=True)
+    parser.add_argument('--end_date', required=True)
+    parser.add_argument('--data_filepath', required=True)
+    parser.add_argument('--outputs_filepath', required=True)
+    parser.add_argument('--presence_store', default=None,
+                        help='/path/to/presence.store. Defaults to data_filepath/presence/YEAR/presence.store/')
+    parser.add_argument('--interval_length_minutes', type=int, default=DEFAULT_INTERVAL_LENGTH_MINUTES)
+    add_sampling_args(parser)
+    return parser
+
+
+def main(args, instrumentation):
+    datetimes = get_datetimes(args.start_date, args.end_date)
+    start_date = datetimes[0]
+    print('--- get occupancy by parish and time of day ---')
+    print('datetimes: %s - %s' % (datetimes[0], datetimes[-1]))
+    sample_rate = set_sample_rate(args.sample_rate)
+    presence_store_filepath = args.presence_store or find_input(
+        get_presence_store_filepath, args.data_filepath, sample_rate, start_date.year)
+    presence_store = PresenceStore.open(presence_store_filepath)
+    occupancy, missing_dates = get_occupancy_cube(
+        args.data_filepath, datetimes, presence_store, args.interval_length_minutes, instrumentation)
+    print('computed occupancy. %s/%s missing dates' % (len(missing_dates), len(datetimes)))
+    occupancy_filepath = '%s%s/occupancy%s.npz' % (args.outputs_filepath, start_date.year, get_sample_suffix(sample_rate))
+    print('saving occupancy data to %s' % occupancy_filepath)
+    occupancy_se = None
+    if sample_rate < 1:
+        occupancy, occupancy_se = scale_occupancy(occupancy, sample_rate)
+    save_occupancy_cube(occupancy_filepath, occupancy, datetimes, args.interval_length_minutes,
+                        occupancy_se, sample_rate)
+    print('saved')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Computes the number of devices in each parish during each time slot of the day.')
+    add_arguments(parser)
+    add_instrumentation_args(parser)
+    args = parser.parse_args()
+    instrumentation = Instrumentation.from_args('occupancy', args)
+    main(args, instrumentation)
+    instrumentation.print_summary()
@@ -11,7 +11,14 @@ python presence_entrances_departures.py \
     --end_date=yyyy-mm-dd \
     --data_filepath=PATH \
     --outputs_filepath=PATH \
-    [--window=INT]
+    [--window=INT] \
+    [--n_shards=INT] \
+    [--n_workers=INT] \
+    [--presence_format=csv|store|both] \
+    [--nationality_groups=country|PATH] \
+    [--sketches=none|hll|exact] \
+    [--sketch_precision=INT] \
+    [--sample_rate=FLOAT]
    
 Example usage:
 nohup python presence_entrances_departures.py \
@@ -22,6 +29,59 @@ nohup python presence_entrances_departures.py \
    --window=13 \
    > nohup_presence_2019.out &
 
+Sharded mode:
+With --n_shards > 1, IMSIs are hash-partitioned into shards while the daily files are
+read (by a pool of n_workers processes), and presence is inferred for each shard on the
+process pool. The per-day presence counts and entrance/departure counts are additive
+across shards and are merged. Memory per worker is bounded by the shard size, so that
+long (e.g. multi-year) date ranges can be processed.
+Shard files are written to data_filepath/presence/YEAR/shards/ and removed when done.
+
+Nationality groups:
+Entrances and departures are counted by the nationality of the user's MCC. By default the
+nationalities are those of mcc_names_dict. --nationality_groups=country counts them for each
+country of data/public/mcc-mnc-list.csv, and --nationality_groups=PATH reads groups from a
+JSON file of {group name: [MCCs, country names or ISO codes]} (see andorra_mobility/nationality.py).
+
+Distinct user sketches:
+With --sketches=hll, while the daily files are read, the users observed each day are added to mergeable
+HyperLogLog sketches by day, nationality group and parish (see andorra_mobility/sketches.py),
+so that the number of distinct users over any date range and groups can be estimated
+without reading the stays again. --sketches=exact also keeps the exact user hashes,
+to validate the estimates. The sketches are off by default: they take
+days x groups x parishes x 2**sketch_precision bytes, in memory and on disk, e.g. 1.1 GB
+for a year with --nationality_groups=country.
+
+Sampling:
+With --sample_rate < 1, only a stable sample of users is read (see andorra_mobility/sampling.py).
+Presence, entrances and departures of the users kept are those of the full run. Their
+per-user presence and sketches are saved under data_filepath/sample_RATE/presence/YEAR/,
+and the aggregate counts, scaled up to all users with a standard error column for each,
+to presence_sample_RATE.csv and entrance_departure_sample_RATE.csv. Sketch counts are
+scaled up too.
+
+nohup python presence_entrances_departures.py \
+   --start_date=2019-03-01 \
+   --end_date=2020-10-31 \
+   --data_filepath=/home/data_commons/andorra_data_2020/  \
+   --outputs_filepath=./outputs/metrics/ \
+   --n_shards=32 \
+   --n_workers=8 \
+   > nohup_presence_2019_2020.out &
+
+Instrumentation options (see andorra_mobility/instrumentation.py):
+    [--metrics_log=PATH] [--profile_day=yyyy-mm-dd] [--profiler=cprofile|sampling]
+
+
+Saves per-user presence (see --presence_format) to
+data_filepath/presence/YEAR/presence_tourists.csv and presence_others.csv:
+-------------
+1 row per imsi, 1 column per date, 0: absent, 1: present, 2: present and observed
+and/or to the bit-packed presence store (see andorra_mobility/presence_store.py)
+data_filepath/presence/YEAR/presence.store/
+
+Saves distinct user sketches (see --sketches) to
+data_filepath/presence/YEAR/sketches.npz
 
 Saves aggregate daily presence counts to 
 outputs_filepath/YEAR/presence.csv:
@@ -34,22 +94,52 @@ outputs_filepath/YEAR/entrance_departure.csv:
 date, entrance_{nationality}, ..., departure_{nationality}
 
 """
-from datetime import datetime, timedelta
+import multiprocessing
 import pathlib
+import shutil
 
 import numpy as np
 import pandas as pd
 
+from andorra_mobility.inputs import read_csv
+from andorra_mobility.instrumentation import Instrumentation, add_instrumentation_args
+from andorra_mobility.nationality import MccGrouping, get_mcc_grouping
+from andorra_mobility.presence_store import PresenceStoreWriter, merge_stores
+from andorra_mobility.paths import (date_fmt, find_input, get_datetimes, get_presence_path, get_sample_path,
+                                    get_sample_suffix, get_stays_filepath)
+from andorra_mobility.sampling import add_sampling_args, get_sample_rate, scale_counts, set_sample_rate
+from andorra_mobility.sketches import DEFAULT_PRECISION, DistinctSketches, get_user_hashes
+
 IMSI = 'imsi'
 MCC ='mcc'
 DATE = 'date'
 
 ENTRANCES = 'entrances'
 
-date_fmt = '%Y-%m-%d'
-
 DEFAULT_WINDOW = 13
 
+# Tourists: observed on fewer than 50 days of the whole dataset
+# Residents (Ordinary or Temp): everyone else
+TOURIST_MAX_DAYS_OBSERVED = 50
+TOURIST = 'tourist'
+RESIDENT = 'resident'
+
+# Per-user presence output formats
+CSV = 'csv'
+STORE = 'store'
+BOTH = 'both'
+PRESENCE_FORMATS = [CSV, STORE, BOTH]
+
+# Distinct user sketches
+NO_SKETCHES = 'none'
+HLL = 'hll'
+EXACT = 'exact'
+SKETCHES = [NO_SKETCHES, HLL, EXACT]
+
+PARISH = 'parish'
+PARISHES = ['Andorra la Vella', 'Canillo', 'Encamp', 'Escaldes-Engordany',
+            'La Massana', 'Ordino', 'Sant Julià de Lòria']
+
 # MCC
 ALL = 'All'
 OTHER_MCC = 'other'
@@ -63,51 +153,80 @@ mcc_names_dict = {
     # otherwise nationality is 'other'
     OTHER_MCC: 'Other'
 }
+DEFAULT_MCC_GROUPING = MccGrouping(
+    [(mcc_names_dict[mcc], [mcc]) for mcc in mcc_names_dict if mcc != OTHER_MCC],
+    other=mcc_names_dict[OTHER_MCC])
 
-
-def get_stays_filepath(data_filepath, day, month, year):
-    return '{}stays/{}_{}/stays_{}_{}_{}.csv'.format(data_filepath, year, month, year, month, day)
-
-def daterange(start_datetime, end_datetime):
-    for n in range(int((end_datetime - start_datetime).days) + 1):
-        yield start_datetime + timedelta(n)
+# Entrance and departure event kinds
+ENTRANCE = 0
+DEPARTURE = 1
 
 
 # ind_days_observed and ind_days_present are used 
 # to denote the indices of the days the person is observed or assumed to be present. 
 # Indices are used to simplify the computation by avoiding datetime operations.
-def get_days_observed(data_filepath, datetimes):
+def get_days_observed(data_filepath, datetimes, instrumentation=None, sketches=None,
+                      mcc_grouping=DEFAULT_MCC_GROUPING):
     """
     returns a dict containing one entry for each imsi
     each person-object contains informtion about the user and when they were observed:
         'days': a set containing all the indices of the days they were present
         'months': a set containing all the months they were present
+    If sketches (DistinctSketches) are given, each day's users are added to them,
+    by the groups of mcc_grouping and by parish.
     """
+    if instrumentation is None:
+        instrumentation = Instrumentation('presence')
     all_persons_summary = {}
     ind_missing_dates=[]
-    print('get days observed')
+    sample_rate = get_sample_rate()
     for i_date, date in enumerate(datetimes):
-        stays_filepath = get_stays_filepath(data_filepath, date.day, date.month, date.year)
+        stays_filepath = find_input(get_stays_filepath, data_filepath, sample_rate, date.day, date.month, date.year)
         date_str =  date.strftime("%Y-%m-%d")
-        if i_date % 10 == 0:
-            print('%s/%s %s : %s' %  (i_date, len(datetimes), date_str, datetime.now()))
         if not pathlib.Path(stays_filepath).is_file():
             ind_missing_dates += [i_date]
             print('%s\nfile not found: %s' % (date_str, stays_filepath))
             continue
-        users = pd.read_csv(stays_filepath)[[IMSI,MCC, 'parish']].dropna().set_index(IMSI)
-        users = users[~users.index.duplicated(keep='first')]
-        users[MCC] = users[MCC].astype(str)
-        for imsi, row in users.iterrows():
-            if imsi not in all_persons_summary:
-                all_persons_summary[imsi]={'mcc': row['mcc'], 'months':set([date.month]),'ind_days_observed':set([i_date])}
-            else:
-                all_persons_summary[imsi]['months'].add(date.month)
-                all_persons_summary[imsi]['ind_days_observed'].add(i_date)
+        with instrumentation.stage('days observed', day=date) as stage_record:
+            users = read_csv(stays_filepath, usecols=[IMSI, MCC, PARISH])[[IMSI, MCC, PARISH]].dropna().set_index(IMSI)
+            stage_record.rows_in = len(users)
+            if sketches is not None:
+                add_day_sketches(sketches, date, users.reset_index(), mcc_grouping)
+            users = users[~users.index.duplicated(keep='first')]
+            users[MCC] = users[MCC].astype(str)
+            for imsi, row in users.iterrows():
+                if imsi not in all_persons_summary:
+                    all_persons_summary[imsi]={'mcc': row['mcc'], 'months':set([date.month]),'ind_days_observed':set([i_date])}
+                else:
+                    all_persons_summary[imsi]['months'].add(date.month)
+                    all_persons_summary[imsi]['ind_days_observed'].add(i_date)
+            stage_record.rows_out = len(users)
     return all_persons_summary, ind_missing_dates
 
 
-def infer_days_present(ind_days_observed, window, ind_missing_dates=[]):
+def create_sketches(datetimes, sketches_mode, precision=DEFAULT_PRECISION, mcc_grouping=DEFAULT_MCC_GROUPING):
+    """
+    returns empty DistinctSketches for datetimes, of the users of the run's sample rate,
+    or None if sketches_mode is NO_SKETCHES
+    """
+    if sketches_mode == NO_SKETCHES:
+        return None
+    return DistinctSketches(datetimes, mcc_grouping.names, PARISHES, precision, exact=sketches_mode == EXACT,
+                            sample_rate=get_sample_rate())
+
+
+def add_day_sketches(sketches, date, users, mcc_grouping=DEFAULT_MCC_GROUPING):
+    """
+    Adds a day's users (the imsi, mcc and parish of each stay) to sketches
+    """
+    sketches.add_day(date, users[IMSI].values, mcc_grouping.get_codes(users[MCC].values), users[PARISH].values)
+
+
+def get_sketches_filepath(data_filepath, year):
+    return '%ssketches.npz' % get_presence_path(data_filepath, year)
+
+
+def infer_days_present(ind_days_observed, window, n_days, ind_missing_dates=[]):
     """
     Infer which days each user was present based on the days they were observed.<br>
     Assume that small gaps in observations are days when the person was still present but their device was not observed.
@@ -123,6 +242,8 @@ def infer_days_present(ind_days_observed, window, ind_missing_dates=[]):
     eg. for the same example above, if days 9,10,11,12 are missing from the data, 
     then the device is assumed to be present during the entire period 
     (because only days 13 and 14 are counted as missing for this user.
+
+    n_days is the number of days in the study period.
     """
     ind_days_observed=sorted(list(ind_days_observed))
     ind_days_present=set()
@@ -148,9 +269,9 @@ def infer_days_present(ind_days_observed, window, ind_missing_dates=[]):
             entrances.append(ind_days_observed[i+1])
     # deal with period between last observed day and end of study period
     ind_days_present.add(ind_days_observed[-1])
-    missing_from_end=sum([1 for d in range(ind_days_observed[-1], len(datetimes)) if d not in ind_missing_dates])
+    missing_from_end=sum([1 for d in range(ind_days_observed[-1], n_days) if d not in ind_missing_dates])
     if missing_from_end<=window:
-        for j in range(ind_days_observed[-1], len(datetimes)):
+        for j in range(ind_days_observed[-1], n_days):
             ind_days_present.add(j)
     else:
         departures.append(ind_days_observed[-1])
@@ -158,130 +279,427 @@ def infer_days_present(ind_days_observed, window, ind_missing_dates=[]):
     return ind_days_present, departures, entrances
 
 
-def get_presence_entrances_departures_dfs(datetimes, all_persons_summary, ind_missing_dates, window):
+def get_presence_entrances_departures_dfs(datetimes, all_persons_summary, ind_missing_dates, window,
+                                          instrumentation=None, mcc_grouping=DEFAULT_MCC_GROUPING):
     """
     returns presence_df, entrance_departure_df
     presence_df:
         - 1 row per imsi
         - 1 column per date
         - 0 indicates person was absent, 1 indicates present but no stays, 0s indicate present and has at least 1 stay
+    entrance_departure_df: entrances and departures by the nationality groups of mcc_grouping.
+    Other breakdowns can be computed from all_persons_summary with get_entrance_departure_events
+    and aggregate_entrances_departures, without inferring presence again.
     """
-    mcc_names=[mcc_names_dict[code]  for code in mcc_names_dict]
-    columns=['entrance_{}'.format(name) for name in mcc_names]+['departures_{}'.format(name) for name in mcc_names]
-    entrance_departure_df=pd.DataFrame(index=datetimes, columns=columns)
-    entrance_departure_df.loc[:,:]=0
+    if instrumentation is None:
+        instrumentation = Instrumentation('presence')
+    with instrumentation.stage('infer presence', rows_in=len(all_persons_summary)) as stage_record:
+        presence_df = _get_presence_df(datetimes, all_persons_summary, ind_missing_dates, window)
+        stage_record.rows_out = len(presence_df)
+    with instrumentation.stage('aggregate entrances departures') as stage_record:
+        events = get_entrance_departure_events(all_persons_summary)
+        stage_record.rows_in = len(events[1])
+        entrance_departure_df = aggregate_entrances_departures(datetimes, *events, mcc_grouping)
+        stage_record.rows_out = len(entrance_departure_df)
+    return presence_df, entrance_departure_df
+
+
+def _get_presence_df(datetimes, all_persons_summary, ind_missing_dates, window):
     presence_df=pd.DataFrame(index=[imsi for imsi in all_persons_summary], columns=range(len(datetimes)))
     presence_df.loc[:,:]=0
     for ind_imsi, imsi in enumerate(all_persons_summary):
-        if ind_imsi%10000==0:
-            print('computing presence for imsi %s/%s : %s' % (ind_imsi, len(all_persons_summary), datetime.now()))
         ind_days_observed=all_persons_summary[imsi]['ind_days_observed']
-        mcc=all_persons_summary[imsi]['mcc']
-        if mcc in mcc_names_dict:
-            mcc_name=mcc_names_dict[mcc]
-        else:
-            mcc_name='Other'
-        ind_days_present, departures, entrances = infer_days_present(ind_days_observed, window, ind_missing_dates)
+        ind_days_present, departures, entrances = infer_days_present(
+            ind_days_observed, window, len(datetimes), ind_missing_dates)
         all_persons_summary[imsi]['entrances']=entrances
         all_persons_summary[imsi]['departures']=departures
         all_persons_summary[imsi]['ind_days_present']=ind_days_present
 
-        # update the the total entrances and exits
-        for ind_day in entrances:
-            entrance_departure_df.loc[datetimes[ind_day], 'entrance_{}'.format(mcc_name)]+=1
-        for ind_day in departures:
-            entrance_departure_df.loc[datetimes[ind_day], 'departures_{}'.format(mcc_name)]+=1
-
         # update the overall dataframe of presence/absence
         presence_df.iloc[ind_imsi][ind_days_present]=1
         presence_df.iloc[ind_imsi][ind_days_observed]=2
     presence_df = presence_df.rename(columns={i:datetimes[i] for i in range(len(datetimes))}) 
-    return presence_df, entrance_departure_df
+    return presence_df
 
 
-if __name__ == '__main__':
-    import argparse
+def get_entrance_departure_events(all_persons_summary):
+    """
+    returns (mccs, event_users, event_days, event_kinds) from the entrances and departures
+    inferred for each person (see infer_days_present):
+        mccs: the mcc of each user, in the order of all_persons_summary
+        event_users, event_days, event_kinds: for each event, the index of the user,
+            the index of the day and ENTRANCE or DEPARTURE
+    """
+    mccs = [person['mcc'] for person in all_persons_summary.values()]
+    n_entrances = np.array([len(person['entrances']) for person in all_persons_summary.values()], dtype=np.int64)
+    n_departures = np.array([len(person['departures']) for person in all_persons_summary.values()], dtype=np.int64)
+    users = np.arange(len(all_persons_summary))
+    event_users = np.concatenate([np.repeat(users, n_entrances), np.repeat(users, n_departures)])
+    event_days = np.fromiter(
+        [d for person in all_persons_summary.values() for d in person['entrances']]
+        + [d for person in all_persons_summary.values() for d in person['departures']],
+        dtype=np.int64, count=len(event_users))
+    event_kinds = np.repeat([ENTRANCE, DEPARTURE], [n_entrances.sum(), n_departures.sum()])
+    return mccs, event_users, event_days, event_kinds
 
-    parser = argparse.ArgumentParser(
-        description='Computes likely dates of presence, entrances, departures \
-                    for each user in the data, based on the dates they are \
-                    observed in the data.')
-    parser.add_argument('--start_date', required=True)
-    parser.add_argument('--end_date', required=True)
-    parser.add_argument('--data_filepath', required=True)
-    parser.add_argument('--outputs_filepath', required=True)
-    parser.add_argument('--window', default=DEFAULT_WINDOW)
-    args = parser.parse_args()
-    start_date = datetime.strptime(args.start_date, date_fmt)
-    end_date = datetime.strptime(args.end_date, date_fmt)
-    datetimes = [d for d in daterange(start_date, end_date)]
-    data_filepath, outputs_filepath = args.data_filepath, args.outputs_filepath
-    window = int(args.window)
-    print('--- get presence, entrances, departures with %s-day window ---' % window)
-    print('datetimes: %s - %s' % (datetimes[0], datetimes[-1]))
-    all_persons_summary, ind_missing_dates= get_days_observed(data_filepath, datetimes)
-    print('computed all_persons_summary for %s-day window. %s missing dates' % (window, ind_missing_dates))
-    presence_df, entrance_departure_df = get_presence_entrances_departures_dfs(datetimes, all_persons_summary, ind_missing_dates, window)
-    print('computed presence, entrance_departure dfs')
-    # mark tourists
-    # Tourists: observed on fewer than 50 days of the whole dataset
-    # Residents (Ordinary or Temp): everyone else
+
+def aggregate_entrances_departures(datetimes, mccs, event_users, event_days, event_kinds,
+                                   mcc_grouping=DEFAULT_MCC_GROUPING):
+    """
+    returns entrance_departure_df, the daily number of entrances and departures by nationality group:
+        - 1 row per date
+        - columns entrance_{group} for each group, then departures_{group} for each group
+    Events are counted with a single bincount over (kind, day, group).
+    """
+    n_days, n_groups = len(datetimes), len(mcc_grouping)
+    event_groups = mcc_grouping.get_codes(mccs)[event_users] if len(mccs) else np.zeros(0, dtype=np.int64)
+    counts = np.bincount((np.asarray(event_kinds) * n_days + event_days) * n_groups + event_groups,
+                         minlength=2 * n_days * n_groups).reshape(2, n_days, n_groups)
+    columns = (['entrance_{}'.format(name) for name in mcc_grouping.names]
+               + ['departures_{}'.format(name) for name in mcc_grouping.names])
+    return pd.DataFrame(np.hstack([counts[ENTRANCE], counts[DEPARTURE]]), index=datetimes, columns=columns)
+
+
+def mark_statuses(all_persons_summary):
+    """
+    Marks each person's 'status' as tourist or resident.
+    Tourists are observed on fewer than TOURIST_MAX_DAYS_OBSERVED days of the whole dataset.
+    """
     for imsi in all_persons_summary:
-        if len(all_persons_summary[imsi]['ind_days_observed'])>=50:
+        if len(all_persons_summary[imsi]['ind_days_observed'])>=TOURIST_MAX_DAYS_OBSERVED:
             # long term stay: either a permanent resident or temp worker
-            all_persons_summary[imsi]['status']='resident'
+            all_persons_summary[imsi]['status']=RESIDENT
         else:
-            all_persons_summary[imsi]['status']='tourist'
-    # Save presence dataframe: one csv for tourists and one for others
+            all_persons_summary[imsi]['status']=TOURIST
+
+
+def split_presence_df(presence_df, all_persons_summary):
+    """
+    returns presence_df_tourists, presence_df_non_tourists
+    """
     ind_tourist, ind_other=[], []
     for ind, imsi in enumerate(all_persons_summary):
-        if all_persons_summary[imsi]['status']=='tourist':
+        if all_persons_summary[imsi]['status']==TOURIST:
             ind_tourist.append(ind)
         else:
             ind_other.append(ind)
-    presence_df_tourists = presence_df.iloc[ind_tourist]
-    presence_df_non_tourists = presence_df.iloc[ind_other]
-    presence_tourists_filepath = ('%spresence/%s/presence_tourists%s.csv'%(
-        data_filepath, start_date.year, ('_%s_day_window'%window if window!=DEFAULT_WINDOW else '')
-    ))
-    presence_others_filepath = ('%spresence/%s/presence_others%s.csv'%(
-        data_filepath, start_date.year, ('_%s_day_window'%window if window!=DEFAULT_WINDOW else '')
-    ))
-    print('saving tourists presence data to %s' % presence_tourists_filepath)
-    presence_df_tourists.to_csv(presence_tourists_filepath)
-    print('saving others presence data to %s' % presence_others_filepath)
-    presence_df_non_tourists.to_csv(presence_others_filepath)
+    return presence_df.iloc[ind_tourist], presence_df.iloc[ind_other]
 
-    # make aggregate presence table and save in public outputs/metrics
-    assert(
-        len(presence_df_tourists.columns) == \
-        len(presence_df_non_tourists.columns) == \
-        len(datetimes)
-    )
-    tourists_present = []
-    non_tourists_present = []
-    all_present = []
-    for i, d in enumerate(presence_df_non_tourists.columns):
-        tourists_present += [(presence_df_tourists[str(d)] > 0).sum()]
-        non_tourists_present += [(presence_df_non_tourists[str(d)] > 0).sum()]
-        all_present += [tourists_present[-1] + non_tourists_present[-1]]
-    aggregate_presence_df = pd.DataFrame(data={
-        DATE:pd.to_datetime(presence_df_tourists.columns),
-        'all': all_present,
+
+def count_present(presence_df):
+    """
+    returns the number of people present on each day (column), as integers even without people
+    """
+    return (presence_df > 0).sum(axis=0).values.astype(np.int64)
+
+
+def get_aggregate_presence_df(datetimes, tourists_present, non_tourists_present):
+    return pd.DataFrame(data={
+        DATE:pd.to_datetime(datetimes),
+        'all': np.asarray(tourists_present) + np.asarray(non_tourists_present),
         'tourists': tourists_present,
         'non-tourists': non_tourists_present,
     }).set_index(DATE)
-    aggregate_presence_filepath = ('%s%s/presence%s.csv'%(
-        outputs_filepath, start_date.year, ('_%s_day_window'%window if window!=DEFAULT_WINDOW else '')
+
+
+def get_presence_filepath(data_filepath, year, window, status):
+    return ('%spresence_%s%s.csv'%(
+        get_presence_path(data_filepath, year), 'tourists' if status == TOURIST else 'others',
+        ('_%s_day_window'%window if window!=DEFAULT_WINDOW else '')
+    ))
+
+
+def get_presence_store_filepath(data_filepath, year, window):
+    return ('%spresence%s.store/'%(
+        get_presence_path(data_filepath, year), ('_%s_day_window'%window if window!=DEFAULT_WINDOW else '')
+    ))
+
+
+def write_presence_store(store_filepath, presence_df, all_persons_summary):
+    """
+    Writes the presence of all users (as returned by get_presence_entrances_departures_dfs)
+    to a presence store, with their mcc and status.
+    """
+    imsis = presence_df.index.values
+    imsi_dtype = 'int64' if pd.api.types.is_integer_dtype(presence_df.index) else 'S'
+    with PresenceStoreWriter(store_filepath, presence_df.columns, imsi_dtype) as writer:
+        writer.write(imsis,
+                     [all_persons_summary[imsi]['mcc'] for imsi in imsis],
+                     [all_persons_summary[imsi]['status'] for imsi in imsis],
+                     presence_df.values.astype(np.uint8))
+
+
+# Sharded mode
+# IMSIs are hash-partitioned into shards. Each day's observed users are written to
+# shards_filepath/SHARD/I_DATE.csv, then presence is inferred for each shard independently.
+
+def get_shards(imsis, n_shards):
+    """
+    returns the shard of each imsi, by a hash that is stable across days, processes and dtypes
+    (see get_user_hashes), so that the days of a user are in one shard
+    """
+    return get_user_hashes(imsis) % np.uint64(n_shards)
+
+
+def get_shard_filepath(shards_filepath, shard):
+    return '%s%s/' % (shards_filepath, shard)
+
+
+def partition_day_observed(args):
+    """
+    Reads a day's observed users and writes them to the shard files.
+    returns (i_date, number of users, day sketches), with None users if the file is missing.
+    The day's sketches, if sketches_mode is not NO_SKETCHES, are merged by the caller.
+    """
+    (data_filepath, i_date, date, n_shards, shards_filepath, sketches_mode, sketch_precision, mcc_grouping,
+     sample_rate) = args
+    set_sample_rate(sample_rate)
+    stays_filepath = find_input(get_stays_filepath, data_filepath, sample_rate, date.day, date.month, date.year)
+    if not pathlib.Path(stays_filepath).is_file():
+        return i_date, None, None
+    users = read_csv(stays_filepath, usecols=[IMSI, MCC, PARISH])[[IMSI, MCC, PARISH]].dropna()
+    day_sketches = create_sketches([date], sketches_mode, sketch_precision, mcc_grouping)
+    if day_sketches is not None:
+        add_day_sketches(day_sketches, date, users, mcc_grouping)
+    users = users[~users[IMSI].duplicated(keep='first')][[IMSI, MCC]]
+    if users[IMSI].dtype.kind == 'f':
+        # a missing imsi in the day's csv makes the column float
+        users[IMSI] = users[IMSI].astype(np.int64)
+    users[MCC] = users[MCC].astype(str)
+    shards = get_shards(users[IMSI].values, n_shards)
+    for shard in range(n_shards):
+        users[shards == shard].to_csv('%s%s.csv' % (get_shard_filepath(shards_filepath, shard), i_date), index=False)
+    return i_date, len(users), day_sketches
+
+
+def get_shard_persons_summary(shard_filepath, datetimes):
+    """
+    returns the all_persons_summary (as returned by get_days_observed) for the users in a shard
+    """
+    all_persons_summary = {}
+    for i_date, date in enumerate(datetimes):
+        fpath = '%s%s.csv' % (shard_filepath, i_date)
+        if not pathlib.Path(fpath).is_file():
+            continue
+        users = pd.read_csv(fpath, dtype={MCC: str})
+        for imsi, mcc in zip(users[IMSI].values, users[MCC].values):
+            if imsi not in all_persons_summary:
+                all_persons_summary[imsi]={'mcc': mcc, 'months':set([date.month]),'ind_days_observed':set([i_date])}
+            else:
+                all_persons_summary[imsi]['months'].add(date.month)
+                all_persons_summary[imsi]['ind_days_observed'].add(i_date)
+    return all_persons_summary
+
+
+def process_shard(args):
+    """
+    Infers presence for the users in a shard and writes the shard's presence tables.
+    returns (tourists_present, non_tourists_present, entrance_departure_df)
+    """
+    (shard, shards_filepath, datetimes, ind_missing_dates, window, presence_format, mcc_grouping,
+     metrics_log_filepath) = args
+    instrumentation = Instrumentation('presence shard %s' % shard, metrics_log_filepath=metrics_log_filepath)
+    shard_filepath = get_shard_filepath(shards_filepath, shard)
+    all_persons_summary = get_shard_persons_summary(shard_filepath, datetimes)
+    presence_df, entrance_departure_df = get_presence_entrances_departures_dfs(
+        datetimes, all_persons_summary, ind_missing_dates, window, instrumentation, mcc_grouping)
+    mark_statuses(all_persons_summary)
+    presence_df_tourists, presence_df_non_tourists = split_presence_df(presence_df, all_persons_summary)
+    if presence_format in [CSV, BOTH]:
+        presence_df_tourists.to_csv('%spresence_%s.csv' % (shard_filepath, TOURIST))
+        presence_df_non_tourists.to_csv('%spresence_%s.csv' % (shard_filepath, RESIDENT))
+    if presence_format in [STORE, BOTH]:
+        write_presence_store('%spresence.store/' % shard_filepath, presence_df, all_persons_summary)
+    return count_present(presence_df_tourists), count_present(presence_df_non_tourists), entrance_departure_df
+
+
+def concat_csvs(fpaths, output_filepath):
+    """
+    Concatenates csv files with the same header without loading them as tables.
+    """
+    with open(output_filepath, 'w') as output_f:
+        for i, fpath in enumerate(fpaths):
+            with open(fpath) as f:
+                header = f.readline()
+                if i == 0:
+                    output_f.write(header)
+                shutil.copyfileobj(f, output_f)
+
+
+def get_presence_sharded(data_filepath, datetimes, window, n_shards, n_workers,
+                         presence_tourists_filepath, presence_others_filepath,
+                         presence_store_filepath=None, presence_format=CSV, instrumentation=None,
+                         mcc_grouping=DEFAULT_MCC_GROUPING, sketches=None):
+    """
+    Computes presence, entrances and departures with users hash-partitioned into shards,
+    processed on a pool of n_workers processes.
+    Saves the presence tables for tourists and others and/or the presence store.
+    If sketches (DistinctSketches) are given, each day's users are added to them.
+    returns (tourists_present, non_tourists_present, entrance_departure_df)
+    """
+    if instrumentation is None:
+        instrumentation = Instrumentation('presence')
+    shards_filepath = str(pathlib.Path(presence_tourists_filepath).parent) + '/shards/'
+    # files left by a failed run would be read as observations of this run
+    shutil.rmtree(shards_filepath, ignore_errors=True)
+    for shard in range(n_shards):
+        pathlib.Path(get_shard_filepath(shards_filepath, shard)).mkdir(parents=True, exist_ok=True)
+    ind_missing_dates = []
+    with multiprocessing.Pool(n_workers) as pool:
+        with instrumentation.stage('partition days', rows_in=len(datetimes)) as stage_record:
+            stage_record.rows_out = 0
+            sketches_mode = NO_SKETCHES if sketches is None else (EXACT if sketches.exact else HLL)
+            sketch_precision = DEFAULT_PRECISION if sketches is None else sketches.precision
+            for i_date, n_users, day_sketches in pool.imap_unordered(partition_day_observed, [
+                    (data_filepath, i_date, date, n_shards, shards_filepath, sketches_mode, sketch_precision,
+                     mcc_grouping, get_sample_rate())
+                    for i_date, date in enumerate(datetimes)]):
+                if n_users is None:
+                    ind_missing_dates += [i_date]
+                    print('%s\nfile not found' % datetimes[i_date].strftime(date_fmt))
+                else:
+                    stage_record.rows_out += n_users
+                if day_sketches is not None:
+                    sketches.merge_day(datetimes[i_date], day_sketches)
+        ind_missing_dates = sorted(ind_missing_dates)
+        print('partitioned users into %s shards. %s missing dates' % (n_shards, ind_missing_dates))
+        with instrumentation.stage('infer presence shards', rows_in=n_shards):
+            shard_results = pool.map(process_shard, [
+                (shard, shards_filepath, datetimes, ind_missing_dates, window, presence_format,
+                 mcc_grouping, instrumentation.metrics_log_filepath)
+                for shard in range(n_shards)])
+    # merge the additive counts across shards
+    tourists_present = sum(r[0] for r in shard_results)
+    non_tourists_present = sum(r[1] for r in shard_results)
+    entrance_departure_df = sum(r[2] for r in shard_results)
+    with instrumentation.stage('save presence'):
+        if presence_format in [CSV, BOTH]:
+            print('saving tourists presence data to %s' % presence_tourists_filepath)
+            concat_csvs(['%spresence_%s.csv' % (get_shard_filepath(shards_filepath, shard), TOURIST)
+                         for shard in range(n_shards)], presence_tourists_filepath)
+            print('saving others presence data to %s' % presence_others_filepath)
+            concat_csvs(['%spresence_%s.csv' % (get_shard_filepath(shards_filepath, shard), RESIDENT)
+                         for shard in range(n_shards)], presence_others_filepath)
+        if presence_format in [STORE, BOTH]:
+            print('saving presence store to %s' % presence_store_filepath)
+            merge_stores(['%spresence.store/' % get_shard_filepath(shards_filepath, shard)
+                          for shard in range(n_shards)], presence_store_filepath)
+    shutil.rmtree(shards_filepath)
+    return tourists_present, non_tourists_present, entrance_departure_df
+
+
+def add_arguments(parser):
+    parser.add_argument('--start_date', required=True)
+    parser.add_argument('--end_date', required=True)
+    parser.add_argument('--data_filepath', required=True)
+    parser.add_argument('--outputs_filepath', required=True)
+    parser.add_argument('--window', default=DEFAULT_WINDOW)
+    parser.add_argument('--n_shards', type=int, default=1,
+                        help='number of IMSI shards. 1 processes all users in one process.')
+    parser.add_argument('--n_workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes in sharded mode')
+    parser.add_argument('--presence_format', default=BOTH, choices=PRESENCE_FORMATS,
+                        help='save per-user presence as csv tables, a presence store, or both')
+    parser.add_argument('--nationality_groups', default=None,
+                        help='entrances and departures by "country", or by the groups of a '
+                             '/path/to/groups.json of {group name: [MCCs, country names or ISO codes]}. '
+                             'Defaults to the nationalities of mcc_names_dict.')
+    parser.add_argument('--sketches', default=NO_SKETCHES, choices=SKETCHES,
+                        help='save distinct user sketches by day, nationality group and parish: '
+                             'none (default), hll (HyperLogLog) or exact (HyperLogLog and exact user hashes)')
+    parser.add_argument('--sketch_precision', type=int, default=DEFAULT_PRECISION,
+                        help='log2 of the number of HyperLogLog registers. '
+                             'The standard error is 1.04 / sqrt(2**precision).')
+    add_sampling_args(parser)
+    return parser
+
+
+def main(args, instrumentation):
+    datetimes = get_datetimes(args.start_date, args.end_date)
+    start_date = datetimes[0]
+    data_filepath, outputs_filepath = args.data_filepath, args.outputs_filepath
+    window = int(args.window)
+    print('--- get presence, entrances, departures with %s-day window ---' % window)
+    print('datetimes: %s - %s' % (datetimes[0], datetimes[-1]))
+    sample_rate = set_sample_rate(args.sample_rate)
+    # per-user outputs of a sample are kept apart from those of all users
+    sample_data_filepath = get_sample_path(data_filepath, sample_rate)
+    if sample_rate < 1:
+        pathlib.Path(get_presence_path(sample_data_filepath, start_date.year)).mkdir(parents=True, exist_ok=True)
+    presence_tourists_filepath = get_presence_filepath(sample_data_filepath, start_date.year, window, TOURIST)
+    presence_others_filepath = get_presence_filepath(sample_data_filepath, start_date.year, window, RESIDENT)
+    presence_store_filepath = get_presence_store_filepath(sample_data_filepath, start_date.year, window)
+    mcc_grouping = get_mcc_grouping(args.nationality_groups, default=DEFAULT_MCC_GROUPING)
+    sketches = create_sketches(datetimes, args.sketches, args.sketch_precision, mcc_grouping)
+    if args.n_shards > 1:
+        print('using %s shards and %s workers' % (args.n_shards, args.n_workers))
+        tourists_present, non_tourists_present, entrance_departure_df = get_presence_sharded(
+            data_filepath, datetimes, window, args.n_shards, args.n_workers,
+            presence_tourists_filepath, presence_others_filepath,
+            presence_store_filepath, args.presence_format, instrumentation, mcc_grouping, sketches)
+    else:
+        all_persons_summary, ind_missing_dates= get_days_observed(
+            data_filepath, datetimes, instrumentation, sketches, mcc_grouping)
+        print('computed all_persons_summary for %s-day window. %s missing dates' % (window, ind_missing_dates))
+        presence_df, entrance_departure_df = get_presence_entrances_departures_dfs(
+            datetimes, all_persons_summary, ind_missing_dates, window, instrumentation, mcc_grouping)
+        print('computed presence, entrance_departure dfs')
+        mark_statuses(all_persons_summary)
+        # Save presence dataframe: one csv for tourists and one for others
+        presence_df_tourists, presence_df_non_tourists = split_presence_df(presence_df, all_persons_summary)
+        with instrumentation.stage('save presence', rows_in=len(presence_df)):
+            if args.presence_format in [CSV, BOTH]:
+                print('saving tourists presence data to %s' % presence_tourists_filepath)
+                presence_df_tourists.to_csv(presence_tourists_filepath)
+                print('saving others presence data to %s' % presence_others_filepath)
+                presence_df_non_tourists.to_csv(presence_others_filepath)
+            if args.presence_format in [STORE, BOTH]:
+                print('saving presence store to %s' % presence_store_filepath)
+                write_presence_store(presence_store_filepath, presence_df, all_persons_summary)
+        assert(
+            len(presence_df_tourists.columns) == \
+            len(presence_df_non_tourists.columns) == \
+            len(datetimes)
+        )
+        tourists_present = count_present(presence_df_tourists)
+        non_tourists_present = count_present(presence_df_non_tourists)
+
+    if sketches is not None:
+        sketches_filepath = get_sketches_filepath(sample_data_filepath, start_date.year)
+        print('saving distinct user sketches to %s' % sketches_filepath)
+        sketches.save(sketches_filepath)
+
+    # make aggregate presence table and save in public outputs/metrics
+    aggregate_presence_df = get_aggregate_presence_df(datetimes, tourists_present, non_tourists_present)
+    scale_counts(aggregate_presence_df, list(aggregate_presence_df.columns), sample_rate)
+    aggregate_presence_filepath = ('%s%s/presence%s%s.csv'%(
+        outputs_filepath, start_date.year, ('_%s_day_window'%window if window!=DEFAULT_WINDOW else ''),
+        get_sample_suffix(sample_rate)
     ))
     print('saving aggregate_presence data to %s' % aggregate_presence_filepath)
     aggregate_presence_df.to_csv(aggregate_presence_filepath, index=True, index_label=DATE)
 
     # save entrances and departures data to public outputs/metrics
-    entrance_departure_filepath = ('%s%s/entrance_departure%s.csv'%(
-        outputs_filepath, start_date.year, ('_%s_day_window'%window if window!=DEFAULT_WINDOW else '')
+    scale_counts(entrance_departure_df, list(entrance_departure_df.columns), sample_rate)
+    entrance_departure_filepath = ('%s%s/entrance_departure%s%s.csv'%(
+        outputs_filepath, start_date.year, ('_%s_day_window'%window if window!=DEFAULT_WINDOW else ''),
+        get_sample_suffix(sample_rate)
     ))
     print('saving entrance_departure data to %s' % entrance_departure_filepath)
     entrance_departure_df.to_csv(entrance_departure_filepath, index=True, index_label=DATE)
     print('saved')
-    
\ No newline at end of file
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Computes likely dates of presence, entrances, departures \
+                    for each user in the data, based on the dates they are \
+                    observed in the data.')
+    add_arguments(parser)
+    add_instrumentation_args(parser)
+    args = parser.parse_args()
+    instrumentation = Instrumentation.from_args('presence', args)
+    main(args, instrumentation)
+    instrumentation.print_summary()
@@ -0,0 +1,295 @@
+"""
+Stay home
+-------------
+Computes the daily number of users staying home, by home parish, from the
+inferred homes (see infer_homes.py) and the daily stays.
+
+For each day and each home parish:
+    users: users present on the day with an inferred home parish for the month
+    stay home users: users present who did not make a trip, i.e. who had
+        at most one stay on the day and no stay outside their home parish
+    home parish users: users present whose stays all lie in their home parish
+        (they may have made trips within their home parish)
+
+Users present but not observed on a day count as staying home.
+This reproduces the stay home users metric of staying_home.ipynb.
+
+IMSIs are coded as integers (their position in the month's homes table) so that the
+per-user reductions are bincounts over codes. Presence is read from the presence
+tables in chunks of users and reduced to daily counts by home parish, so the full
+presence matrix is never held in memory.
+Presence can also be read from a presence store (see andorra_mobility/presence_store.py),
+which only reads the bits of the requested days.
+If no presence files are given, the users observed on each day are used instead.
+
+With --sample_rate < 1, only a stable sample of users is counted (see andorra_mobility/sampling.py):
+the homes of the users kept are read, and users without a home are ignored, so presence
+files of all users or of a larger sample can be used. The counts are scaled up to all
+users, with a standard error column for each.
+
+
+Usage:
+python stay_home.py \
+    --start_date=yyyy-mm-dd \
+    --end_date=yyyy-mm-dd \
+    --data_filepath=PATH \
+    --outputs_filepath=PATH \
+    [--presence_filepaths=PATH,PATH] \
+    [--presence_store=PATH] \
+    [--sample_rate=FLOAT]
+
+Example usage:
+nohup python stay_home.py \
+  --start_date=2020-03-01 \
+  --end_date=2020-10-31 \
+  --data_filepath=/home/data_commons/andorra_data_2020/  \
+  --outputs_filepath=./outputs/metrics/ \
+  --presence_store=/home/data_commons/andorra_data_2020/presence/2020/presence.store \
+  > nohup_stay_home_2020.out &
+
+Instrumentation options (see andorra_mobility/instrumentation.py):
+    [--metrics_log=PATH] [--profile_day=yyyy-mm-dd] [--profiler=cprofile|sampling]
+
+
+Reads homes from data_filepath/homes/YYYY_M_homes.csv
+and stays from data_filepath/stays/YYYY_M/stays_YYYY_M_D.csv
+
+Saves daily stay home counts by home parish to
+outputs_filepath/YEAR/stay_home.csv:
+-------------
+date, parish, users, stay home users, home parish users
+or, with --sample_rate < 1, to stay_home_sample_RATE.csv:
+date, parish, users, stay home users, home parish users, users se, stay home users se, home parish users se
+
+"""
+import pathlib
+
+import numpy as np
+import pandas as pd
+
+from andorra_mobility.inputs import read_csv
+from andorra_mobility.instrumentation import Instrumentation, add_instrumentation_args
+from andorra_mobility.paths import (date_fmt, find_input, get_datetimes, get_homes_filepath, get_sample_suffix,
+                                    get_stays_filepath)
+from andorra_mobility.presence_store import PresenceStore
+from andorra_mobility.sampling import add_sampling_args, get_sample_rate, scale_counts, set_sample_rate
+
+IMSI = 'imsi'
+PARISH = 'parish'
+DATE = 'date'
+
+USERS = 'users'
+STAY_HOME_USERS = 'stay home users'
+HOME_PARISH_USERS = 'home parish users'
+
+PARISHES = ['Andorra la Vella', 'Canillo', 'Encamp', 'Escaldes-Engordany',
+            'La Massana', 'Ordino', 'Sant Julià de Lòria']
+
+PRESENCE_CHUNKSIZE = 100000
+
+
+def get_parish_codes(parishes):
+    """
+    Returns the index of each parish in PARISHES, or -1 for missing or unknown parishes.
+    """
+    return pd.Categorical(parishes, categories=PARISHES).codes.astype(np.int64)
+
+
+class MonthHomes:
+    """
+    A month's inferred homes, with IMSIs coded as their position in the homes table.
+    """
+
+    def __init__(self, homes_df):
+        self.imsi_index = pd.Index(homes_df[IMSI].values)
+        self.home_parish_codes = get_parish_codes(homes_df[PARISH].values)
+
+    @classmethod
+    def read(cls, data_filepath, year, month):
+        fpath = find_input(get_homes_filepath, data_filepath, get_sample_rate(), year, month)
+        if not pathlib.Path(fpath).is_file():
+            print('homes file not found: %s' % fpath)
+            return None
+        return cls(read_csv(fpath, usecols=[IMSI, PARISH]))
+
+    def get_codes(self, imsis):
+        """
+        Returns the int code of each imsi, or -1 for imsis without a home.
+        """
+        return self.imsi_index.get_indexer(imsis)
+
+    def __len__(self):
+        return len(self.imsi_index)
+
+
+def get_day_stay_home_counts(stays_df, month_homes):
+    """
+    Reduces a day's stays to counts by home parish.
+    Returns (observed users, non stay home users, users with stays outside their home parish),
+    each an array indexed by parish code.
+    """
+    codes = month_homes.get_codes(stays_df[IMSI].values)
+    parish_codes = get_parish_codes(stays_df[PARISH].values)
+    # stays outside Andorra, and users without a home, are ignored
+    keep = (codes >= 0) & (parish_codes >= 0)
+    codes, parish_codes = codes[keep], parish_codes[keep]
+    home_codes = month_homes.home_parish_codes[codes]
+    keep = home_codes >= 0
+    codes, parish_codes, home_codes = codes[keep], parish_codes[keep], home_codes[keep]
+    n_users = len(month_homes)
+    n_stays = np.bincount(codes, minlength=n_users)
+    n_stays_outside_home = np.bincount(codes, weights=(parish_codes != home_codes), minlength=n_users)
+    observed = n_stays > 0
+    outside_home = n_stays_outside_home > 0
+    non_stay_home = outside_home | (n_stays > 1)
+    home_parish_codes = month_homes.home_parish_codes
+    counts = []
+    for user_mask in [observed, non_stay_home, outside_home]:
+        counts.append(np.bincount(home_parish_codes[user_mask], minlength=len(PARISHES)))
+    return counts
+
+
+def get_presence_counts(presence_filepaths, datetimes, homes_by_month, instrumentation):
+    """
+    Streams over the presence tables in chunks of users and returns an array
+    (days x parishes) of the number of users present on each day by home parish.
+    """
+    presence_counts = np.zeros((len(datetimes), len(PARISHES)), dtype=np.int64)
+    ind_date_by_date_str = {d.strftime(date_fmt): i for i, d in enumerate(datetimes)}
+    for fpath in presence_filepaths:
+        with instrumentation.stage('presence counts') as stage_record:
+            stage_record.rows_in = 0
+            for chunk in pd.read_csv(fpath, index_col=0, chunksize=PRESENCE_CHUNKSIZE):
+                stage_record.rows_in += len(chunk)
+                ind_dates = np.array([ind_date_by_date_str.get(d, -1)
+                                      for d in pd.to_datetime(chunk.columns).strftime(date_fmt)])
+                present = chunk.values > 0
+                for (year, month), month_homes in homes_by_month.items():
+                    cols = [c for c, i_d in enumerate(ind_dates)
+                            if i_d >= 0 and (datetimes[i_d].year, datetimes[i_d].month) == (year, month)]
+                    if month_homes is None or not cols:
+                        continue
+                    codes = month_homes.get_codes(chunk.index.values)
+                    home_codes = np.where(codes >= 0, month_homes.home_parish_codes[codes], -1)
+                    user_inds, col_inds = np.nonzero(present[:, cols] & (home_codes >= 0)[:, None])
+                    flat_inds = ind_dates[cols][col_inds] * len(PARISHES) + home_codes[user_inds]
+                    presence_counts += np.bincount(
+                        flat_inds, minlength=presence_counts.size).reshape(presence_counts.shape)
+    return presence_counts
+
+
+def get_presence_counts_from_store(presence_store, datetimes, homes_by_month, instrumentation):
+    """
+    Returns an array (days x parishes) of the number of users present on each day by home parish,
+    from a PresenceStore.
+    """
+    presence_counts = np.zeros((len(datetimes), len(PARISHES)), dtype=np.int64)
+    store_dates = set(presence_store.dates)
+    for (year, month), month_homes in homes_by_month.items():
+        inds = [i for i, d in enumerate(datetimes)
+                if (d.year, d.month) == (year, month) and pd.Timestamp(d) in store_dates]
+        if month_homes is None or not inds:
+            continue
+        with instrumentation.stage('presence counts', rows_in=len(presence_store)):
+            codes = month_homes.get_codes(np.asarray(presence_store.imsi))
+            home_codes = np.where(codes >= 0, month_homes.home_parish_codes[codes], -1)
+            # days within a month are contiguous
+            presence_counts[inds[0]:inds[-1] + 1] = presence_store.count_by_group(
+                datetimes[inds[0]], datetimes[inds[-1]], home_codes, len(PARISHES))
+    return presence_counts
+
+
+def get_stay_home_df(data_filepath, datetimes, presence_filepaths=None, instrumentation=None,
+                     presence_store=None):
+    """
+    Returns (stay_home_df, missing_dates).
+    Presence is read from presence_store (a PresenceStore) if given, otherwise from presence_filepaths.
+    stay_home_df has one row per date and parish with columns:
+        date, parish, users, stay home users, home parish users
+    and, at a sample rate below 1, the standard error of each count.
+    """
+    if instrumentation is None:
+        instrumentation = Instrumentation('stay home')
+    sample_rate = get_sample_rate()
+    months = sorted(set((d.year, d.month) for d in datetimes))
+    homes_by_month = {(year, month): MonthHomes.read(data_filepath, year, month) for year, month in months}
+    presence_counts = None
+    if presence_store is not None:
+        presence_counts = get_presence_counts_from_store(presence_store, datetimes, homes_by_month, instrumentation)
+    elif presence_filepaths:
+        presence_counts = get_presence_counts(presence_filepaths, datetimes, homes_by_month, instrumentation)
+
+    records = []
+    missing_dates = []
+    for i, d in enumerate(datetimes):
+        month_homes = homes_by_month[(d.year, d.month)]
+        stays_filepath = find_input(get_stays_filepath, data_filepath, sample_rate, d.day, d.month, d.year)
+        if month_homes is None or not pathlib.Path(stays_filepath).is_file():
+            print('%s\nfile not found: %s' % (d.strftime(date_fmt), stays_filepath))
+            missing_dates += [d]
+            for p in PARISHES:
+                records += [{DATE: d, PARISH: p, USERS: np.nan,
+                             STAY_HOME_USERS: np.nan, HOME_PARISH_USERS: np.nan}]
+            continue
+        with instrumentation.stage('stay home day', day=d) as stage_record:
+            stays_df = read_csv(stays_filepath, usecols=[IMSI, PARISH])
+            stage_record.rows_in = len(stays_df)
+            observed, non_stay_home, outside_home = get_day_stay_home_counts(stays_df, month_homes)
+            users = observed if presence_counts is None else presence_counts[i]
+            for p_ind, p in enumerate(PARISHES):
+                records += [{
+                    DATE: d,
+                    PARISH: p,
+                    USERS: users[p_ind],
+                    STAY_HOME_USERS: users[p_ind] - non_stay_home[p_ind],
+                    HOME_PARISH_USERS: users[p_ind] - outside_home[p_ind],
+                }]
+            stage_record.rows_out = len(PARISHES)
+    stay_home_df = pd.DataFrame.from_records(records)
+    scale_counts(stay_home_df, [USERS, STAY_HOME_USERS, HOME_PARISH_USERS], sample_rate)
+    return stay_home_df, missing_dates
+
+
+def add_arguments(parser):
+    parser.add_argument('--start_date', required=True)
+    parser.add_argument('--end_date', required=True)
+    parser.add_argument('--data_filepath', required=True)
+    parser.add_argument('--outputs_filepath', required=True)
+    parser.add_argument('--presence_filepaths', default=None,
+                        help='comma separated /path/to/presence.csv files. '
+                             'Defaults to using the users observed each day.')
+    parser.add_argument('--presence_store', default=None,
+                        help='/path/to/presence.store to read presence from instead of presence csv files')
+    add_sampling_args(parser)
+    return parser
+
+
+def main(args, instrumentation):
+    datetimes = get_datetimes(args.start_date, args.end_date)
+    start_date = datetimes[0]
+    print('--- get stay home users ---')
+    print('datetimes: %s - %s' % (datetimes[0], datetimes[-1]))
+    sample_rate = set_sample_rate(args.sample_rate)
+    presence_filepaths = args.presence_filepaths.split(',') if args.presence_filepaths else None
+    presence_store = PresenceStore.open(args.presence_store) if args.presence_store else None
+    stay_home_df, missing_dates = get_stay_home_df(
+        args.data_filepath, datetimes, presence_filepaths, instrumentation, presence_store)
+    print('computed stay home users. %s/%s missing dates' % (len(missing_dates), len(datetimes)))
+    stay_home_filepath = ('%s%s/stay_home%s.csv' % (
+        args.outputs_filepath, start_date.year, get_sample_suffix(sample_rate)))
+    print('saving stay home data to %s' % stay_home_filepath)
+    stay_home_df.to_csv(stay_home_filepath, index=False)
+    print('saved')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Computes the daily number of users staying home, by home parish.')
+    add_arguments(parser)
+    add_instrumentation_args(parser)
+    args = parser.parse_args()
+    instrumentation = Instrumentation.from_args('stay home', args)
+    main(args, instrumentation)
+    instrumentation.print_summary()
@@ -1,11 +1,6 @@
-from pyspark import SparkContext
-from pyspark.sql import SparkSession
-from pyspark.sql.functions import lit
-
-spark = SparkSession.builder.appName("Get_Stays New").getOrCreate()
-sc = spark.sparkContext
-
+import bisect
 import datetime
+import hashlib
 import json
 import math
 
@@ -13,6 +8,30 @@ import math
 DIR4G=''
 DIR3G=''
 
+# =============================================================================
+# Constants
+# =============================================================================
+
+MAX_ROAM=200
+MIN_STAY=10*60
+
+# IMSIs with more than HEAVY_OBSERVATIONS observations in a day (e.g. IoT devices)
+# are split into chunks of about CHUNK_OBSERVATIONS observations, at most MAX_CHUNKS,
+# whose stays are detected in parallel (see Heavy IMSIs below)
+HEAVY_OBSERVATIONS=100000
+CHUNK_OBSERVATIONS=20000
+MAX_CHUNKS=32
+# IMSIs with more than --quarantine_observations observations in a day are left out
+# of the stays and reported in stays/quarantine_YYYY_M_D. None to keep all IMSIs.
+DEFAULT_QUARANTINE_OBSERVATIONS=None
+# --sample_rate: fraction of IMSIs whose stays are detected, by a stable hash of the IMSI, so that
+# the same IMSIs are kept on every day (see andorra_mobility/sampling.py). 1.0 to keep all IMSIs.
+DEFAULT_SAMPLE_RATE=1.0
+
+# the sampling hash of andorra_mobility/sampling.py (imsi_hash), which the executors cannot import
+SAMPLE_SALT=0x5BD1E9955BD1E995
+MASK_64=(1 << 64) - 1
+
 
 def get_haversine_distance(point_1, point_2):
     """
@@ -29,17 +48,36 @@ def get_haversine_distance(point_1, point_2):
     r = 6371000 # Radius of earth in kilometers. Use 3956 for miles
     return c * r
 
-def get_stay_points(line):
+def is_sampled_imsi(imsi, sample_rate=DEFAULT_SAMPLE_RATE):
     """
-    takes a line of an rdd containing all the RNC observations for one person
-    Returns a line containing all the stay-points for that person 
+    Returns whether an IMSI is kept at sample_rate, as andorra_mobility.sampling.is_sampled
     """
-    imsi=line[0]
-    ts, lat, lon, mcc, is_4G, cellid=line[1]
-    ts_unix=[(ts[i] - datetime.datetime(1970,1,1)).total_seconds()%(24*60*60) for i in range(len(ts))]
+    if sample_rate>=1:
+        return True
+    try:
+        x=int(imsi)
+    except ValueError:
+        x=int.from_bytes(hashlib.blake2b(str(imsi).encode(), digest_size=8,
+                                         key=SAMPLE_SALT.to_bytes(8, 'little')).digest(), 'little')
+    else:
+        x=(x ^ SAMPLE_SALT) & MASK_64
+        x=((x ^ (x >> 33)) * 0xFF51AFD7ED558CCD) & MASK_64
+        x=((x ^ (x >> 33)) * 0xC4CEB9FE1A85EC53) & MASK_64
+        x=x ^ (x >> 33)
+    return (x >> 11) / 2.0**53 < sample_rate
+
+def get_seconds_of_day(ts):
+    return (ts - datetime.datetime(1970,1,1)).total_seconds()%(24*60*60)
+
+def get_sorted_observations(ts, lat, lon, is_4G, cellid):
+    """
+    Drops the observations of tower 14 and sorts the observations by time of day.
+    returns ts_unix, lat, lon, is_4G
+    """
+    ts_unix=[get_seconds_of_day(t) for t in ts]
 
     # drop observations of tower 14
-    drop_ind=[i for i in range(len(cellid)) if cellid[i]=='14']
+    drop_ind=set(i for i in range(len(cellid)) if cellid[i]=='14')
     ts_unix=[ts_unix[i] for i in range(len(ts_unix)) if i not in drop_ind]
     lat=[lat[i] for i in range(len(lat)) if i not in drop_ind]
     lon=[lon[i] for i in range(len(lon)) if i not in drop_ind]
@@ -55,6 +93,16 @@ def get_stay_points(line):
     # cellid=[x_2 for (x_1, x_2) in sorted(zip(ts_unix,cellid))]
     #then sort the timestamp itself
     ts_unix.sort()
+    return ts_unix, lat, lon, is_4G
+
+def get_stay_points(line):
+    """
+    takes a line of an rdd containing all the RNC observations for one person
+    Returns a line containing all the stay-points for that person 
+    """
+    imsi=line[0]
+    ts, lat, lon, mcc, is_4G, cellid=line[1]
+    ts_unix, lat, lon, is_4G=get_sorted_observations(ts, lat, lon, is_4G, cellid)
 
     stay_points=[]
     i=0
@@ -76,60 +124,396 @@ def get_stay_points(line):
                                  'n_4G': sum(is_4G[i:j+1])}])      
         i=j+1
     return {'mcc': mcc, 'stay_points': stay_points, 'imsi': imsi}
-        
-year=2020
-dates=[{'month': 3, 'day': d} for d in range(2, 32)] + [{'month': 4, 'day': d} for d in range(1, 31)] + [{'month': 5, 'day': d} for d in range(1, 32)]
 
-hour='*'
 # =============================================================================
-# Constants
+# Heavy IMSIs
 # =============================================================================
+# reduceByKey puts all the observations of an IMSI in one list, processed by one task.
+# The observations of heavy IMSIs are instead split into chunks of consecutive times
+# of day, and the stays of the chunks are detected in parallel.
+#
+# Clusters are greedy: a cluster starting at point i takes the next points while they
+# are within MAX_ROAM of point i. Each chunk is clustered as if a cluster started at its
+# first point, and its last cluster is open: it may continue in the next chunk.
+# The chunks are then stitched in order, carrying the open cluster into the next chunk:
+# - the chunk is scanned for the first point outside the carried cluster
+# - clustering restarts from that point until it reaches a cluster start of the chunk's
+#   own clustering, after which the chunk's clusters are those of a single pass
+# so the stays are the same as get_stay_points'.
+# Scans need the chunk's observations and run in rounds where the chunks are. Each chunk
+# is scanned ahead for the open cluster of the previous chunk, so that most IMSIs are
+# stitched in one round.
 
-MAX_ROAM=200
-MIN_STAY=10*60
+def get_n_chunks(n_observations):
+    return max(1, min(MAX_CHUNKS, int(math.ceil(n_observations/CHUNK_OBSERVATIONS))))
 
-# =============================================================================
-# Get the RNC data for the period
-# =============================================================================
-for date in dates:
-    month=date['month']
-    day=date['day']
-    print('RNC data')
-    rnc_4G_Df=spark.read.parquet('{}/year={}/month={}/day={}/hour={}/*.snappy.parquet'.format(DIR4G, year, month, day, hour))
-    rnc_3G_Df=spark.read.parquet('{}/year={}/month={}/day={}/hour={}/*.snappy.parquet'.format(DIR3G, year, month, day, hour))
-
-    rnc_3G_Df=rnc_3G_Df.withColumn('4G', lit(0))
-    rnc_4G_Df=rnc_4G_Df.withColumn('4G', lit(1))
-
-    print('Union')
-    rnc_Df=rnc_4G_Df.union(rnc_3G_Df)
-
-    print('Transform')
-    rncRdd=rnc_Df.rdd
-    byIMSE = rncRdd.map(lambda x: (x['imsi'], 
-                                    [[x['timestamp']],[x['lat']],
-                                     [x['lon']], x['mcc'], [x['4G']], 
-                                     # [str(x['indooroutdoor'])], 
-                                     [str(x['cellid'])]])).reduceByKey(
-        lambda a, b: [a[0] + b[0],
-                      a[1] + b[1],
-                      a[2] + b[2],
-                      a[3],
-                      a[4] + b[4],
-		      a[5] + b[5]])
-		      # a[6] + b[6]])
-        
-    #byIMSE_part = byIMSE.sample(False, 0.1)
-    byIMSE_part=byIMSE
-
-
-    broadcastConstants = sc.broadcast({
-                                'MAX_ROAM':MAX_ROAM,
-                                'MIN_STAY':MIN_STAY
-                                })
-    print('Stay points')    
-    persons=byIMSE_part.map(get_stay_points)
-    persons.saveAsTextFile('stays/stays2_{}_{}_{}'.format(year, month, day))
+def get_chunk(ts, n_chunks):
+    """
+    returns the chunk of an observation: chunks are equal intervals of the day
+    """
+    return min(int(get_seconds_of_day(ts)*n_chunks/(24*60*60)), n_chunks-1)
+
+def get_chunk_observations(observations):
+    """
+    takes the observations of an IMSI's chunk, as grouped by reduceByKey
+    returns the chunk's sorted observations {ts, lat, lon, is_4G}
+    """
+    ts, lat, lon, mcc, is_4G, cellid=observations
+    ts_unix, lat, lon, is_4G=get_sorted_observations(ts, lat, lon, is_4G, cellid)
+    return {'ts': ts_unix, 'lat': lat, 'lon': lon, 'is_4G': is_4G}
+
+def get_cluster_end(chunk, i):
+    lat, lon=chunk['lat'], chunk['lon']
+    j=i
+    while ((j+1)<len(lon) and
+            (get_haversine_distance([lon[j+1],lat[j+1]],
+                            [lon[i],lat[i]])<MAX_ROAM)):
+        j+=1
+    return j
+
+def cluster_chunk(chunk, start=0, sync_starts=None):
+    """
+    Clusters a chunk's observations from start, as get_stay_points does.
+    Stops at the first cluster start in sync_starts, if given.
+    returns {starts, stays, sync, open}
+    starts: the start of each cluster
+    stays: the stay points of the clusters that end in the chunk, with their start i
+    sync: the start in sync_starts where clustering stopped, or None
+    open: the last cluster {p, i, s, l, n_4G}, if clustering reached the end of the chunk
+    """
+    ts, lat, lon, is_4G=chunk['ts'], chunk['lat'], chunk['lon'], chunk['is_4G']
+    starts=[]
+    stays=[]
+    i=start
+    while i<len(lon):
+        if sync_starts is not None and i in sync_starts:
+            return {'starts': starts, 'stays': stays, 'sync': i, 'open': None}
+        starts.append(i)
+        j=get_cluster_end(chunk, i)
+        if j==len(lon)-1:
+            open_cluster={'p': [lon[i], lat[i]], 'i': i, 's': ts[i], 'l': ts[j], 'n_4G': sum(is_4G[i:])}
+            return {'starts': starts, 'stays': stays, 'sync': None, 'open': open_cluster}
+        if (ts[j+1]-ts[i])>MIN_STAY:
+            stays.append({'p':[lon[int((i+j)/2)],lat[int((i+j)/2)]],
+                          's':ts[i],
+                          'l':ts[j],
+                          'e':ts[j+1],
+                          'n':(j-i+1),
+                          'n_4G': sum(is_4G[i:j+1]),
+                          'i': i})
+        i=j+1
+    return {'starts': starts, 'stays': stays, 'sync': None, 'open': None}
+
+def summarize_chunk(chunk):
+    """
+    Clusters a chunk as if a cluster started at its first observation.
+    returns {n, n_4G, last_ts, starts, stays, open}
+    """
+    summary=cluster_chunk(chunk)
+    del summary['sync']
+    summary.update({'n': len(chunk['ts']),
+                    'n_4G': sum(chunk['is_4G']),
+                    'last_ts': chunk['ts'][-1] if chunk['ts'] else None})
+    return summary
+
+def scan_chunk(chunk, summary, anchor):
+    """
+    Scans a chunk for the end of a cluster carried from the previous chunks,
+    whose first point is anchor [lon, lat], and clusters the chunk from there
+    until it reaches a cluster start of the chunk's summary.
+    returns {covered: True} if the carried cluster covers the chunk, else
+    {covered: False, exit, exit_ts, before_exit_ts, n_4G, stays, sync, open}
+    with n_4G the 4G observations before the exit
+    """
+    ts, lat, lon, is_4G=chunk['ts'], chunk['lat'], chunk['lon'], chunk['is_4G']
+    t=0
+    while t<len(lon) and get_haversine_distance([lon[t],lat[t]], anchor)<MAX_ROAM:
+        t+=1
+    if t==len(lon):
+        return {'covered': True}
+    scan=cluster_chunk(chunk, t, set(summary['starts']))
+    del scan['starts']
+    scan.update({'covered': False,
+                 'exit': t,
+                 'exit_ts': ts[t],
+                 'before_exit_ts': ts[t-1] if t>0 else None,
+                 'n_4G': sum(is_4G[:t])})
+    return scan
+
+
+class HeavyImsiStays:
+    """
+    Stitches the stay points of an IMSI from the summaries and scans of its chunks.
+    stitch() returns the scans it needs, [(chunk, anchor)], until the stays are stitched,
+    then get_point_requests() the observations at the middle of the stitched stays.
+    """
+    def __init__(self, imsi, mcc, summaries):
+        self.imsi=imsi
+        self.mcc=mcc
+        self.summaries=summaries
+        self.chunks=sorted(c for c in summaries if summaries[c]['n']>0)
+        self.offsets=[]
+        offset=0
+        for c in self.chunks:
+            self.offsets.append(offset)
+            offset+=summaries[c]['n']
+        self.n=offset
+        self.scans={}
+        self.points={}
+        self.stays=None
+
+    def add_scans(self, scans):
+        self.scans.update(scans)
+
+    def add_points(self, points):
+        self.points.update(points)
+
+    def _shift(self, k, cluster):
+        return dict(cluster, i=self.offsets[k]+cluster['i'])
+
+    def _close(self, cluster, j, l, e, n_4G):
+        # j is the last observation of the cluster, in the IMSI's observations
+        if (e-cluster['s'])>MIN_STAY:
+            return [{'mid': int((cluster['i']+j)/2),
+                     's': cluster['s'],
+                     'l': l,
+                     'e': e,
+                     'n': (j-cluster['i']+1),
+                     'n_4G': n_4G,
+                     'i': cluster['i']}]
+        return []
+
+    def _get_scan_requests(self, k, carried):
+        requests=[(self.chunks[k], tuple(carried['p']))]
+        # scan the next chunks ahead, for the open cluster of the chunk before
+        for k_next in range(k+1, len(self.chunks)):
+            open_cluster=self.summaries[self.chunks[k_next-1]]['open']
+            request=(self.chunks[k_next], tuple(open_cluster['p']))
+            if request not in self.scans:
+                requests.append(request)
+        return requests
+
+    def stitch(self):
+        stays=[]
+        carried=None
+        for k, c in enumerate(self.chunks):
+            summary=self.summaries[c]
+            if carried is None:
+                stays+=[self._shift(k, stay) for stay in summary['stays']]
+                carried=self._shift(k, summary['open'])
+                continue
+            scan=self.scans.get((c, tuple(carried['p'])))
+            if scan is None:
+                return self._get_scan_requests(k, carried)
+            if scan['covered']:
+                carried=dict(carried, l=summary['last_ts'], n_4G=carried['n_4G']+summary['n_4G'])
+                continue
+            l=scan['before_exit_ts'] if scan['exit']>0 else carried['l']
+            stays+=self._close(carried, self.offsets[k]+scan['exit']-1, l, scan['exit_ts'],
+                               carried['n_4G']+scan['n_4G'])
+            stays+=[self._shift(k, stay) for stay in scan['stays']]
+            if scan['sync'] is None:
+                carried=self._shift(k, scan['open']) if scan['open'] else None
+            else:
+                stays+=[self._shift(k, stay) for stay in summary['stays'] if stay['i']>=scan['sync']]
+                carried=self._shift(k, summary['open'])
+        if carried is not None:
+            # the last cluster ends with the last observation
+            stays+=self._close(carried, self.n-1, carried['l'], carried['l'], carried['n_4G'])
+        self.stays=stays
+        return []
+
+    def _get_chunk_index(self, i):
+        k=bisect.bisect_right(self.offsets, i)-1
+        return (self.chunks[k], i-self.offsets[k])
+
+    def get_point_requests(self):
+        return [self._get_chunk_index(stay['mid']) for stay in self.stays if 'p' not in stay]
+
+    def get_person(self):
+        stay_points=[]
+        for stay in self.stays:
+            p=stay['p'] if 'p' in stay else self.points[self._get_chunk_index(stay['mid'])]
+            stay_points.append({'p': p, 's': stay['s'], 'l': stay['l'], 'e': stay['e'],
+                                'n': stay['n'], 'n_4G': stay['n_4G']})
+        return {'mcc': self.mcc, 'stay_points': stay_points, 'imsi': self.imsi}
+
+
+def get_stay_points_chunked(line, n_chunks):
+    """
+    Same as get_stay_points, detecting the stays of n_chunks chunks separately
+    and stitching them, as get_heavy_persons does with Spark.
+    """
+    imsi=line[0]
+    ts, lat, lon, mcc, is_4G, cellid=line[1]
+    chunk_observations={}
+    for observation in zip(ts, lat, lon, is_4G, cellid):
+        chunk_observations.setdefault(get_chunk(observation[0], n_chunks), []).append(observation)
+    chunks={}
+    for c, observations in chunk_observations.items():
+        ts, lat, lon, is_4G, cellid=[list(x) for x in zip(*observations)]
+        chunks[c]=get_chunk_observations([ts, lat, lon, mcc, is_4G, cellid])
+    summaries={c: summarize_chunk(chunk) for c, chunk in chunks.items()}
+    stitcher=HeavyImsiStays(imsi, mcc, summaries)
+    requests=stitcher.stitch()
+    while requests:
+        stitcher.add_scans({(c, anchor): scan_chunk(chunks[c], summaries[c], anchor)
+                            for c, anchor in requests})
+        requests=stitcher.stitch()
+    stitcher.add_points({(c, i): [chunks[c]['lon'][i], chunks[c]['lat'][i]]
+                         for c, i in stitcher.get_point_requests()})
+    return stitcher.get_person()
+
+
+def get_observations(x):
+    return [[x['timestamp']],[x['lat']],
+            [x['lon']], x['mcc'], [x['4G']],
+            # [str(x['indooroutdoor'])],
+            [str(x['cellid'])]]
+
+def add_observations(a, b):
+    return [a[0] + b[0],
+            a[1] + b[1],
+            a[2] + b[2],
+            a[3],
+            a[4] + b[4],
+            a[5] + b[5]]
+            # a[6] + b[6]])
+
+def get_heavy_persons(sc, chunk_lines):
+    """
+    takes an rdd of the chunks of heavy IMSIs, ((imsi, chunk), observations)
+    Detects the stays of the chunks in parallel and stitches them on the driver.
+    Returns an rdd of persons, as get_stay_points
+    """
+    chunks=chunk_lines.map(lambda x: (x[0], (x[1][3], get_chunk_observations(x[1])))).map(
+        lambda x: (x[0], (x[1][0], x[1][1], summarize_chunk(x[1][1])))).cache()
+    imsi_summaries={}
+    for (imsi, c), (mcc, summary) in chunks.map(
+            lambda x: (x[0], (x[1][0], {k: v for k, v in x[1][2].items() if k!='starts'}))).collect():
+        imsi_summaries.setdefault(imsi, (mcc, {}))[1][c]=summary
+    stitchers=[HeavyImsiStays(imsi, mcc, summaries) for imsi, (mcc, summaries) in imsi_summaries.items()]
+    requests={}
+    for stitcher in stitchers:
+        for c, anchor in stitcher.stitch():
+            requests.setdefault((stitcher.imsi, c), []).append(anchor)
+    n_rounds=0
+    while requests:
+        n_rounds+=1
+        broadcastRequests=sc.broadcast(requests)
+        scans=chunks.filter(lambda x: x[0] in broadcastRequests.value).flatMap(
+            lambda x: [(x[0], anchor, scan_chunk(x[1][1], x[1][2], anchor))
+                       for anchor in broadcastRequests.value[x[0]]]).collect()
+        imsi_scans={}
+        for (imsi, c), anchor, scan in scans:
+            imsi_scans.setdefault(imsi, {})[(c, anchor)]=scan
+        requests={}
+        for stitcher in stitchers:
+            if stitcher.stays is None:
+                stitcher.add_scans(imsi_scans.get(stitcher.imsi, {}))
+                for c, anchor in stitcher.stitch():
+                    requests.setdefault((stitcher.imsi, c), []).append(anchor)
+    print('stitched %s heavy imsis in %s scan rounds' % (len(stitchers), n_rounds))
+    point_requests={}
+    for stitcher in stitchers:
+        for c, i in stitcher.get_point_requests():
+            point_requests.setdefault((stitcher.imsi, c), []).append(i)
+    broadcastPoints=sc.broadcast(point_requests)
+    points=chunks.filter(lambda x: x[0] in broadcastPoints.value).flatMap(
+        lambda x: [(x[0], i, [x[1][1]['lon'][i], x[1][1]['lat'][i]])
+                   for i in broadcastPoints.value[x[0]]]).collect()
+    imsi_points={}
+    for (imsi, c), i, p in points:
+        imsi_points.setdefault(imsi, {})[(c, i)]=p
+    for stitcher in stitchers:
+        stitcher.add_points(imsi_points.get(stitcher.imsi, {}))
+    chunks.unpersist()
+    return sc.parallelize([stitcher.get_person() for stitcher in stitchers])
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Detects the stay points of each IMSI from the RNC data of each day.')
+    parser.add_argument('--quarantine_observations', type=int, default=DEFAULT_QUARANTINE_OBSERVATIONS,
+                        help='leave out the IMSIs with more than this many observations in a day, and report '
+                             'them in stays/quarantine_YYYY_M_D. Defaults to keeping all IMSIs.')
+    parser.add_argument('--sample_rate', type=float, default=DEFAULT_SAMPLE_RATE,
+                        help='fraction of IMSIs to keep, by a stable hash of the IMSI. Defaults to all IMSIs.')
+    args = parser.parse_args()
+    quarantine_observations = args.quarantine_observations
+    sample_rate = args.sample_rate
+
+    # The Spark session is only created when the job is submitted, so that
+    # get_stay_points can be imported (e.g. by the benchmarks) without Spark.
+    from pyspark import SparkContext
+    from pyspark.sql import SparkSession
+    from pyspark.sql.functions import lit
+
+    spark = SparkSession.builder.appName("Get_Stays New").getOrCreate()
+    sc = spark.sparkContext
+
+    year=2020
+    dates=[{'month': 3, 'day': d} for d in range(2, 32)] + [{'month': 4, 'day': d} for d in range(1, 31)] + [{'month': 5, 'day': d} for d in range(1, 32)]
+
+    hour='*'
+
+    # =============================================================================
+    # Get the RNC data for the period
+    # =============================================================================
+    for date in dates:
+        month=date['month']
+        day=date['day']
+        print('RNC data')
+        rnc_4G_Df=spark.read.parquet('{}/year={}/month={}/day={}/hour={}/*.snappy.parquet'.format(DIR4G, year, month, day, hour))
+        rnc_3G_Df=spark.read.parquet('{}/year={}/month={}/day={}/hour={}/*.snappy.parquet'.format(DIR3G, year, month, day, hour))
+
+        rnc_3G_Df=rnc_3G_Df.withColumn('4G', lit(0))
+        rnc_4G_Df=rnc_4G_Df.withColumn('4G', lit(1))
+
+        print('Union')
+        rnc_Df=rnc_4G_Df.union(rnc_3G_Df)
+
+        print('Transform')
+        rncRdd=rnc_Df.rdd
+        if sample_rate<1:
+            # the same IMSIs on every day, unlike a random sample of each day's IMSIs
+            rncRdd=rncRdd.filter(lambda x: is_sampled_imsi(x['imsi'], sample_rate))
+
+        print('Count observations')
+        min_large=HEAVY_OBSERVATIONS if quarantine_observations is None else min(HEAVY_OBSERVATIONS, quarantine_observations)
+        large_counts=rncRdd.map(lambda x: (x['imsi'], 1)).reduceByKey(
+            lambda a, b: a + b).filter(lambda x: x[1]>min_large).collectAsMap()
+        quarantined={imsi: n for imsi, n in large_counts.items()
+                     if quarantine_observations is not None and n>quarantine_observations}
+        heavy={imsi: get_n_chunks(n) for imsi, n in large_counts.items()
+               if n>HEAVY_OBSERVATIONS and imsi not in quarantined}
+        print('%s heavy imsis, %s quarantined imsis' % (len(heavy), len(quarantined)))
+        broadcastHeavy=sc.broadcast(heavy)
+        broadcastLarge=sc.broadcast(set(heavy) | set(quarantined))
+
+        byIMSE = rncRdd.filter(lambda x: x['imsi'] not in broadcastLarge.value).map(
+            lambda x: (x['imsi'], get_observations(x))).reduceByKey(add_observations)
 
 
+        broadcastConstants = sc.broadcast({
+                                    'MAX_ROAM':MAX_ROAM,
+                                    'MIN_STAY':MIN_STAY
+                                    })
+        print('Stay points')    
+        persons=byIMSE.map(get_stay_points)
+        if heavy:
+            print('Heavy stay points')
+            byIMSEChunk = rncRdd.filter(lambda x: x['imsi'] in broadcastHeavy.value).map(
+                lambda x: ((x['imsi'], get_chunk(x['timestamp'], broadcastHeavy.value[x['imsi']])),
+                           get_observations(x))).reduceByKey(add_observations)
+            persons=persons.union(get_heavy_persons(sc, byIMSEChunk))
+        persons.saveAsTextFile('stays/stays2_{}_{}_{}'.format(year, month, day))
 
+        if quarantined:
+            print('Quarantine report')
+            broadcastQuarantined=sc.broadcast(quarantined)
+            report=rncRdd.filter(lambda x: x['imsi'] in broadcastQuarantined.value).map(
+                lambda x: (x['imsi'], x['mcc'])).reduceByKey(lambda a, b: a).map(
+                lambda x: {'imsi': x[0], 'mcc': x[1], 'n': broadcastQuarantined.value[x[0]]})
+            report.saveAsTextFile('stays/quarantine_{}_{}_{}'.format(year, month, day))
@@ -0,0 +1,65 @@
+"""
+Local HDFS
+-------------
+A stand-in for the hdfs command, to run parquet_to_json.py away from the Hadoop server.
+HDFS paths are read relative to a local root directory, e.g. one written by
+benchmarks/synthetic_data.py --formats=hdfs.
+
+Supports:
+    dfs -copyToLocal SRC DST
+
+An optional delay per copied file simulates a slow network copy.
+
+
+Usage:
+python local_hdfs.py --root=PATH [--delay=SECONDS] dfs -copyToLocal SRC DST
+
+Example usage with parquet_to_json.py:
+python parquet_to_json.py \
+    --start_date=2020-03-01 --end_date=2020-03-07 \
+    --hdfs_command="python local_hdfs.py --root=/tmp/synthetic/hdfs/ --delay=0.5"
+
+"""
+from pathlib import Path
+import shutil
+import sys
+import time
+
+
+def copy_to_local(root, src, dst, delay=0.0):
+    """
+    Copies root/src to dst, like hdfs dfs -copyToLocal. Returns the exit code.
+    """
+    src_path = Path(root) / src
+    if not src_path.exists():
+        print('copyToLocal: `%s\': No such file or directory' % src, file=sys.stderr)
+        return 1
+    dst_path = Path(dst)
+    if dst_path.is_dir():
+        dst_path = dst_path / src_path.name
+    if dst_path.exists():
+        print('copyToLocal: `%s\': File exists' % dst_path, file=sys.stderr)
+        return 1
+    if src_path.is_dir():
+        dst_path.mkdir(parents=True)
+        for fpath in sorted(src_path.iterdir()):
+            time.sleep(delay)
+            shutil.copyfile(fpath, dst_path / fpath.name)
+    else:
+        time.sleep(delay)
+        shutil.copyfile(src_path, dst_path)
+    return 0
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='A local stand-in for the hdfs command.')
+    parser.add_argument('--root', required=True, help='/path/to/local/hdfs/root/')
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='seconds to wait for each copied file')
+    # the hdfs arguments start with '-', so they are parsed by hand
+    args, hdfs_args = parser.parse_known_args()
+    if hdfs_args[:2] == ['dfs', '-copyToLocal'] and len(hdfs_args) == 4:
+        sys.exit(copy_to_local(args.root, hdfs_args[2], hdfs_args[3], args.delay))
+    parser.error('unsupported hdfs command: %s' % ' '.join(hdfs_args))
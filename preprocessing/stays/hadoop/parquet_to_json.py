@@ -1,26 +1,231 @@
-import subprocess
-import sys
-from toolbox import *
+"""
+Parquet to JSON
+-------------
+Copies the daily stays computed on the Hadoop server by get_stays.py from HDFS
+and converts them to the stays json files used by the preprocessing stages.
+
+Copying and converting are pipelined: while a day is converted, the copies of the
+next days run concurrently on a pool of threads, with at most n_copies copies in flight
+(and so at most n_copies + 1 days of copied files on local disk).
+Each day's records are streamed from the part files to the json file, one person
+at a time, rather than loaded as a list of persons.
+
+The conversion can be interrupted and resumed:
+- days whose json file exists are skipped, and their local copies, left if the
+  interruption came between the json file and their removal, are removed
+- json files are written to a .partial file and renamed when complete
+- copies are made into local_filepath/.partial/ and renamed when complete, so a day
+  copied before an interruption is converted without copying it again
+
+The hdfs command can be replaced with local_hdfs.py to run away from the server.
+
+
+Usage:
+python parquet_to_json.py \
+    --start_date=yyyy-mm-dd \
+    --end_date=yyyy-mm-dd \
+    [--outputs_filepath=PATH] \
+    [--local_filepath=PATH] \
+    [--n_copies=INT] \
+    [--hdfs_command=COMMAND]
+
+Example usage:
+nohup python parquet_to_json.py \
+    --start_date=2020-03-02 \
+    --end_date=2020-05-31 \
+    --outputs_filepath=./stays/ \
+    --n_copies=3 \
+    > nohup_parquet_to_json.out &
+
+Example usage with synthetic data (see benchmarks/synthetic_data.py):
+python parquet_to_json.py \
+    --start_date=2020-03-01 \
+    --end_date=2020-03-07 \
+    --outputs_filepath=/tmp/converted/stays/ \
+    --local_filepath=/tmp/converted/ \
+    --hdfs_command="python local_hdfs.py --root=/tmp/synthetic/hdfs/ --delay=0.5"
+
+Instrumentation options (see andorra_mobility/instrumentation.py):
+    [--metrics_log=PATH] [--profile_day=yyyy-mm-dd] [--profiler=cprofile|sampling]
+
+
+Copies hdfs stays_YYYY_M_D/ (part files of one person per line, as saved by get_stays.py)
+
+Saves stays to
+outputs_filepath/YYYY_M/stays_YYYY_M_D.json:
+-------------
+[{imsi, mcc, stay_points: [{p, s, l, e, n, n_4G}, ...]}, ...]
+
+"""
+import ast
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import json
+import os
+import pathlib
+import shlex
+import shutil
+import subprocess
+
+from andorra_mobility.instrumentation import Instrumentation, add_instrumentation_args
+from andorra_mobility.paths import JSON, date_fmt, daterange, get_stays_day_filepath
+
+DEFAULT_N_COPIES = 2
+PARTIAL = '.partial'
+
+
+def get_hdfs_stays_path(year, month, day):
+    return 'stays_{}_{}_{}'.format(year, month, day)
+
+def get_json_filepath(outputs_filepath, year, month, day):
+    return get_stays_day_filepath(outputs_filepath, day, month, year, JSON)
+
+
+def copy_stays_to_local(year, month, day, local_filepath='./', hdfs_command='hdfs'):
+    """
+    Copies a day's stays from HDFS to local_filepath/stays_YYYY_M_D/.
+    The copy is made into local_filepath/.partial/ and moved when complete.
+    returns the local path, or None if the copy failed.
+    """
+    hdfs_path = get_hdfs_stays_path(year, month, day)
+    local_path = pathlib.Path(local_filepath) / hdfs_path
+    if local_path.is_dir():
+        # copied before an interruption
+        return local_path
+    partial_path = pathlib.Path(local_filepath) / PARTIAL / hdfs_path
+    if partial_path.exists():
+        shutil.rmtree(partial_path)
+    partial_path.parent.mkdir(parents=True, exist_ok=True)
+    command = shlex.split(hdfs_command) + ['dfs', '-copyToLocal', hdfs_path, str(partial_path.parent)]
+    completed = subprocess.run(command)
+    if completed.returncode != 0 or not partial_path.exists():
+        return None
+    os.replace(partial_path, local_path)
+    return local_path
+
+
+def remove_local_copies(year, month, day, local_filepath='./'):
+    """
+    Removes the complete and partial local copies of a day's stays, if any.
+    """
+    hdfs_path = get_hdfs_stays_path(year, month, day)
+    for local_path in [pathlib.Path(local_filepath) / hdfs_path, pathlib.Path(local_filepath) / PARTIAL / hdfs_path]:
+        if local_path.exists():
+            shutil.rmtree(local_path)
+
+
+def get_stay_file_paths(local_path):
+    """
+    returns the part files of a day's stays, in order
+    """
+    return sorted(p for p in pathlib.Path(local_path).iterdir() if p.name.startswith('part-'))
+
+
+def read_persons(file_paths):
+    """
+    Yields the persons of the part files, one at a time.
+    Each line is a person saved by saveAsTextFile in get_stays.py, i.e. the repr of a dict.
+    """
+    for fpath in file_paths:
+        with open(fpath) as f:
+            for line in f:
+                if line.strip():
+                    yield ast.literal_eval(line)
+
+
+def write_persons_json(persons, json_filepath):
+    """
+    Streams persons to a json list, written to a .partial file and renamed when complete.
+    The output is the same as json.dump(list(persons), f).
+    returns the number of persons written.
+    """
+    partial_filepath = json_filepath + PARTIAL
+    n_persons = 0
+    with open(partial_filepath, 'w') as f:
+        f.write('[')
+        for person in persons:
+            if n_persons > 0:
+                f.write(', ')
+            f.write(json.dumps(person))
+            n_persons += 1
+        f.write(']')
+    os.replace(partial_filepath, json_filepath)
+    return n_persons
+
+
+def convert_days(datetimes, outputs_filepath, local_filepath='./', hdfs_command='hdfs',
+                 n_copies=DEFAULT_N_COPIES, instrumentation=None):
+    """
+    Copies and converts the stays of each date, copying up to n_copies days ahead of the conversion.
+    returns the dates that could not be copied.
+    """
+    if instrumentation is None:
+        instrumentation = Instrumentation('parquet to json')
+    pending = deque()
+    for d in datetimes:
+        if pathlib.Path(get_json_filepath(outputs_filepath, d.year, d.month, d.day)).is_file():
+            remove_local_copies(d.year, d.month, d.day, local_filepath)
+        else:
+            pending.append(d)
+    print('%s/%s dates already converted' % (len(datetimes) - len(pending), len(datetimes)))
+    failed_dates = []
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=n_copies) as executor:
+        def fill_copies():
+            while pending and len(in_flight) < n_copies:
+                d = pending.popleft()
+                print('Copying data for {}/{}'.format(d.month, d.day))
+                in_flight.append((d, executor.submit(
+                    copy_stays_to_local, d.year, d.month, d.day, local_filepath, hdfs_command)))
+
+        fill_copies()
+        while in_flight:
+            d, copy_future = in_flight.popleft()
+            with instrumentation.stage('wait copy', day=d):
+                local_path = copy_future.result()
+            fill_copies()
+            if local_path is None:
+                print('Copy failed for {}/{}'.format(d.month, d.day))
+                failed_dates.append(d)
+                continue
+            print('Creating json for {}/{}'.format(d.month, d.day))
+            json_filepath = get_json_filepath(outputs_filepath, d.year, d.month, d.day)
+            pathlib.Path(json_filepath).parent.mkdir(parents=True, exist_ok=True)
+            with instrumentation.stage('convert day', day=d) as stage_record:
+                file_paths = get_stay_file_paths(local_path)
+                stage_record.rows_in = len(file_paths)
+                stage_record.rows_out = write_persons_json(read_persons(file_paths), json_filepath)
+            print('Removing local files for {}/{}'.format(d.month, d.day))
+            shutil.rmtree(local_path)
+    return failed_dates
 
-def copy_stays_to_local(year, month, day):
-    command=['hdfs', 'dfs', '-copyToLocal', 'stays_{}_{}_{}'.format(year, month, day),
-             './']
-    subprocess.run(command)
 
 if __name__ == '__main__':
-    month=int(sys.argv[1])
-    days_from=int(sys.argv[2])
-    days_to=int(sys.argv[3])
-    year=2020
-    subprocess.run(['mkdir', 'stays/{}_{}'.format(year, month)])
-    for day in range(days_from, days_to+1):
-        print('Copying data for {}/{}'.format(month, day))
-        copy_stays_to_local(year, month, day)
-        print('Creating json for {}/{}'.format(month, day))
-        folder='stays_{}_{}_{}'.format(year, month, day)
-        file_paths=get_stay_file_paths(folder)
-        persons=get_person_data_all_paths(folder, file_paths)
-        json.dump(persons, open('stays/{}_{}/stays_{}_{}_{}.json'.format(year, month, year, month, day), 'w'))
-        print('Removing local parquet files for {}/{}'.format(month, day))
-        subprocess.run(['rm', '-r','stays_{}_{}_{}'.format(year, month, day)])
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Copies the daily stays from HDFS and converts them to json files.')
+    parser.add_argument('--start_date', required=True)
+    parser.add_argument('--end_date', required=True)
+    parser.add_argument('--outputs_filepath', default='./stays/')
+    parser.add_argument('--local_filepath', default='./',
+                        help='/path/to/copy/hdfs/files/to/')
+    parser.add_argument('--n_copies', type=int, default=DEFAULT_N_COPIES,
+                        help='maximum number of days copied concurrently')
+    parser.add_argument('--hdfs_command', default='hdfs',
+                        help='command to run hdfs, e.g. "python local_hdfs.py --root=PATH"')
+    add_instrumentation_args(parser)
+    args = parser.parse_args()
+    instrumentation = Instrumentation.from_args('parquet to json', args)
+
+    start_date = datetime.strptime(args.start_date, date_fmt)
+    end_date = datetime.strptime(args.end_date, date_fmt)
+    datetimes = [d for d in daterange(start_date, end_date)]
+    print('--- copy and convert stays ---')
+    print('datetimes: %s - %s' % (datetimes[0], datetimes[-1]))
+    failed_dates = convert_days(datetimes, args.outputs_filepath, args.local_filepath,
+                                args.hdfs_command, args.n_copies, instrumentation)
+    print('converted stays. %s failed dates: %s' % (
+        len(failed_dates), [d.strftime(date_fmt) for d in failed_dates]))
+    instrumentation.print_summary()
@@ -11,8 +11,10 @@ Usage:
 python python/preprocessing_stays_by_parish.py \
     --start_date=yyyy-mm-dd \
     --end_date=yyyy-mm-dd \
-    --stays_datapath=/path/to/data/ \
-    --shapefilepath=/path/to/data/shapefile.shp
+    [--data_filepath=/path/to/data/] \
+    --stays_datapath=/path/to/data/stays/ \
+    --shapefilepath=/path/to/data/shapefile.shp \
+    [--sample_rate=FLOAT]
 
 Example usage:
 python python/preprocessing_stays_by_parish.py --start_date=2020-03-01 --end_date=2020-04-18 \
@@ -20,30 +22,36 @@ python python/preprocessing_stays_by_parish.py --start_date=2020-03-01 --end_dat
     --shapefilepath=/home/data_commons/andorra_data_2020/datafiles/shapefiles/andorra_parish.shp \
     > preprocessing_stays_by_parish_2020-03-01_2020-04-18.out
 
+Instrumentation options (see andorra_mobility/instrumentation.py):
+    [--metrics_log=PATH] [--profile_day=yyyy-mm-dd] [--profiler=cprofile|sampling]
+
 
 The input files are saved in filepaths named  by 
     /YYYY_MM/stays_YYYY_MM_DD.json
 The output  files  are saved to 
     /YYYY_MM/stays_YYYY_MM_DD.csv
 
+With --sample_rate < 1, only the stays of a stable sample of users are joined and saved
+(see andorra_mobility/sampling.py). With --data_filepath, they are saved under
+data_filepath/sample_RATE/stays/, where the other stages read them at the same sample rate.
+
 """
 
 
-import datetime
 import json
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 
-import geopandas as gpd
+from andorra_mobility.instrumentation import Instrumentation, add_instrumentation_args
+from andorra_mobility.paths import CSV, JSON, get_datetimes, get_sample_path, get_stays_day_filepath, get_stays_path
+from andorra_mobility.sampling import add_sampling_args, get_sample_mask, set_sample_rate
 
 
 default_stays_datapath = '/home/data_commons/andorra_data_2020/stays/'
 default_andorra_parish_shps_filepath = '/home/data_commons/andorra_data_2020/datafiles/shapefiles/andorra_parish.shp'
 
-date_fmt = '%Y-%m-%d'
-
 IMSI = 'imsi'
 MCC = 'mcc'
 START = 's'
@@ -59,18 +67,6 @@ GEOMETRY = 'geometry'
 CRS ='epsg:4269'
 
 
-def get_stays_day_filepath(datapath, day, month, year=2020):
-    return '{}{}_{}/stays_{}_{}_{}.json'.format(datapath, year, month, year, month, day)
-
-def get_stays_by_parish_filepath(datapath, day, month, year=2020):
-    return '{}{}_{}/stays_{}_{}_{}.csv'.format(datapath, year, month, year, month, day)
-
-
-def daterange(start_datetime, end_datetime):
-    for n in range(int((end_datetime - start_datetime).days) + 1):
-        yield start_datetime + datetime.timedelta(n)
-
-
 def get_stays_df(json_persons_data):
     """
     Returns dataframe with stays.
@@ -78,8 +74,6 @@ def get_stays_df(json_persons_data):
     """
     stays_df = None
     for i, p_data in enumerate(json_persons_data):
-        if i % 10000 == 0:
-            print('processing imsi %s/%s : %s' % (i, len(json_persons_data),datetime.datetime.now()))
         stay_points = p_data['stay_points']
         if not stay_points:
             continue
@@ -103,6 +97,8 @@ def get_stays_by_parish_df(json_persons_data, parish_shps):
     Returns dataframe with stays and parish data.
     Columns: imsi, mcc, s, e, n, n_4G, lat, lon, parish
     """
+    import geopandas as gpd
+
     stays_df = get_stays_df(json_persons_data)
     # join with parishes geodata
     gdfp = gpd.GeoDataFrame(stays_df,
@@ -113,48 +109,92 @@ def get_stays_by_parish_df(json_persons_data, parish_shps):
     return stays_by_parish_df.set_index(IMSI)
 
 
-def process_date_files(dates, stays_datapath, shapefilepath):
+def sample_persons(json_persons_data, sample_rate):
+    """
+    Returns the persons of the users kept at sample_rate
+    """
+    if sample_rate >= 1:
+        return json_persons_data
+    mask = get_sample_mask([p_data[IMSI] for p_data in json_persons_data], sample_rate)
+    return [p_data for p_data, keep in zip(json_persons_data, mask) if keep]
+
+
+def process_date_files(dates, stays_datapath, shapefilepath, instrumentation=None, sample_rate=1.0,
+                       output_stays_datapath=None):
+    """
+    Joins the stays of the json files of stays_datapath with the parishes and saves them
+    as csv files to output_stays_datapath (stays_datapath by default).
+    """
+    import geopandas as gpd
+
+    if instrumentation is None:
+        instrumentation = Instrumentation('stays by parish')
     # Read in the Andorra parish shapefile
     andorra_parish_shps = gpd.read_file(shapefilepath)
     andorra_parish_shps = andorra_parish_shps.to_crs({'init':CRS})
     andorra_parish_shps.rename(columns={'NAME_1':PARISH_NAME}, inplace=True)
     andorra_parish_shps = andorra_parish_shps[[PARISH_NAME, GEOMETRY]]
     assert(len(andorra_parish_shps) == 7) # There  are  7 parishes
+    output_stays_datapath = output_stays_datapath or stays_datapath
     
     for i, d in enumerate(dates):
         date_str =  d.strftime("%Y-%m-%d")
-        print('%s/%s: processing %s -- %s' % (i+1, len(dates), date_str, datetime.datetime.now()))
         
-        stays_json_filepath = get_stays_day_filepath(stays_datapath, d.day, d.month, d.year)
-        stays_by_parish_filepath = get_stays_by_parish_filepath(stays_datapath, d.day, d.month, d.year)
+        stays_json_filepath = get_stays_day_filepath(stays_datapath, d.day, d.month, d.year, JSON)
+        stays_by_parish_filepath = get_stays_day_filepath(output_stays_datapath, d.day, d.month, d.year, CSV)
 
         if not Path(stays_json_filepath).is_file():
             print('skipping %s -- file not found: %s' % (date_str, stays_json_filepath))
             continue
-        stays_json_data = json.load(open(stays_json_filepath))
-        stays_by_parish_df = get_stays_by_parish_df(stays_json_data, andorra_parish_shps)
-        print('%s/%s: saving data for %s to %s' % (i+1, len(dates), date_str, stays_by_parish_filepath))
-        stays_by_parish_df.to_csv(stays_by_parish_filepath)
+        with instrumentation.stage('stays by parish day', day=d) as stage_record:
+            with instrumentation.stage('read json'):
+                stays_json_data = sample_persons(json.load(open(stays_json_filepath)), sample_rate)
+            stage_record.rows_in = len(stays_json_data)
+            with instrumentation.stage('join parishes', rows_in=len(stays_json_data)) as join_record:
+                stays_by_parish_df = get_stays_by_parish_df(stays_json_data, andorra_parish_shps)
+                join_record.rows_out = len(stays_by_parish_df)
+            with instrumentation.stage('write csv', rows_in=len(stays_by_parish_df)):
+                Path(stays_by_parish_filepath).parent.mkdir(parents=True, exist_ok=True)
+                stays_by_parish_df.to_csv(stays_by_parish_filepath)
+            stage_record.rows_out = len(stays_by_parish_df)
+        print('%s/%s: saved data for %s to %s' % (i+1, len(dates), date_str, stays_by_parish_filepath))
         
 
-if __name__ == '__main__':
-    import argparse
-
-    parser = argparse.ArgumentParser(description='Preprocess JSON stays files to produce CSV tables of stays with parishes.')
+def add_arguments(parser):
     parser.add_argument('--start_date', required=True,
                         help='yyyy-mm-dd start date for files to process')
     parser.add_argument('--end_date', required=True,
                         help='yyyy-mm-dd end date for files to process')
-    parser.add_argument('--stays_datapath', default=default_stays_datapath,
+    parser.add_argument('--data_filepath', default=None,
+                        help='/path/to/data/ with stays/. Sets the default of --stays_datapath.')
+    parser.add_argument('--stays_datapath', default=None,
                         help='/path/to/data/')
     parser.add_argument('--shapefilepath', default=default_andorra_parish_shps_filepath,
                         help='/path/to/data/')
+    add_sampling_args(parser)
+    return parser
+
+
+def main(args, instrumentation):
+    sample_rate = set_sample_rate(args.sample_rate)
+    stays_datapath, output_stays_datapath = args.stays_datapath, None
+    if stays_datapath is None:
+        stays_datapath = default_stays_datapath if args.data_filepath is None else get_stays_path(args.data_filepath)
+        if args.data_filepath is not None:
+            # the stays of a sample are kept apart from those of all users
+            output_stays_datapath = get_stays_path(get_sample_path(args.data_filepath, sample_rate))
+    process_dates = get_datetimes(args.start_date, args.end_date)
+    process_date_files(process_dates, stays_datapath, args.shapefilepath, instrumentation, sample_rate,
+                       output_stays_datapath)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Preprocess JSON stays files to produce CSV tables of stays with parishes.')
+    add_arguments(parser)
+    add_instrumentation_args(parser)
     args = parser.parse_args()
-    
-    start_datetime = datetime.datetime.strptime(args.start_date, date_fmt)
-    end_datetime  = datetime.datetime.strptime(args.end_date, date_fmt)
-    
-    process_dates = [d for d in daterange(start_datetime, end_datetime)]
-    process_date_files(process_dates, args.stays_datapath, args.shapefilepath)
-    
-    
\ No newline at end of file
+    instrumentation = Instrumentation.from_args('stays by parish', args)
+    main(args, instrumentation)
+    instrumentation.print_summary()
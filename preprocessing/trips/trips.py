@@ -9,7 +9,8 @@ python trips.py \
     --start_date=yyyy-mm-dd \
     --end_date=yyyy-mm-dd \
     --data_filepath=PATH \
-    --outputs_filepath=PATH
+    --outputs_filepath=PATH \
+    [--sample_rate=FLOAT]
    
 Example usage:
 nohup python trips.py \
@@ -25,13 +26,22 @@ outputs_filepath/YEAR/trips.csv:
 -------------
 date, users making trips, total trips, mean trips, median trips
 
+With --sample_rate < 1 (see andorra_mobility/sampling.py), the users making trips and
+total trips are scaled up to all users, and the standard errors of users making trips,
+total trips and mean trips are added. They are saved to trips_sample_RATE.csv.
+
 """
-from datetime import datetime, timedelta
 import pathlib
 
 import numpy as np
 import pandas as pd
 
+from andorra_mobility.inputs import read_csv
+from andorra_mobility.instrumentation import Instrumentation, add_instrumentation_args
+from andorra_mobility.paths import find_input, get_datetimes, get_sample_suffix, get_stays_filepath
+from andorra_mobility.sampling import (add_sampling_args, get_mean_standard_error, get_sample_rate,
+                                       get_se_column, scale_count, scale_total, set_sample_rate)
+
 IMSI = 'imsi'
 DATE = 'date'
 
@@ -41,66 +51,84 @@ USERS_MAKING_TRIPS = 'users making trips'
 TRIPS_MEAN = 'mean trips'
 TRIPS_MEDIAN = 'median trips'
 
-date_fmt = '%Y-%m-%d'
-
-
-def get_stays_filepath(data_filepath, day, month, year):
-    return '{}stays/{}_{}/stays_{}_{}_{}.csv'.format(data_filepath, year, month, year, month, day)
-
-def daterange(start_datetime, end_datetime):
-    for n in range(int((end_datetime - start_datetime).days) + 1):
-        yield start_datetime + timedelta(n)
 
-def get_trips_df(data_filepath, dates):
+def get_trips_record(d, trips, sample_rate=1.0):
+    """
+    Returns the day's record of trip counts from the number of trips of each user.
+    At a sample rate below 1, counts are scaled up to all users, with standard errors.
+    """
+    record = {
+        DATE: d,
+        USERS_MAKING_TRIPS: len(trips[trips>0]),
+        TOTAL_TRIPS: trips.sum(),
+        TRIPS_MEAN: trips.mean(),
+        TRIPS_MEDIAN: trips.median(),
+    }
+    if sample_rate < 1:
+        record[USERS_MAKING_TRIPS], record[get_se_column(USERS_MAKING_TRIPS)] = scale_count(
+            record[USERS_MAKING_TRIPS], sample_rate)
+        record[TOTAL_TRIPS], record[get_se_column(TOTAL_TRIPS)] = scale_total(trips.values, sample_rate)
+        record[get_se_column(TRIPS_MEAN)] = get_mean_standard_error(trips.values, sample_rate)
+    return record
+
+
+def get_trips_df(data_filepath, dates, instrumentation=None):
+    if instrumentation is None:
+        instrumentation = Instrumentation('trips')
+    sample_rate = get_sample_rate()
     df = None
     records = []
     missing_dates = []
     for i, d in enumerate(dates):
-        stays_filepath = get_stays_filepath(data_filepath, d.day, d.month, d.year)
+        stays_filepath = find_input(get_stays_filepath, data_filepath, sample_rate, d.day, d.month, d.year)
         date_str =  d.strftime("%Y-%m-%d")
-        if i%20==0:
-            print('%s/%s %s : %s' %  (i, len(dates), date_str, datetime.now()))
         if not pathlib.Path(stays_filepath).is_file():
             missing_dates += [d]
             print('%s\nfile not found: %s' % (date_str, stays_filepath))
             continue
-        df = pd.read_csv(stays_filepath).dropna()
-        trips = (df[IMSI].value_counts() - 1)
-        records +=  [{
-            DATE: d,
-            USERS_MAKING_TRIPS: len(trips[trips>0]),
-            TOTAL_TRIPS: trips.sum(),
-            TRIPS_MEAN: trips.mean(),
-            TRIPS_MEDIAN: trips.median(),
-        }]
+        with instrumentation.stage('trips day', day=d) as stage_record:
+            df = read_csv(stays_filepath).dropna()
+            stage_record.rows_in = len(df)
+            trips = (df[IMSI].value_counts() - 1)
+            records +=  [get_trips_record(d, trips, sample_rate)]
+            stage_record.rows_out = 1
     trips_df = pd.DataFrame.from_records(records).set_index(DATE)
     return trips_df, missing_dates
 
 
-if __name__ == '__main__':
-    import argparse
-
-    parser = argparse.ArgumentParser(
-        description='Computes likely dates of presence, entrances, departures \
-                    for each user in the data, based on the dates they are \
-                    observed in the data.')
+def add_arguments(parser):
     parser.add_argument('--start_date', required=True)
     parser.add_argument('--end_date', required=True)
     parser.add_argument('--data_filepath', required=True)
     parser.add_argument('--outputs_filepath', required=True)
-    args = parser.parse_args()
+    add_sampling_args(parser)
+    return parser
+
 
-    start_date = datetime.strptime(args.start_date, date_fmt)
-    end_date = datetime.strptime(args.end_date, date_fmt)
-    datetimes = [d for d in daterange(start_date, end_date)]
+def main(args, instrumentation):
+    datetimes = get_datetimes(args.start_date, args.end_date)
     print('--- get trips ---')
     print('datetimes: %s - %s' % (datetimes[0], datetimes[-1]))
-    year = start_date.year
+    sample_rate = set_sample_rate(args.sample_rate)
+    year = datetimes[0].year
     data_filepath, outputs_filepath = args.data_filepath, args.outputs_filepath
-    trips_df, missing_dates = get_trips_df(data_filepath, datetimes)
+    trips_df, missing_dates = get_trips_df(data_filepath, datetimes, instrumentation)
     print('computed trips. %s/%s missing dates' % (len(missing_dates), len(datetimes)))
-    trips_filepath = ('%s%s/trips.csv' % (outputs_filepath, year))
+    trips_filepath = ('%s%s/trips%s.csv' % (outputs_filepath, year, get_sample_suffix(sample_rate)))
     print('saving trips data to %s' % trips_filepath)
     trips_df.to_csv(trips_filepath, index=True, index_label=DATE)
     print('saved')
-    
\ No newline at end of file
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Computes the daily number of trips made by mobile subscribers, \
+                    based on precomputed stays.')
+    add_arguments(parser)
+    add_instrumentation_args(parser)
+    args = parser.parse_args()
+    instrumentation = Instrumentation.from_args('trips', args)
+    main(args, instrumentation)
+    instrumentation.print_summary()